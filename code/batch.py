@@ -0,0 +1,299 @@
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+
+import click
+import pandas as pd
+from chunking import DEFAULT_CHUNK_SIZE
+from damply import dirs
+from output import OUTPUT_FORMATS
+from profiling import RunProfile
+from simulation import Simulation, SimulationResult
+
+logger = logging.getLogger(__name__)
+
+# Number of threads reading inputs and writing outputs and plots while the compute pool simulates
+DEFAULT_IO_THREADS = 4
+
+
+def dataset_paths(datasets: str) -> list[Path]:
+    """Return the radiomic feature files of a batch, given as a glob pattern or a manifest file listing one path per line.
+
+    Blank lines and lines starting with # in a manifest are skipped. As outputs are named after the parent directory of each
+    file, no two files can share a parent directory name.
+    """
+    manifest = Path(datasets)
+    if manifest.is_file() and manifest.suffix != '.csv':
+        lines = [line.strip() for line in manifest.read_text().splitlines()]
+        filepaths = [Path(line) for line in lines if line and not line.startswith('#')]
+    else:
+        # Path.glob only takes relative patterns, so an absolute pattern is matched from its anchor
+        anchor = Path(datasets).anchor
+        pattern = str(Path(datasets).relative_to(anchor)) if anchor else datasets
+        filepaths = sorted(Path(anchor).glob(pattern))
+
+    if not filepaths:
+        message = f"No radiomic feature files found for {datasets}."
+        raise ValueError(message)
+    missing = [str(filepath) for filepath in filepaths if not filepath.is_file()]
+    if missing:
+        message = f"{missing} listed in the manifest do not exist."
+        raise ValueError(message)
+    names = [filepath.parent.stem for filepath in filepaths]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        message = f"Outputs are named after each file's parent directory, but more than one file of the batch is in a directory named {duplicates}."
+        raise ValueError(message)
+    return filepaths
+
+
+def summary_rows(result: SimulationResult) -> pd.DataFrame:
+    """Tabulate the RECIST accuracy and PD sensitivity of one dataset of a batch, one row per number of target lesions.
+
+    If the run had replicates, the accuracy and PD sensitivity are the replicate means and their confidence intervals are added.
+    """
+    table = pd.DataFrame({'dataset': result.dataset_name,
+                          'num_targets': range(1, len(result.recist_accuracy) + 1),
+                          'accuracy': result.recist_accuracy,
+                          'pd_sensitivity': result.pd_sensitivity})
+    if result.replicate_metrics is not None:
+        for column in ['accuracy_ci_low', 'accuracy_ci_high', 'pd_sensitivity_ci_low', 'pd_sensitivity_ci_high']:
+            table[column] = result.replicate_metrics[column].to_numpy()
+    return table
+
+
+def save_outputs(result: SimulationResult,
+                 out_path: Path,
+                 plot_path: Path,
+                 output_format: str = 'csv',
+                 partition_size: int | None = None,
+                 plot_mode: str = 'auto'
+                 ) -> None:
+    """Save a dataset's outputs, plots and run profile, see SimulationResult.save and SimulationResult.plot. Run on an I/O thread."""
+    result.save(out_path, output_format=output_format, partition_size=partition_size)
+    # Each dataset already plots on its own I/O thread, so its figures are rendered one after another
+    result.plot(plot_path, plot_mode=plot_mode, n_jobs=1)
+    result.profile.save(out_path / f"{result.dataset_name}_run_profile")
+    logger.info(f'Saved the outputs of {result.dataset_name} to {out_path}.')
+
+
+def run_batch(filepaths: list[Path],
+              out_dir: Path | None = None,
+              plot_dir: Path | None = None,
+              location_label: str = "LABEL",
+              n_jobs: int = -1,
+              io_threads: int = DEFAULT_IO_THREADS,
+              cache_dir: Path | None = None,
+              output_format: str = 'csv',
+              partition_size: int | None = None,
+              plot_mode: str = 'auto',
+              **run_options: object
+              ) -> pd.DataFrame:
+    """Simulate every dataset of a batch on one compute pool, overlapping each dataset's input and output with the simulation of others.
+
+    Each dataset is loaded into a Simulation on a thread pool of io_threads while the dataset before it is simulated, so
+    the radiomic feature files are read in the background. The datasets are simulated in order as chunked batch runs on one process pool of n_jobs
+    workers, shared by their Simulations. As each run finishes, its outputs, plots and run profile are saved on the thread pool
+    while the next dataset is simulated, and only the dataset's summary rows are kept once they are saved. The results of each
+    dataset match those of pipe with the same options.
+
+    Parameters
+    ----------
+    filepaths: list[Path]
+        Radiomic feature files to simulate from, see dataset_paths.
+    out_dir: Path | None = None
+        Directory to save each dataset's outputs under, in dataset_name/sim_name like pipe. If None, no outputs are saved.
+    plot_dir: Path | None = None
+        Directory to save each dataset's plots under, in dataset_name/sim_name like pipe. Only used if out_dir is given.
+    location_label: str = "LABEL"
+        Location column label in every dataset's radiomic feature data.
+    n_jobs: int = -1
+        Number of worker processes in the compute pool. -1 uses all available cores.
+    io_threads: int = 4
+        Number of threads reading inputs and writing outputs.
+    cache_dir: Path | None = None
+        Ingest cache directory, see load_radiomic_data.
+    output_format: str = 'csv'
+        File format to save the synthetic lesion and response data in, see output.OUTPUT_FORMATS.
+    partition_size: int | None = None
+        If given, the synthetic data is saved as one file per range of this many patient IDs.
+    plot_mode: str = 'auto'
+        How to plot lesion volume against diameter, see plot.PLOT_MODES.
+    **run_options
+        Other keyword arguments passed to Simulation.run for every dataset, such as num_patients, seed and replicates.
+
+    Returns
+    -------
+    pd.DataFrame
+        Accuracy and PD sensitivity of every dataset by number of target lesions, see summary_rows.
+    """
+    num_patients = run_options.get('num_patients', 100)
+    replicates = run_options.get('replicates', 1)
+    sim_name = f"sim_{num_patients}_pats" if replicates == 1 else f"sim_{num_patients}_pats_{replicates}_reps"
+
+    # joblib is only imported for parallel runs, keeping serial runs quick to start
+    if n_jobs != 1:
+        from joblib import Parallel
+
+    def load(index: int) -> tuple[Future, RunProfile]:
+        """Start loading dataset index into a Simulation on the I/O threads, returning its future and the profile recording its ingest stage."""
+        profile = RunProfile()
+        return io_pool.submit(Simulation, filepaths[index],
+                              location_label=location_label,
+                              n_jobs=n_jobs,
+                              cache_dir=cache_dir,
+                              profile=profile,
+                              pool=compute_pool), profile
+
+    summaries = []
+    with (Parallel(n_jobs=n_jobs, return_as='generator') if n_jobs != 1 else nullcontext()) as compute_pool, \
+         ThreadPoolExecutor(max_workers=io_threads, thread_name_prefix='batch_io') as io_pool:
+        next_load, next_profile = load(0)
+        saving: deque[Future] = deque()
+        try:
+            for index, filepath in enumerate(filepaths):
+                simulation, profile = next_load.result(), next_profile
+                # Only the next dataset is read ahead, so at most two datasets' base data are held at once
+                next_load, next_profile = load(index + 1) if index + 1 < len(filepaths) else (None, None)
+                logger.info(f'Simulating {simulation.dataset_name} from {filepath}.')
+                # The run's stages are added to the profile holding the dataset's ingest stage
+                with simulation:
+                    result = simulation.run(mode='batch', profile=profile, **run_options)
+                summaries.append(summary_rows(result))
+                if out_dir is not None:
+                    # Waiting on the oldest save bounds the results held by pending saves, each dropped once its save finishes
+                    if len(saving) >= io_threads:
+                        saving.popleft().result()
+                    saving.append(io_pool.submit(save_outputs, result,
+                                                 out_path=Path(out_dir) / simulation.dataset_name / sim_name,
+                                                 plot_path=Path(plot_dir or out_dir) / simulation.dataset_name / sim_name,
+                                                 output_format=output_format,
+                                                 partition_size=partition_size,
+                                                 plot_mode=plot_mode))
+                del result
+            # Raise any error from saving the outputs
+            for save in saving:
+                save.result()
+        finally:
+            # A dataset read ahead but not simulated, if a run failed, still removes its shared base columns
+            if next_load is not None and not next_load.cancel() and next_load.exception() is None:
+                next_load.result().close()
+
+    return pd.concat(summaries, ignore_index=True)
+
+@click.command()
+@click.argument('datasets', type=click.STRING)
+@click.option('--batch_name', type=click.STRING, default=None, help="Name of the batch summary. Defaults to the manifest file name, or batch for a glob pattern.")
+@click.option('--num_sim_patients', type=click.INT, default=100, help="Number of patients to generate simulations for in each dataset.")
+@click.option('--expected_num_lesions', type=click.IntRange(1, 30), default=10, help="Expected number of lesions per patient. Must be between 1 and 30.")
+@click.option('--location_label', type=click.STRING, default='LABEL', help="Location column label in the radiomic feature data.")
+@click.option('--save_out', type=click.BOOL, default=True, help="Whether to save out each dataset's simulated lesion data and plots for analysis.")
+@click.option('--random_seed', type=click.INT, default=None, help="Random seed to use for reproducible results. Each dataset is simulated from the same seed.")
+@click.option('--n_jobs', type=click.INT, default=-1, help="Number of worker processes in the compute pool. -1 uses all available cores.")
+@click.option('--io_threads', type=click.IntRange(min=1), default=DEFAULT_IO_THREADS, help="Number of threads reading inputs and writing outputs and plots.")
+@click.option('--replicates', type=click.IntRange(min=1), default=1, help="Number of independent cohorts of num_sim_patients to simulate for each dataset.")
+@click.option('--chunk_size', type=click.IntRange(min=1), default=DEFAULT_CHUNK_SIZE, help="Number of patients per chunk of work.")
+@click.option('--output_format', type=click.Choice(list(OUTPUT_FORMATS)), default='csv', help="File format to save the synthetic lesion and response data in.")
+@click.option('--partition_size', type=click.IntRange(min=1), default=None, help="If given, save the synthetic data as one file per range of this many patient IDs.")
+@click.option('--cache_ingest', type=click.BOOL, default=True, help="Whether to cache the prepared radiomic data in data/procdata for faster repeat runs.")
+# The plot.PLOT_MODES keys, listed here so plot is only imported when saving
+@click.option('--plot_mode', type=click.Choice(['auto', 'scatter', 'density']), default='auto', help="Whether to plot lesion volumes as scatters or binned density. auto uses density for large cohorts.")
+def batch(datasets: str,
+          batch_name: str | None = None,
+          num_sim_patients: int = 100,
+          expected_num_lesions: int = 10,
+          location_label: str = "LABEL",
+          save_out: bool = True,
+          random_seed: int | None = None,
+          n_jobs: int = -1,
+          io_threads: int = DEFAULT_IO_THREADS,
+          replicates: int = 1,
+          chunk_size: int = DEFAULT_CHUNK_SIZE,
+          output_format: str = 'csv',
+          partition_size: int | None = None,
+          cache_ingest: bool = True,
+          plot_mode: str = 'auto'
+          ) -> pd.DataFrame:
+    """Retiring the Ruler multi-dataset batch
+
+       Run the simulation pipeline over many datasets on one compute pool, reading inputs and writing outputs in the background.
+
+    Parameters
+    ----------
+    datasets: str
+        Radiomic feature files to simulate from, as a glob pattern such as "data/rawdata/*/features.csv", or a manifest file listing
+        one path per line. Each dataset's outputs are named after its file's parent directory, as with pipe.
+    batch_name: str | None = None
+        Name of the batch summary. Defaults to the manifest file name, or batch for a glob pattern.
+    num_sim_patients: int = 100
+        Number of patients to generate simulations for in each dataset.
+    expected_num_lesions: int = 10
+        Expected number of lesions per patient. Used to set up a Poisson distribution to select from.
+    location_label: str = "LABEL"
+        Label in every dataset's radiomic feature data identifying where the ground truth tumor is located.
+    save_out: bool = True
+        Whether to save out each dataset's simulated lesion data, metrics and plots to data/procdata and data/results, as pipe does.
+    random_seed: int | None = None
+        Random seed to use for reproducible results. Each dataset is simulated from the same seed, so its results match a pipe run
+        in batch mode with the same seed and chunk size.
+    n_jobs: int = -1
+        Number of worker processes in the compute pool shared by every dataset. -1 uses all available cores.
+    io_threads: int = 4
+        Number of threads reading the radiomic feature files and writing outputs and plots while datasets are simulated.
+    replicates: int = 1
+        Number of independent cohorts of num_sim_patients to simulate for each dataset.
+    chunk_size: int = 10000
+        Number of patients per chunk of work.
+    output_format: str = 'csv'
+        File format to save the synthetic lesion and response data in, one of 'csv', 'parquet' or 'feather'.
+    partition_size: int | None = None
+        If given, the synthetic data is saved as one file per range of partition_size patient IDs.
+    cache_ingest: bool = True
+        Whether to cache the prepared radiomic data in data/procdata/radiomic_cache.
+    plot_mode: str = 'auto'
+        How to plot lesion volume against diameter, see pipe.
+
+    Returns
+    -------
+    pd.DataFrame
+        RECIST accuracy and PD sensitivity of every dataset for 1 to 10 target lesions, with confidence intervals if replicates
+        is more than 1, saved to data/results/batches.
+    """
+    try:
+        filepaths = dataset_paths(datasets)
+    except ValueError as error:
+        raise click.UsageError(str(error)) from error
+    if batch_name is None:
+        batch_name = Path(datasets).stem if Path(datasets).is_file() else 'batch'
+
+    logging.basicConfig(filename=dirs.LOGS / f'batch_{batch_name}.log', level=logging.INFO, format='%(asctime)s %(message)s')
+    logger.info(f'Retiring the Ruler batch started for {len(filepaths)} datasets in {batch_name}')
+
+    summary = run_batch(filepaths,
+                        out_dir=dirs.PROCDATA if save_out else None,
+                        plot_dir=dirs.RESULTS,
+                        location_label=location_label,
+                        n_jobs=n_jobs,
+                        io_threads=io_threads,
+                        cache_dir=dirs.PROCDATA / "radiomic_cache" if cache_ingest else None,
+                        output_format=output_format,
+                        partition_size=partition_size,
+                        plot_mode=plot_mode,
+                        num_patients=num_sim_patients,
+                        expected_num_lesions=expected_num_lesions,
+                        seed=random_seed,
+                        replicates=replicates,
+                        chunk_size=chunk_size)
+
+    results_path = dirs.RESULTS / "batches"
+    results_path.mkdir(parents=True, exist_ok=True)
+    summary.to_csv(results_path / f"{batch_name}_summary.csv", index=False)
+    logger.info('Batch finished.')
+
+    return summary
+
+
+if __name__ == '__main__':
+    batch()
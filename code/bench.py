@@ -0,0 +1,277 @@
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections.abc import Callable
+from datetime import datetime
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from damply import dirs
+from ingest import load_radiomic_data
+from recist import (
+    recist_assess,
+    recist_metrics_by_target_count,
+    select_target_lesions,
+    target_lesion_sweep,
+)
+from synthetic_gen import generate_synthetic_patients
+from version import code_version
+
+# Number of synthetic patients to benchmark each function at
+BENCHMARK_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+# Functions that have a parallel mode are benchmarked both serially and across all available cores
+BENCHMARK_MODES = ['serial', 'parallel']
+
+# Runs faster or smaller than these are too noisy to flag as regressions
+MIN_COMPARE_SECONDS = 0.05
+MIN_COMPARE_MEMORY_MB = 1.0
+
+# Maximum total module import time of a command line entry point started with --help, and packages it must leave to be imported
+# only when they are used
+STARTUP_BUDGET_SECONDS = 1.5
+LAZY_IMPORTS = ['joblib', 'matplotlib', 'scipy', 'seaborn', 'tqdm']
+
+# Number of | separated fields in each line of python -X importtime output
+IMPORTTIME_FIELDS = 3
+
+
+def make_radiomic_fixture(num_lesions: int = 500,
+                          random_seed: int = 0
+                          ) -> pd.DataFrame:
+    """Make a synthetic PyRadiomics feature table with the columns needed by ingest.read_radiomic_data, so benchmarks do not need real data.
+
+    Diameters are uniform from 5 to 120 mm and volumes are within 50% of the sphere volume, across five locations in the LABEL column.
+    """
+    rng = np.random.default_rng(random_seed)
+    diameter = rng.uniform(5, 120, num_lesions)
+    return pd.DataFrame({'original_shape_Maximum2DDiameterSlice': diameter,
+                         'original_shape_VoxelVolume': 4 / 3 * np.pi * (diameter / 2) ** 3 * rng.uniform(0.5, 1.5, num_lesions),
+                         'diagnostics_Image-interpolated_Spacing': [f"(1.0, 1.0, {thickness})" for thickness in rng.choice([1.0, 2.5, 5.0], num_lesions)],
+                         'original_shape_Maximum3DDiameter': diameter * rng.uniform(1.0, 1.4, num_lesions),
+                         'original_shape_MajorAxisLength': diameter * rng.uniform(0.9, 1.2, num_lesions),
+                         'original_shape_MinorAxisLength': diameter * rng.uniform(0.4, 0.9, num_lesions),
+                         'LABEL': rng.choice(['liver', 'lung', 'lymph node', 'bone', 'adrenal'], num_lesions)})
+
+
+def measure(func: Callable,
+            repeats: int = 3,
+            **kwargs: object
+            ) -> tuple[float, float]:
+    """Run func repeats times for its best wall time in seconds and once more under tracemalloc for its peak Python heap memory in MB.
+
+    Memory used by worker processes is not included, so parallel runs only report the memory of the main process.
+    """
+    seconds = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func(**kwargs)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(**kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return seconds, peak / 1e6
+
+
+def benchmark_inputs(num_sim_patients: int,
+                     base_radiomic_data: pd.DataFrame,
+                     random_seed: int = 0
+                     ) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Simulate the lesion and patient response data the assessment and metric functions are benchmarked on."""
+    rng = np.random.default_rng(random_seed)
+    synth_lesions = generate_synthetic_patients(num_sim_patients=num_sim_patients,
+                                                base_radiomic_data=base_radiomic_data,
+                                                lesion_selection_rng=rng,
+                                                batch=True)
+    synth_response = recist_assess(synth_lesions)
+    target_response = target_lesion_sweep(synth_lesions, lesion_selection_rng=rng, max_targets=10)
+    return synth_lesions, pd.concat([synth_response, target_response.drop(columns='patient_id')], axis=1)
+
+
+def run_benchmarks(sizes: list[int],
+                   functions: list[str] | None = None,
+                   repeats: int = 3,
+                   random_seed: int = 0
+                   ) -> list[dict]:
+    """Time and measure the peak memory of the simulation hot paths at each number of patients in sizes.
+
+    Returns one record per function, mode and size with the function, mode, num_patients, seconds and peak_memory_mb.
+    """
+    with tempfile.TemporaryDirectory() as fixture_dir:
+        # Go through the real ingest path so the fixture is prepared like a dataset
+        fixture_path = Path(fixture_dir) / "radiomic_features.csv"
+        make_radiomic_fixture(random_seed=random_seed).to_csv(fixture_path, index=False)
+        rad_data = load_radiomic_data(fixture_path)
+
+    results = []
+    for num_patients in sizes:
+        synth_lesions, patient_response = benchmark_inputs(num_patients, rad_data, random_seed=random_seed)
+        benchmarks = {
+            'generate_synthetic_patients': {
+                mode: (generate_synthetic_patients, {'num_sim_patients': num_patients,
+                                                     'base_radiomic_data': rad_data,
+                                                     'lesion_selection_rng': np.random.default_rng(random_seed),
+                                                     'batch': True,
+                                                     'parallel': mode == 'parallel'})
+                for mode in BENCHMARK_MODES},
+            'recist_assess': {'serial': (recist_assess, {'lesion_data': synth_lesions})},
+            'select_target_lesions': {
+                mode: (select_target_lesions, {'num_lesions': 5,
+                                               'lesion_data': synth_lesions,
+                                               'lesion_selection_rng': np.random.default_rng(random_seed),
+                                               'parallel': mode == 'parallel'})
+                for mode in BENCHMARK_MODES},
+            'recist_metrics_by_target_count': {'serial': (recist_metrics_by_target_count, {'patient_response': patient_response})},
+        }
+
+        for function, modes in benchmarks.items():
+            if functions and function not in functions:
+                continue
+            for mode, (func, kwargs) in modes.items():
+                seconds, peak_memory_mb = measure(func, repeats=repeats, **kwargs)
+                results.append({'function': function,
+                                'mode': mode,
+                                'num_patients': num_patients,
+                                'seconds': seconds,
+                                'peak_memory_mb': peak_memory_mb})
+                click.echo(f"{function:<32}{mode:<10}{num_patients:>10,} patients {seconds:>10.3f} s {peak_memory_mb:>10.1f} MB")
+
+    return results
+
+
+def compare_results(baseline: list[dict],
+                    current: list[dict],
+                    threshold: float = 0.2
+                    ) -> pd.DataFrame:
+    """Match current benchmark records to the baseline by function, mode and size, flagging runs more than threshold slower or larger.
+
+    Changes are only flagged for runs taking at least MIN_COMPARE_SECONDS or MIN_COMPARE_MEMORY_MB in either result.
+    """
+    keys = ['function', 'mode', 'num_patients']
+    comparison = pd.DataFrame(baseline).merge(pd.DataFrame(current), on=keys, suffixes=('_baseline', '_current'))
+
+    comparison['time_ratio'] = comparison['seconds_current'] / comparison['seconds_baseline']
+    comparison['memory_ratio'] = comparison['peak_memory_mb_current'] / comparison['peak_memory_mb_baseline']
+    timed = comparison[['seconds_baseline', 'seconds_current']].max(axis=1) >= MIN_COMPARE_SECONDS
+    comparison['time_regression'] = timed & (comparison['time_ratio'] > 1 + threshold)
+    measured = comparison[['peak_memory_mb_baseline', 'peak_memory_mb_current']].max(axis=1) >= MIN_COMPARE_MEMORY_MB
+    comparison['memory_regression'] = measured & (comparison['memory_ratio'] > 1 + threshold)
+
+    return comparison
+
+
+def startup_imports(script: Path) -> tuple[float, set[str]]:
+    """Run script with --help under python -X importtime, returning its total import time in seconds and the top-level packages imported."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', str(script), '--help'], capture_output=True, text=True, check=True)
+
+    import_seconds = 0.0
+    packages = set()
+    for line in result.stderr.splitlines():
+        # Lines are "import time: self [us] | cumulative [us] | package", indented by two spaces per level of nesting
+        fields = line.removeprefix('import time:').split('|')
+        if not line.startswith('import time:') or len(fields) != IMPORTTIME_FIELDS or not fields[1].strip().isdigit():
+            continue
+        package = fields[2][1:]
+        if not package.startswith(' '):
+            import_seconds += int(fields[1]) / 1e6
+        packages.add(package.strip().split('.')[0])
+
+    return import_seconds, packages
+
+
+@click.group()
+def bench() -> None:
+    """Retiring the Ruler benchmarks
+
+       Measure the run time and peak memory of the simulation hot paths on a synthetic radiomic fixture, and compare runs.
+    """
+
+
+@bench.command()
+@click.option('--sizes', type=click.INT, multiple=True, default=BENCHMARK_SIZES, help="Number of patients to benchmark at. Can be given more than once.")
+@click.option('--function', 'functions', type=click.STRING, multiple=True, help="Only benchmark this function. Can be given more than once.")
+@click.option('--repeats', type=click.IntRange(min=1), default=3, help="Number of timed runs per benchmark, the fastest is kept.")
+@click.option('--random_seed', type=click.INT, default=0, help="Random seed for the fixture and simulations.")
+@click.option('--output', type=click.Path(), default=None, help="JSON file to save results to. Defaults to a timestamped file in data/results/benchmarks.")
+def run(sizes: tuple[int, ...],
+        functions: tuple[str, ...],
+        repeats: int = 3,
+        random_seed: int = 0,
+        output: str | None = None
+        ) -> None:
+    """Run the benchmarks and save the results with the code version and machine details as JSON."""
+    # joblib is only imported when benchmarks run, so the startup check of this script stays within its own budget
+    from joblib import cpu_count
+
+    started = datetime.now()
+    results = run_benchmarks(list(sizes), functions=list(functions), repeats=repeats, random_seed=random_seed)
+
+    output_path = Path(output) if output else dirs.RESULTS / "benchmarks" / f"bench_{started:%Y%m%d_%H%M%S}.json"
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    output_path.write_text(json.dumps({'started': started.isoformat(timespec='seconds'),
+                                       'code_version': code_version(),
+                                       'python': platform.python_version(),
+                                       'numpy': np.__version__,
+                                       'pandas': pd.__version__,
+                                       'machine': platform.platform(),
+                                       'cpu_count': cpu_count(),
+                                       'results': results},
+                                      indent=2))
+    click.echo(f"Saved benchmark results to {output_path}")
+
+
+@bench.command()
+@click.argument('baseline_filepath', type=click.Path(exists=True))
+@click.argument('current_filepath', type=click.Path(exists=True))
+@click.option('--threshold', type=click.FloatRange(min=0), default=0.2, help="Fractional increase in time or peak memory over the baseline to flag as a regression.")
+def compare(baseline_filepath: str,
+            current_filepath: str,
+            threshold: float = 0.2
+            ) -> None:
+    """Compare benchmark results against a saved baseline, exiting with status 1 if any regressions are found."""
+    baseline = json.loads(Path(baseline_filepath).read_text())
+    current = json.loads(Path(current_filepath).read_text())
+    comparison = compare_results(baseline['results'], current['results'], threshold=threshold)
+
+    for row in comparison.itertuples():
+        flags = [flag for flag, regressed in (('TIME', row.time_regression), ('MEMORY', row.memory_regression)) if regressed]
+        click.echo(f"{row.function:<32}{row.mode:<10}{row.num_patients:>10,} patients "
+                   f"time x{row.time_ratio:.2f}  memory x{row.memory_ratio:.2f}  {' '.join(flags)}")
+
+    num_regressions = int((comparison['time_regression'] | comparison['memory_regression']).sum())
+    if num_regressions:
+        click.echo(f"{num_regressions} regressions over {threshold:.0%} against {baseline['code_version']}.")
+        raise SystemExit(1)
+    click.echo(f"No regressions over {threshold:.0%} against {baseline['code_version']}.")
+
+
+@bench.command()
+@click.option('--script', type=click.Path(exists=True), default=Path(__file__).parent / "pipe.py", help="Command line entry point to check. Defaults to pipe.py.")
+@click.option('--budget', type=click.FloatRange(min=0, min_open=True), default=STARTUP_BUDGET_SECONDS, help="Maximum total import time in seconds.")
+@click.option('--repeats', type=click.IntRange(min=1), default=3, help="Number of timed starts, the fastest is kept.")
+def startup(script: str,
+            budget: float = STARTUP_BUDGET_SECONDS,
+            repeats: int = 3
+            ) -> None:
+    """Check the import time of a command line entry point started with --help, exiting with status 1 if it is over budget or imports any LAZY_IMPORTS."""
+    import_seconds, packages = min(startup_imports(script) for _ in range(repeats))
+    eager = sorted(packages.intersection(LAZY_IMPORTS))
+
+    click.echo(f"{Path(script).name} imports in {import_seconds:.3f} s, budget {budget:.3f} s.")
+    if eager:
+        click.echo(f"Imported at startup but should only be imported when used: {', '.join(eager)}.")
+    if import_seconds > budget or eager:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from lesion_store import LesionStore
+from pyarrow import feather
+
+# Bumped whenever the checkpoint layout changes, so checkpoints in an older layout are never resumed
+CHECKPOINT_VERSION = 1
+
+
+def write_durably(filepath: Path, write: Callable[[Path], None]) -> None:
+    """Write a file with write(path) to a temporary file, flush it to disk and move it into place, so filepath is never left partly written."""
+    partial_file = filepath.with_name(f"{filepath.name}.{os.getpid()}.tmp")
+    write(partial_file)
+    with partial_file.open('rb+') as file:
+        os.fsync(file.fileno())
+    partial_file.replace(filepath)
+
+
+class RunCheckpoint:
+    """Durable record of the finished chunks of a chunked simulation run, so a run that dies partway can be resumed.
+
+    run.json holds the run config and the entropy of the SeedSequence that every chunk's random stream is spawned from. Each
+    finished chunk's lesion and response data are written as Feather files, followed by a JSON marker with the spawn key of the
+    chunk's random stream, so a chunk only counts as finished once all of its data is on disk. As each chunk's stream depends only
+    on the entropy and the chunk index, a resumed run recomputes the missing chunks with the same draws as an uninterrupted run.
+    """
+
+    def __init__(self,
+                 checkpoint_dir: Path,
+                 run_config: dict,
+                 seed_entropy: int,
+                 resume: bool = False
+                 ) -> None:
+        self.checkpoint_dir = Path(checkpoint_dir)
+        # Round trip through JSON so the config compares equal to the saved one, for example with tuples as lists
+        self.run_config = json.loads(json.dumps(run_config))
+        run_file = self.checkpoint_dir / "run.json"
+
+        if resume and run_file.exists():
+            saved = json.loads(run_file.read_text())
+            if saved['checkpoint_version'] != CHECKPOINT_VERSION or saved['config'] != self.run_config:
+                message = (f"The checkpoint in {self.checkpoint_dir} was made by a run with a different config or code version and cannot be "
+                           f"resumed. Rerun without resume to start over.")
+                raise ValueError(message)
+            self.seed_entropy = saved['seed_entropy']
+            return
+
+        # Starting over, so any chunks left by an earlier run are removed
+        if self.checkpoint_dir.exists():
+            shutil.rmtree(self.checkpoint_dir)
+        self.checkpoint_dir.mkdir(parents=True)
+        self.seed_entropy = seed_entropy
+        write_durably(run_file, lambda path: path.write_text(json.dumps({'checkpoint_version': CHECKPOINT_VERSION,
+                                                                         'config': self.run_config,
+                                                                         'seed_entropy': seed_entropy},
+                                                                        indent=2)))
+
+    def chunk_file(self,
+                   index: int,
+                   suffix: str
+                   ) -> Path:
+        """Return the path of a file of chunk index, with suffix such as '_lesions.feather'."""
+        return self.checkpoint_dir / f"chunk_{index:06d}{suffix}"
+
+    def is_finished(self,
+                    index: int,
+                    chunk_rng: np.random.Generator
+                    ) -> bool:
+        """Whether chunk index was finished with the random stream of chunk_rng."""
+        marker_file = self.chunk_file(index, '.json')
+        if not marker_file.exists():
+            return False
+        return json.loads(marker_file.read_text())['spawn_key'] == list(chunk_rng.bit_generator.seed_seq.spawn_key)
+
+    def save(self,
+             index: int,
+             chunk_rng: np.random.Generator,
+             synth_lesions: LesionStore,
+             synth_response: pd.DataFrame
+             ) -> None:
+        """Durably write the lesion and response data of finished chunk index, drawn with chunk_rng, then mark it finished."""
+        # Stage timings belong to the run that simulated the chunk, not to a resumed run loading it
+        response = synth_response.copy()
+        response.attrs = {}
+        write_durably(self.chunk_file(index, '_lesions.feather'), lambda path: feather.write_feather(synth_lesions.to_frame(), path))
+        write_durably(self.chunk_file(index, '_response.feather'), lambda path: feather.write_feather(response, path))
+
+        seed_seq = chunk_rng.bit_generator.seed_seq
+        marker = {'index': index,
+                  'num_lesions': len(synth_lesions),
+                  'num_patients': len(synth_response),
+                  'entropy': seed_seq.entropy,
+                  'spawn_key': list(seed_seq.spawn_key)}
+        write_durably(self.chunk_file(index, '.json'), lambda path: path.write_text(json.dumps(marker)))
+
+    def load(self,
+             index: int,
+             location_labels: np.ndarray | None = None
+             ) -> tuple[LesionStore, pd.DataFrame]:
+        """Read the lesion and response data of finished chunk index, with location_labels as the lesion store's location lookup table."""
+        synth_lesions = LesionStore.from_frame(feather.read_feather(self.chunk_file(index, '_lesions.feather')), location_labels=location_labels)
+        synth_response = feather.read_feather(self.chunk_file(index, '_response.feather'))
+        synth_response.attrs = {}
+        return synth_lesions, synth_response
+
+    def remove(self) -> None:
+        """Delete the checkpoint once the run's outputs are saved."""
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
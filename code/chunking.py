@@ -0,0 +1,65 @@
+from collections.abc import Callable, Iterable, Iterator
+
+import numpy as np
+
+# Default number of patients handled by each chunk of work
+DEFAULT_CHUNK_SIZE = 10_000
+
+
+def chunk_bounds(num_items: int,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE
+                 ) -> list[tuple[int, int]]:
+    """Split num_items into consecutive (start, stop) bounds holding at most chunk_size items each."""
+    if chunk_size < 1:
+        message = f"chunk_size must be at least 1, got {chunk_size}."
+        raise ValueError(message)
+
+    return [(start, min(start + chunk_size, num_items)) for start in range(0, num_items, chunk_size)]
+
+
+def spawn_chunk_rngs(rng: np.random.Generator,
+                     num_chunks: int
+                     ) -> list[np.random.Generator]:
+    """Spawn an independent random number generator for each chunk from the SeedSequence of rng.
+
+    The streams only depend on the seed of rng and the chunk index, so results are the same no matter
+    how many workers the chunks are spread across.
+    """
+    return [np.random.default_rng(seed) for seed in rng.bit_generator.seed_seq.spawn(num_chunks)]
+
+
+def iter_chunks(chunk_func: Callable,
+                chunk_kwargs: Iterable[dict],
+                n_jobs: int = 1,
+                pool: object | None = None
+                ) -> Iterator:
+    """Lazily run chunk_func once per set of keyword arguments in chunk_kwargs, using a process pool of n_jobs workers if n_jobs is not 1.
+
+    Results are yielded in the same order as chunk_kwargs as soon as they are ready, so callers can process and drop each one
+    without holding every chunk's result in memory. If pool is given, an entered joblib Parallel with return_as='generator',
+    its workers are used instead of starting a pool for this call.
+    """
+    if n_jobs == 1:
+        return (chunk_func(**kwargs) for kwargs in chunk_kwargs)
+
+    # joblib is only imported for parallel runs, keeping serial runs quick to start
+    from joblib import Parallel, delayed
+
+    if pool is None:
+        pool = Parallel(n_jobs=n_jobs, return_as='generator')
+    return pool(delayed(chunk_func)(**kwargs) for kwargs in chunk_kwargs)
+
+
+def map_chunks(chunk_func: Callable,
+               chunk_kwargs: list[dict],
+               n_jobs: int = 1,
+               pool: object | None = None
+               ) -> list:
+    """Run chunk_func once per set of keyword arguments in chunk_kwargs, using a process pool of n_jobs workers if n_jobs is not 1.
+
+    Results are returned in the same order as chunk_kwargs. See iter_chunks for pool.
+    """
+    if len(chunk_kwargs) <= 1:
+        n_jobs = 1
+
+    return list(iter_chunks(chunk_func, chunk_kwargs, n_jobs=n_jobs, pool=pool))
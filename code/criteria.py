@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+from lesion_store import LesionStore
+from recist import (
+    PD_THRESHOLD,
+    PR_THRESHOLD,
+    SD_THRESHOLD,
+    lesion_location_codes,
+    recist_labels,
+    target_sum_sweep,
+)
+
+# Response criteria that can be assessed together with assess_criteria. Each criterion sums the pre- and post-treatment lesion
+# measures in pre and post, reports the sums and their percent change with the label prefix, and classifies the percent change as
+# PD above pd_threshold, SD above sd_threshold, PR above -100 and CR at -100. Add an entry to assess another criterion.
+RESPONSE_CRITERIA = {
+    # RECIST 1.1 sum of longest diameters
+    'RECIST': {'pre': 'diameter_pre', 'post': 'diameter_post', 'label': 'sld', 'pd_threshold': PD_THRESHOLD,
+               'sd_threshold': SD_THRESHOLD},
+    # Volumetric thresholds equivalent to the RECIST diameter thresholds for a sphere, 1.2^3 - 1 and 0.7^3 - 1
+    'Volumetric (contoured)': {'pre': 'volume_cc_contoured', 'post': 'volume_cc_contoured_post', 'label': 'contoured_volume',
+                               'pd_threshold': 73, 'sd_threshold': -65},
+    'Volumetric (sphere)': {'pre': 'volume_cc_pre', 'post': 'volume_cc_post', 'label': 'sphere_volume',
+                            'pd_threshold': 73, 'sd_threshold': -65},
+    'Volumetric (3D max sphere)': {'pre': 'volume_cc_3Dmax', 'post': 'volume_cc_3Dmax_post', 'label': 'sphere_3D_max_volume',
+                                   'pd_threshold': 73, 'sd_threshold': -65},
+}
+
+# Post-treatment volumes that are not simulated directly, mapped to their pre-treatment volume. They are scaled by the cube of
+# each lesion's simulated diameter change, assuming lesions grow or shrink uniformly in every direction.
+POST_TREATMENT_VOLUMES = {'volume_cc_contoured_post': 'volume_cc_contoured',
+                          'volume_cc_3Dmax_post': 'volume_cc_3Dmax'}
+
+
+def lesion_measures(lesion_data: pd.DataFrame | LesionStore,
+                    columns: list[str]
+                    ) -> np.ndarray:
+    """Return an array of shape (lesions, len(columns)) of lesion measures, calculating any POST_TREATMENT_VOLUMES columns."""
+    measures = np.empty((len(lesion_data), len(columns)))
+    for index, column in enumerate(columns):
+        if column in POST_TREATMENT_VOLUMES and column not in lesion_data.columns:
+            measures[:, index] = np.asarray(lesion_data[POST_TREATMENT_VOLUMES[column]]) * (1 + np.asarray(lesion_data['diameter_change'])) ** 3
+        else:
+            measures[:, index] = np.asarray(lesion_data[column])
+    return measures
+
+
+def criteria_codes(change: np.ndarray,
+                   pd_thresholds: np.ndarray,
+                   sd_thresholds: np.ndarray
+                   ) -> np.ndarray:
+    """Classify percent changes of shape (..., criteria) with each criterion's thresholds, returning RECIST_CATEGORIES codes like recist_codes."""
+    codes = np.select([change > pd_thresholds,
+                       change > sd_thresholds,
+                       change > PR_THRESHOLD,
+                       change == PR_THRESHOLD],
+                      [3, 2, 1, 0],
+                      default=-1)
+    return codes.astype(np.int8)
+
+
+def percent_change(pre: np.ndarray, post: np.ndarray) -> np.ndarray:
+    """Percent change from pre to post, NaN where pre is 0."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (post - pre) / pre * 100
+
+
+def assess_criteria(lesion_data: pd.DataFrame | LesionStore,
+                    lesion_selection_rng: np.random.Generator,
+                    criteria: list[str] | None = None,
+                    max_targets: int = 10
+                    ) -> pd.DataFrame:
+    """Assess the response of each patient under several response criteria, using all lesions and 1 to max_targets target lesions, in one pass.
+
+    The measures of every criterion are summed together, with one np.bincount per measure for all lesions and one target_sum_sweep
+    for the target lesions, so each patient's target lesions are the same under every criterion. With criteria=['RECIST'], the output
+    matches recist_assess combined with target_lesion_sweep for the same random number generator.
+
+    Parameters
+    ----------
+    lesion_data: pd.DataFrame | LesionStore
+        Lesion measurement data, like that output by generate_synthetic_patients.
+    lesion_selection_rng: np.random.Generator
+        Random number generator to use for target lesion selection.
+    criteria: list[str] | None = None
+        Names of the RESPONSE_CRITERIA to assess. If None, all criteria are assessed.
+    max_targets: int = 10
+        Maximum number of target lesions to assess with.
+
+    Returns
+    -------
+    pd.DataFrame
+        Sorted patient IDs, the number of lesions and, for each criterion, the pre- and post-treatment sums and percent change of
+        its measure, its "{criterion} (all)" response category and a "{criterion} (k targets)" column for each k from 1 to max_targets.
+    """
+    criteria = list(RESPONSE_CRITERIA) if criteria is None else list(criteria)
+    unknown = [criterion for criterion in criteria if criterion not in RESPONSE_CRITERIA]
+    if unknown:
+        message = f"{unknown} are not supported response criteria, must be in {list(RESPONSE_CRITERIA)}."
+        raise ValueError(message)
+
+    specs = [RESPONSE_CRITERIA[criterion] for criterion in criteria]
+    pd_thresholds = np.array([spec['pd_threshold'] for spec in specs])
+    sd_thresholds = np.array([spec['sd_threshold'] for spec in specs])
+    # Each measure is only gathered and summed once, even if it is shared by several criteria
+    columns = list(dict.fromkeys(column for spec in specs for column in (spec['pre'], spec['post'])))
+    pre_index = [columns.index(spec['pre']) for spec in specs]
+    post_index = [columns.index(spec['post']) for spec in specs]
+
+    patient_codes, patients = pd.factorize(np.asarray(lesion_data['patient_id']), sort=True)
+    num_patients = len(patients)
+    measures = lesion_measures(lesion_data, columns)
+
+    lesion_counts = np.bincount(patient_codes, minlength=num_patients)
+    sums = np.stack([np.bincount(patient_codes, weights=measures[:, index], minlength=num_patients) for index in range(len(columns))], axis=-1)
+    change = percent_change(sums[:, pre_index], sums[:, post_index])
+    response = recist_labels(criteria_codes(change, pd_thresholds, sd_thresholds))
+
+    target_sums = target_sum_sweep(patient_codes=patient_codes,
+                                   location_codes=lesion_location_codes(lesion_data),
+                                   values=measures,
+                                   num_patients=num_patients,
+                                   lesion_selection_rng=lesion_selection_rng,
+                                   max_targets=max_targets)
+    target_change = percent_change(target_sums[..., pre_index], target_sums[..., post_index])
+    target_response = recist_labels(criteria_codes(target_change, pd_thresholds, sd_thresholds))
+
+    patient_response = {'patient_id': patients, 'num_lesions': lesion_counts}
+    for index, (criterion, spec) in enumerate(zip(criteria, specs, strict=True)):
+        patient_response[f"{spec['label']}_pre"] = sums[:, pre_index[index]]
+        patient_response[f"{spec['label']}_post"] = sums[:, post_index[index]]
+        patient_response[f"{spec['label']}_chg"] = change[:, index]
+        patient_response[f"{criterion} (all)"] = response[:, index]
+    for index, criterion in enumerate(criteria):
+        for num_targets in range(1, max_targets + 1):
+            patient_response[f"{criterion} ({num_targets} targets)"] = target_response[:, num_targets - 1, index]
+
+    return pd.DataFrame(patient_response)
+
+
+def criteria_metrics_table(criteria_metrics: dict[str, tuple[list, list]]) -> pd.DataFrame:
+    """Tabulate the accuracy and PD sensitivity lists of each criterion, one row per criterion and number of target lesions.
+
+    Accuracy is the agreement of each criterion's response using k target lesions with its response using all lesions, and PD
+    sensitivity is the share of patients in PD using all lesions who are also in PD using k target lesions, see MetricAccumulator.
+    """
+    return pd.concat([pd.DataFrame({'criterion': criterion,
+                                    'num_targets': range(1, len(accuracy) + 1),
+                                    'accuracy': accuracy,
+                                    'pd_sensitivity': pd_sensitivity})
+                      for criterion, (accuracy, pd_sensitivity) in criteria_metrics.items()],
+                     ignore_index=True)
+
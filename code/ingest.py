@@ -0,0 +1,112 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# PyRadiomics feature columns needed to prepare the base radiomic data for simulation
+RADIOMIC_COLUMNS = ['original_shape_Maximum2DDiameterSlice',
+                    'original_shape_VoxelVolume',
+                    'diagnostics_Image-interpolated_Spacing',
+                    'original_shape_Maximum3DDiameter',
+                    'original_shape_MajorAxisLength',
+                    'original_shape_MinorAxisLength']
+
+# Increment when prepare_radiomic_data or the cache file layout changes so stale cache files are not reused
+CACHE_VERSION = 2
+
+# Suffix of the cache arrays marking the missing values of a text column, which are stored as empty strings
+MISSING_SUFFIX = ':missing'
+
+
+def file_hash(filepath: Path) -> str:
+    """Return the SHA-256 hash of a file's contents."""
+    with Path(filepath).open('rb') as file:
+        return hashlib.file_digest(file, 'sha256').hexdigest()
+
+
+def prepare_radiomic_data(rad_data: pd.DataFrame) -> pd.DataFrame:
+    """Add the slice thickness and contoured volume columns to PyRadiomics feature data."""
+    # Extract the slice thickness from the last value of the interpolated spacing, e.g. "(0.8, 0.8, 5.0)"
+    rad_data['slice_thickness'] = rad_data['diagnostics_Image-interpolated_Spacing'].str.rsplit(', ', n=1).str[-1].str.strip('()').astype(float)
+
+    # Calculate the true volume of the segmentation
+    rad_data['volume_cc_contoured'] = rad_data['original_shape_VoxelVolume'] * rad_data['slice_thickness'] / 1000
+
+    return rad_data
+
+
+def read_radiomic_data(radiomic_features_filepath: Path,
+                       location_label: str = "LABEL"
+                       ) -> pd.DataFrame:
+    """Read only the columns of a PyRadiomics feature file needed for simulation and prepare them with prepare_radiomic_data."""
+    usecols = {*RADIOMIC_COLUMNS, location_label}
+    rad_data = pd.read_csv(radiomic_features_filepath, usecols=lambda column: column in usecols)
+
+    if location_label not in rad_data.columns:
+        message = f"{location_label} is not a column name in the provided radiomic data."
+        raise ValueError(message)
+
+    return prepare_radiomic_data(rad_data)
+
+
+def load_radiomic_data(radiomic_features_filepath: Path,
+                       location_label: str = "LABEL",
+                       cache_dir: Path | None = None
+                       ) -> pd.DataFrame:
+    """Load the base radiomic data to simulate from, using a cached copy of the prepared columns if available.
+
+    Parameters
+    ----------
+    radiomic_features_filepath: Path
+        PyRadiomics feature CSV file with diameter and volume data.
+    location_label: str = "LABEL"
+        Location column label in the radiomic feature data.
+    cache_dir: Path | None = None
+        Directory to store prepared data in. Cache files are keyed on the SHA-256 hash of the feature file's contents and
+        location_label, so an edited file is always re-read. If None, the feature file is read without caching.
+
+    Returns
+    -------
+    pd.DataFrame
+        Prepared base radiomic data with the RADIOMIC_COLUMNS, location_label, slice_thickness and volume_cc_contoured columns.
+    """
+    if cache_dir is None:
+        return read_radiomic_data(radiomic_features_filepath, location_label=location_label)
+
+    cache_key = hashlib.sha256(f"{file_hash(radiomic_features_filepath)}:{location_label}:{CACHE_VERSION}".encode()).hexdigest()[:16]
+    cache_file = Path(cache_dir) / f"{Path(radiomic_features_filepath).stem}_{cache_key}.npz"
+
+    if cache_file.exists():
+        with np.load(cache_file) as cached:
+            cached_data = {}
+            for column in cached.files:
+                if column.endswith(MISSING_SUFFIX):
+                    continue
+                values = cached[column]
+                if f"{column}{MISSING_SUFFIX}" in cached.files:
+                    values = values.astype(object)
+                    values[cached[f"{column}{MISSING_SUFFIX}"]] = np.nan
+                cached_data[column] = values
+            return pd.DataFrame(cached_data)
+
+    rad_data = read_radiomic_data(radiomic_features_filepath, location_label=location_label)
+
+    # Store text columns as fixed-width strings with a mask of their missing values, so the cache can be loaded without pickle
+    cache_arrays = {}
+    for column in rad_data.columns:
+        if rad_data[column].dtype == object:
+            missing = rad_data[column].isna().to_numpy()
+            cache_arrays[column] = rad_data[column].fillna('').to_numpy(dtype=str)
+            cache_arrays[f"{column}{MISSING_SUFFIX}"] = missing
+        else:
+            cache_arrays[column] = rad_data[column].to_numpy()
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    partial_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+    with partial_file.open('wb') as file:
+        np.savez(file, **cache_arrays)
+    # Move the finished file into place so concurrent runs never read a partial cache
+    partial_file.replace(cache_file)
+
+    return rad_data
@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from synthetic_gen import DERIVED_VOLUME_COLUMNS, volume_calc
+
+
+class LesionStore:
+    """Compact struct-of-arrays store of synthetic lesion data.
+
+    Integer columns are held as int32 (patient_id) or int16 (lesion_idx and other small counters), the location labels as int16
+    codes into a lookup table, and measurements as float32, each in its own contiguous array. The sphere-derived volume columns
+    are not stored, they are calculated from their diameters when requested.
+
+    A store made with take is a view: it shares the arrays of the store it was taken from and only holds the selected row
+    positions, so target lesion subsets do not copy any lesion data. Use from_frame and to_frame to convert from and to the
+    lesion DataFrame returned by generate_synthetic_patients.
+    """
+
+    __slots__ = ('columns', 'integers', 'location_code', 'location_labels', 'measurements', 'rows')
+
+    def __init__(self,
+                 columns: list[str],
+                 integers: dict[str, np.ndarray],
+                 location_code: np.ndarray,
+                 location_labels: np.ndarray,
+                 measurements: dict[str, np.ndarray],
+                 rows: np.ndarray | None = None
+                 ) -> None:
+        self.columns = columns
+        self.integers = integers
+        self.location_code = location_code
+        self.location_labels = location_labels
+        self.measurements = measurements
+        self.rows = rows
+
+    @classmethod
+    def from_frame(cls,
+                   lesion_data: pd.DataFrame,
+                   location_labels: np.ndarray | None = None
+                   ) -> 'LesionStore':
+        """Build a store from lesion data with a patient_id and location column. If location_labels is not given, it is made from the unique locations in lesion_data."""
+        if location_labels is None:
+            location_code, location_labels = pd.factorize(lesion_data['location'].to_numpy(), sort=True)
+        else:
+            location_code = pd.Categorical(lesion_data['location'], categories=location_labels).codes
+
+        integers = {}
+        measurements = {}
+        for column in lesion_data.columns:
+            values = lesion_data[column].to_numpy()
+            if column == 'location' or (column in DERIVED_VOLUME_COLUMNS and DERIVED_VOLUME_COLUMNS[column] in lesion_data.columns):
+                continue
+            if column == 'patient_id':
+                integers[column] = values.astype(np.int32)
+            elif np.issubdtype(values.dtype, np.integer):
+                integers[column] = values.astype(np.int16 if values.size == 0 or np.abs(values).max() < np.iinfo(np.int16).max else np.int32)
+            else:
+                measurements[column] = values.astype(np.float32)
+
+        return cls(columns=list(lesion_data.columns),
+                   integers=integers,
+                   location_code=location_code.astype(np.int16),
+                   location_labels=np.asarray(location_labels, dtype=object),
+                   measurements=measurements)
+
+    @classmethod
+    def concat(cls, stores: list['LesionStore']) -> 'LesionStore':
+        """Concatenate stores with the same columns into one new store, merging their location lookup tables."""
+        location_labels = pd.unique(np.concatenate([store.location_labels for store in stores]))
+        # Map each store's location codes onto the merged lookup table
+        location_code = np.concatenate([pd.Index(location_labels).get_indexer(store.location_labels).astype(np.int16)[store.column('location_code')]
+                                        for store in stores])
+
+        return cls(columns=stores[0].columns,
+                   integers={column: np.concatenate([store.column(column) for store in stores]) for column in stores[0].integers},
+                   location_code=location_code,
+                   location_labels=np.asarray(location_labels, dtype=object),
+                   measurements={column: np.concatenate([store.column(column) for store in stores]) for column in stores[0].measurements})
+
+    def __len__(self) -> int:
+        return len(self.location_code) if self.rows is None else len(self.rows)
+
+    def take(self, rows: np.ndarray) -> 'LesionStore':
+        """Return a view of the lesions at the given row positions of this store, sharing its arrays."""
+        rows = np.asarray(rows)
+        return LesionStore(columns=self.columns,
+                           integers=self.integers,
+                           location_code=self.location_code,
+                           location_labels=self.location_labels,
+                           measurements=self.measurements,
+                           rows=rows if self.rows is None else self.rows[rows])
+
+    def column(self, name: str) -> np.ndarray:
+        """Return the values of a column for the lesions in this store, including the location_code array and derived volume columns."""
+        if name == 'location':
+            # Code -1 (a location missing from the lookup table) indexes the trailing None
+            return np.append(self.location_labels, None)[self.column('location_code')]
+        if name in DERIVED_VOLUME_COLUMNS and name not in self.measurements:
+            return volume_calc(self.column(DERIVED_VOLUME_COLUMNS[name]))
+
+        if name == 'location_code':
+            values = self.location_code
+        elif name in self.integers:
+            values = self.integers[name]
+        else:
+            values = self.measurements[name]
+        return values if self.rows is None else values[self.rows]
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.column(name)
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes held by the store's arrays, including the row positions of a view."""
+        arrays = [*self.integers.values(), self.location_code, *self.measurements.values()]
+        return sum(array.nbytes for array in arrays) + (0 if self.rows is None else self.rows.nbytes)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Convert to a lesion DataFrame with the original columns, int64 integers and float64 measurements."""
+        lesion_data = pd.DataFrame({column: self.column(column) for column in self.columns})
+        integer_columns = [column for column in self.columns if column in self.integers]
+        float_columns = [column for column in self.columns if column not in self.integers and column != 'location']
+        return lesion_data.astype({**dict.fromkeys(integer_columns, np.int64), **dict.fromkeys(float_columns, np.float64)})
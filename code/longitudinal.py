@@ -0,0 +1,269 @@
+import logging
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from chunking import DEFAULT_CHUNK_SIZE, chunk_bounds, map_chunks, spawn_chunk_rngs
+from damply import dirs
+from ingest import load_radiomic_data
+from output import OUTPUT_FORMATS, write_table
+from recist import PD_THRESHOLD, SD_THRESHOLD, recist_labels, target_sum_sweep
+from samplers import TruncatedNormalSampler
+from shared_table import SharedTable, share_with_workers, table_frame
+from streaming import MetricAccumulator
+from synthetic_gen import draw_lesion_counts, select_base_columns
+
+logger = logging.getLogger(__name__)
+
+# RECIST 1.1 also requires the SLD to grow by at least this many millimetres over the nadir for progressive disease
+PD_MIN_INCREASE = 5
+
+
+def longitudinal_response(sld_series: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Classify the RECIST response at each follow-up timepoint of SLD series of shape (..., timepoints), where index 0 is baseline.
+
+    Progression is judged against the nadir, the running minimum SLD of all earlier timepoints including baseline: PD when the SLD is
+    more than PD_THRESHOLD percent and at least PD_MIN_INCREASE mm over the nadir. Otherwise CR when the SLD is 0, PR when it is at
+    least SD_THRESHOLD percent below baseline and SD if not. Only measured lesions are considered, with no confirmation scans.
+
+    Returns
+    -------
+    response: np.ndarray
+        RECIST category code of shape (..., timepoints - 1) for each follow-up timepoint, see recist_codes.
+    best_response: np.ndarray
+        Best overall response code, the best response recorded up to and including the first PD.
+    time_to_pd: np.ndarray
+        Follow-up timepoint number (1 for the first follow-up) of the first PD, NaN if the patient never progresses.
+    """
+    baseline = sld_series[..., :1]
+    follow_up = sld_series[..., 1:]
+    # Nadir before each follow-up timepoint
+    nadir = np.minimum.accumulate(sld_series, axis=-1)[..., :-1]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change_from_nadir = (follow_up - nadir) / nadir * 100
+        change_from_baseline = (follow_up - baseline) / baseline * 100
+    progressed = (change_from_nadir > PD_THRESHOLD) & (follow_up - nadir >= PD_MIN_INCREASE)
+    response = np.select([progressed, follow_up == 0, change_from_baseline <= SD_THRESHOLD],
+                         [3, 0, 1],
+                         default=2).astype(np.int8)
+
+    ever_progressed = progressed.any(axis=-1)
+    first_pd = np.where(ever_progressed, np.argmax(progressed, axis=-1), progressed.shape[-1])
+    # Responses after the first PD do not count towards the best overall response
+    after_pd = np.arange(progressed.shape[-1]) > first_pd[..., None]
+    best_response = np.where(after_pd, 3, response).min(axis=-1).astype(np.int8)
+    time_to_pd = np.where(ever_progressed, first_pd + 1, np.nan)
+
+    return response, best_response, time_to_pd
+
+
+def simulate_longitudinal_chunk(num_sim_patients: int,
+                                base_radiomic_data: pd.DataFrame | SharedTable,
+                                lesion_selection_rng: np.random.Generator,
+                                num_timepoints: int = 10,
+                                step_std_dev: float = 0.1,
+                                expected_num_lesions: int = 10,
+                                max_num_lesions: int = 30,
+                                location_label: str = "LABEL",
+                                first_patient_id: int = 0,
+                                max_targets: int = 10
+                                ) -> pd.DataFrame:
+    """Simulate diameter trajectories over num_timepoints follow-up scans for a chunk of synthetic patients and assess their longitudinal response.
+
+    Each lesion's baseline diameter is drawn from the base radiomic data like generate_synthetic_lesion_batch. Its diameter at each
+    follow-up is the previous diameter times 1 plus a change drawn from a normal distribution with mean 0 and step_std_dev, truncated
+    to -1 to 3, so the trajectories of every lesion form one (lesions, timepoints) float32 array. The SLD series for all lesions and for
+    1 to max_targets target lesions (no more than 2 per location, nested like target_sum_sweep) are summed in one pass.
+
+    Returns
+    -------
+    pd.DataFrame
+        Sorted patient IDs, the number of lesions, the SLD of all lesions at each timepoint ("sld_t0" is baseline) and the best overall
+        response ("BOR") and time to PD ("TTP", in follow-up timepoints, NaN without PD) using all lesions and k target lesions.
+    """
+    base_radiomic_data = table_frame(base_radiomic_data)
+    lesion_counts = draw_lesion_counts(num_sim_patients=num_sim_patients,
+                                       lesion_selection_rng=lesion_selection_rng,
+                                       expected_num_lesions=expected_num_lesions,
+                                       max_num_lesions=max_num_lesions)
+    num_lesions = int(np.sum(lesion_counts))
+    patient_codes = np.repeat(np.arange(num_sim_patients), lesion_counts)
+
+    base_rows = lesion_selection_rng.integers(0, len(base_radiomic_data), size=num_lesions)
+    location_codes = pd.factorize(base_radiomic_data[location_label].to_numpy())[0][base_rows]
+
+    step_change_sampler = TruncatedNormalSampler(mean=0, std_dev=step_std_dev, low_end=-1, high_end=3)
+    step_change = step_change_sampler.sample(lesion_selection_rng, (num_lesions, num_timepoints)).astype(np.float32)
+
+    # Diameter trajectories of shape (lesions, baseline + follow-up timepoints)
+    diameters = np.empty((num_lesions, num_timepoints + 1), dtype=np.float32)
+    diameters[:, 0] = base_radiomic_data['original_shape_Maximum2DDiameterSlice'].to_numpy()[base_rows]
+    diameters[:, 1:] = diameters[:, :1] * np.cumprod(1 + step_change, axis=1)
+
+    # SLD series of shape (patients, all lesions + 1 to max_targets targets, timepoints)
+    sld_series = np.empty((num_sim_patients, max_targets + 1, num_timepoints + 1), dtype=np.float32)
+    # Lesions are grouped by patient and every patient has at least one lesion, so each patient's rows start at patient_starts
+    patient_starts = np.cumsum(lesion_counts) - lesion_counts
+    sld_series[:, 0] = np.add.reduceat(diameters, patient_starts, axis=0, dtype=np.float64)
+    sld_series[:, 1:] = target_sum_sweep(patient_codes=patient_codes,
+                                         location_codes=location_codes,
+                                         values=diameters,
+                                         num_patients=num_sim_patients,
+                                         lesion_selection_rng=lesion_selection_rng,
+                                         max_targets=max_targets)
+
+    _, best_response, time_to_pd = longitudinal_response(sld_series)
+    best_response = recist_labels(best_response)
+
+    response = {'patient_id': np.arange(first_patient_id, first_patient_id + num_sim_patients),
+                'num_lesions': lesion_counts,
+                **{f"sld_t{timepoint}": sld_series[:, 0, timepoint] for timepoint in range(num_timepoints + 1)},
+                'BOR (all)': best_response[:, 0],
+                'TTP (all)': time_to_pd[:, 0]}
+    for num_targets in range(1, max_targets + 1):
+        response[f"BOR ({num_targets} targets)"] = best_response[:, num_targets]
+        response[f"TTP ({num_targets} targets)"] = time_to_pd[:, num_targets]
+
+    return pd.DataFrame(response)
+
+
+def simulate_longitudinal(num_sim_patients: int,
+                          base_radiomic_data: pd.DataFrame,
+                          lesion_selection_rng: np.random.Generator,
+                          location_label: str = "LABEL",
+                          n_jobs: int = 1,
+                          chunk_size: int = DEFAULT_CHUNK_SIZE,
+                          **chunk_options: object
+                          ) -> pd.DataFrame:
+    """Simulate and assess num_sim_patients longitudinally in chunks of chunk_size, see simulate_longitudinal_chunk.
+
+    Only one chunk of lesion trajectories is held in memory per worker, so peak memory is bounded by chunk_size and the number
+    of timepoints rather than the number of patients. Each chunk draws from its own random stream spawned from lesion_selection_rng,
+    so the results for a given seed and chunk_size do not depend on n_jobs.
+    """
+    bounds = chunk_bounds(num_sim_patients, chunk_size)
+    chunk_rngs = spawn_chunk_rngs(lesion_selection_rng, len(bounds))
+    # Published once for the workers rather than pickled into every chunk
+    base_columns = share_with_workers(select_base_columns(base_radiomic_data, location_label=location_label),
+                                      n_jobs=n_jobs,
+                                      num_chunks=len(bounds))
+
+    chunks = map_chunks(simulate_longitudinal_chunk,
+                        [{'num_sim_patients': stop - start,
+                          'base_radiomic_data': base_columns,
+                          'lesion_selection_rng': chunk_rng,
+                          'location_label': location_label,
+                          'first_patient_id': start,
+                          **chunk_options}
+                         for (start, stop), chunk_rng in zip(bounds, chunk_rngs, strict=True)],
+                        n_jobs=n_jobs)
+    return pd.concat(chunks, ignore_index=True)
+
+
+@click.command()
+@click.argument('radiomic_features_filepath', type=click.Path(exists=True))
+@click.option('--num_sim_patients', type=click.INT, default=100, help="Number of patients to generate simulations for.")
+@click.option('--num_timepoints', type=click.IntRange(min=1), default=10, help="Number of follow-up scans to simulate after baseline.")
+@click.option('--step_std_dev', type=click.FloatRange(min=0, min_open=True), default=0.1, help="Standard deviation of the fractional diameter change between scans.")
+@click.option('--expected_num_lesions', type=click.IntRange(1, 30), default=10, help="Expected number of lesions per patient. Must be between 1 and 30.")
+@click.option('--location_label', type=click.STRING, default='LABEL', help="Location column label in the radiomic feature data.")
+@click.option('--save_out', type=click.BOOL, default=True, help='Whether to save out the patient response data, metrics and plots.')
+@click.option('--random_seed', type=click.INT, default=None, help="Random seed to use for reproducible results.")
+@click.option('--n_jobs', type=click.INT, default=1, help="Number of worker processes to use. -1 uses all available cores.")
+@click.option('--chunk_size', type=click.IntRange(min=1), default=DEFAULT_CHUNK_SIZE, help="Number of patients per chunk of work.")
+@click.option('--output_format', type=click.Choice(list(OUTPUT_FORMATS)), default='csv', help="File format to save the patient response data in.")
+def longitudinal(radiomic_features_filepath: str,
+                 num_sim_patients: int = 100,
+                 num_timepoints: int = 10,
+                 step_std_dev: float = 0.1,
+                 expected_num_lesions: int = 10,
+                 location_label: str = "LABEL",
+                 save_out: bool = True,
+                 random_seed: int | None = None,
+                 n_jobs: int = 1,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 output_format: str = 'csv'
+                 ) -> pd.DataFrame:
+    """Retiring the Ruler longitudinal simulation
+
+       Simulate lesion diameters over several follow-up scans and assess best overall response and time to progression against the nadir.
+
+    Parameters
+    ----------
+    radiomic_features_filepath: str
+        Real radiomic feature data with diameter data to draw baseline lesions from.
+    num_sim_patients: int = 100
+        Number of patients to generate simulations for.
+    num_timepoints: int = 10
+        Number of follow-up scans to simulate after baseline.
+    step_std_dev: float = 0.1
+        Standard deviation of the fractional diameter change of each lesion between consecutive scans.
+    expected_num_lesions: int = 10
+        Expected number of lesions per patient. Used to set up a Poisson distribution to select from.
+    location_label: str = "LABEL"
+        Label in the radiomic feature data identifying where the ground truth tumor is located.
+    save_out: bool = True
+        Whether to save out the patient response data, the best overall response metrics and plots.
+    random_seed: int | None = None
+        Random seed to use for reproducible results.
+    n_jobs: int = 1
+        Number of worker processes to use. -1 uses all available cores.
+    chunk_size: int = 10000
+        Number of patients per chunk of work. Peak memory per worker is bounded by chunk_size and num_timepoints.
+    output_format: str = 'csv'
+        File format to save the patient response data in, see output.TableWriter.
+
+    Returns
+    -------
+    pd.DataFrame
+        Response data for each synthetic patient, see simulate_longitudinal_chunk. The accuracy and PD sensitivity of the best
+        overall response with 1 to 10 target lesions, compared to using all lesions, are saved to data/procdata and plotted to data/results,
+        along with the per category metrics of their confusion matrices, see recist.confusion_metrics_table.
+    """
+    dataset_name = Path(radiomic_features_filepath).parent.stem
+
+    logging.basicConfig(filename=dirs.LOGS / f'longitudinal_{dataset_name}.log', level=logging.INFO, format='%(asctime)s %(message)s')
+    logger.info(f'Retiring the Ruler longitudinal simulation started for {dataset_name}')
+
+    rad_data = load_radiomic_data(radiomic_features_filepath,
+                                  location_label=location_label,
+                                  cache_dir=dirs.PROCDATA / "radiomic_cache")
+
+    synth_response = simulate_longitudinal(num_sim_patients=num_sim_patients,
+                                           base_radiomic_data=rad_data,
+                                           lesion_selection_rng=np.random.default_rng(random_seed),
+                                           location_label=location_label,
+                                           n_jobs=n_jobs,
+                                           chunk_size=chunk_size,
+                                           num_timepoints=num_timepoints,
+                                           step_std_dev=step_std_dev,
+                                           expected_num_lesions=expected_num_lesions)
+    logger.info('Finished longitudinal simulation.')
+
+    # Agreement of the best overall response using k target lesions with that using all lesions
+    accumulator = MetricAccumulator(max_targets=11, criterion='BOR')
+    accumulator.update(synth_response)
+    bor_accuracy, bor_pd_sensitivity = accumulator.metrics()
+
+    if save_out:
+        sim_name = f"long_{num_sim_patients}_pats_{num_timepoints}_tps"
+        out_path = dirs.PROCDATA / dataset_name / sim_name
+        out_path.mkdir(parents=True, exist_ok=True)
+        write_table(synth_response, out_path / f"{dataset_name}_longitudinal_response", output_format=output_format)
+        pd.DataFrame({'num_targets': range(1, len(bor_accuracy) + 1),
+                      'accuracy': bor_accuracy,
+                      'pd_sensitivity': bor_pd_sensitivity}).to_csv(out_path / f"{dataset_name}_bor_metrics.csv", index=False)
+        accumulator.confusion_metrics().to_csv(out_path / f"{dataset_name}_bor_confusion_metrics.csv", index=False)
+        # Plotting libraries are only imported when saving
+        from plot import plot_acc_and_sens
+
+        plot_acc_and_sens(bor_accuracy, bor_pd_sensitivity, dirs.RESULTS / dataset_name / sim_name)
+        logger.info(f'Saved longitudinal results to {out_path}.')
+
+    return synth_response
+
+
+if __name__ == '__main__':
+    longitudinal()
@@ -0,0 +1,161 @@
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import feather, ipc
+
+# File extension for each supported output format
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+# Compression codec used for Parquet output. Feather output is left uncompressed so it can be memory-mapped.
+PARQUET_COMPRESSION = 'zstd'
+
+
+class TableWriter:
+    """Appending writer for synthetic lesion or patient response tables that arrive in chunks sorted by patient ID.
+
+    Writes a single file at output_path (with the extension for output_format added), or if partition_size is given, a directory at
+    output_path holding one file per range of partition_size patient IDs so later analysis can read one slice at a time.
+    CSV output continues the row index across chunks like DataFrame.to_csv, Parquet and Feather output do not store the index.
+    """
+
+    def __init__(self,
+                 output_path: Path,
+                 output_format: str = 'csv',
+                 partition_size: int | None = None
+                 ) -> None:
+        if output_format not in OUTPUT_FORMATS:
+            message = f"{output_format} is not a supported output format, must be one of {list(OUTPUT_FORMATS)}."
+            raise ValueError(message)
+
+        self.output_path = Path(output_path)
+        self.output_format = output_format
+        self.partition_size = partition_size
+        self.num_rows = 0
+        self.schema = None
+        self._partition = None
+        self._file_writer = None
+        self._filepath = None
+        self._partition_rows = 0
+
+        if partition_size:
+            self.output_path.mkdir(parents=True, exist_ok=True)
+        else:
+            self.output_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def partition_filepath(self, partition: int | None) -> Path:
+        """Return the file to write to for a partition number, or the single output file if partition is None."""
+        extension = OUTPUT_FORMATS[self.output_format]
+        if partition is None:
+            return self.output_path.with_name(self.output_path.name + extension)
+
+        first_patient = partition * self.partition_size
+        last_patient = first_patient + self.partition_size - 1
+        return self.output_path / f"patients_{first_patient:09d}-{last_patient:09d}{extension}"
+
+    def write(self, data: pd.DataFrame) -> None:
+        """Append a chunk of rows, which must have a patient_id column sorted in ascending order."""
+        if not self.partition_size:
+            self._write_partition(data, partition=None)
+            return
+
+        partitions = data['patient_id'].to_numpy() // self.partition_size
+        for partition in pd.unique(partitions):
+            self._write_partition(data[partitions == partition], partition=int(partition))
+
+    def _write_partition(self,
+                         data: pd.DataFrame,
+                         partition: int | None
+                         ) -> None:
+        # Chunks arrive in patient order, so a new partition means the previous one is finished
+        if self._filepath is None or partition != self._partition:
+            self._close_file()
+            self._partition = partition
+            self._filepath = self.partition_filepath(partition)
+            self._partition_rows = 0
+
+        if self.output_format == 'csv':
+            data = data.set_axis(pd.RangeIndex(self.num_rows, self.num_rows + len(data)))
+            first_rows = self._partition_rows == 0
+            data.to_csv(self._filepath, mode='w' if first_rows else 'a', header=first_rows, index_label="index")
+        else:
+            table = pa.Table.from_pandas(data, schema=self.schema, preserve_index=False)
+            if self.schema is None:
+                self.schema = table.schema
+            if self._file_writer is None:
+                if self.output_format == 'parquet':
+                    self._file_writer = pq.ParquetWriter(self._filepath, self.schema, compression=PARQUET_COMPRESSION)
+                else:
+                    self._file_writer = ipc.new_file(self._filepath, self.schema)
+            self._file_writer.write_table(table)
+
+        self.num_rows += len(data)
+        self._partition_rows += len(data)
+
+    def _close_file(self) -> None:
+        if self._file_writer is not None:
+            self._file_writer.close()
+            self._file_writer = None
+
+    def close(self) -> None:
+        """Finish writing the open file."""
+        self._close_file()
+
+    def __enter__(self) -> 'TableWriter':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+
+def write_table(data: pd.DataFrame,
+                output_path: Path,
+                output_format: str = 'csv',
+                partition_size: int | None = None
+                ) -> None:
+    """Write a full synthetic lesion or patient response table in one go, see TableWriter."""
+    with TableWriter(output_path, output_format=output_format, partition_size=partition_size) as writer:
+        writer.write(data)
+
+
+def read_table(filepath: Path,
+               first_patient: int | None = None,
+               last_patient: int | None = None,
+               columns: list[str] | None = None
+               ) -> pd.DataFrame:
+    """Read a table written by TableWriter, optionally only the rows for patient IDs first_patient to last_patient (inclusive).
+
+    For partitioned output only the partition files overlapping the requested patient range are read, and Feather files are memory-mapped.
+    """
+    filepath = Path(filepath)
+    if filepath.is_dir():
+        filepaths = []
+        for partition_filepath in sorted(filepath.glob('patients_*')):
+            partition_first, partition_last = (int(patient) for patient in partition_filepath.stem.removeprefix('patients_').split('-'))
+            if (last_patient is None or partition_first <= last_patient) and (first_patient is None or partition_last >= first_patient):
+                filepaths.append(partition_filepath)
+    else:
+        filepaths = [filepath]
+
+    if not filepaths:
+        message = f"No output files found at {filepath} for the requested patients."
+        raise FileNotFoundError(message)
+
+    read_columns = None if columns is None else list(dict.fromkeys(['patient_id', *columns]))
+    tables = []
+    for partition_filepath in filepaths:
+        if partition_filepath.suffix == '.csv':
+            tables.append(pd.read_csv(partition_filepath, index_col="index", usecols=None if read_columns is None else ['index', *read_columns]))
+        elif partition_filepath.suffix == '.parquet':
+            tables.append(pd.read_parquet(partition_filepath, columns=read_columns))
+        else:
+            tables.append(feather.read_table(partition_filepath, columns=read_columns, memory_map=True).to_pandas())
+
+    # Only CSV output stores the row index
+    data = pd.concat(tables, ignore_index=filepaths[0].suffix != '.csv')
+    if first_patient is not None:
+        data = data[data['patient_id'] >= first_patient]
+    if last_patient is not None:
+        data = data[data['patient_id'] <= last_patient]
+    return data if columns is None else data[columns]
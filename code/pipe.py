@@ -3,18 +3,14 @@ import logging
 from pathlib import Path
 
 import click
-import numpy as np
 import pandas as pd
+from chunking import DEFAULT_CHUNK_SIZE
+from criteria import RESPONSE_CRITERIA
 from damply import dirs
-from plot import (
-    plot_acc_and_sens,
-    plot_pd_sensitivity,
-    plot_recist_accuracy,
-    plot_vol_vs_diameter,
-)
-from recist import recist_assess, recist_metrics_by_target_count, select_target_lesions
-from synthetic_gen import generate_synthetic_patients
-from tqdm import tqdm
+from output import OUTPUT_FORMATS, TableWriter
+from profiling import PROFILE_MODES, RunProfile, start_profiler, stop_profiler
+from samplers import parse_site_mix
+from simulation import Simulation, validate_run_options
 
 logger = logging.getLogger(__name__)
 
@@ -24,20 +20,55 @@ logger = logging.getLogger(__name__)
 @click.option('--num_sim_patients', type=click.INT, default=100, help="Number of patients to generate simulations for.")
 @click.option('--expected_num_lesions', type=click.IntRange(1, 30), default=10, help="Expected number of lesions per patient. Must be between 1 and 30.")
 @click.option('--location_label', type=click.STRING, default='LABEL', help="Location column label in the radiomic feature data.")
+@click.option('--site_mix', type=click.STRING, default=None, help='Share of lesions at each location, such as "liver=0.4,lung=0.1". Other locations share the rest.')
 @click.option('--save_out', type=click.BOOL, default=True, help='Whether to save out the simulated lesion data and plots for analysis.')
 @click.option('--random_seed', type=click.INT, default=None, help="Random seed to use for reproducible results. Used to initialize the random number generators.")
 @click.option('--parallel', type=click.BOOL, default=False, help="Whether to run generation in parallel.")
+@click.option('--batch', type=click.BOOL, default=False, help="Whether to generate and assess synthetic patients in vectorized chunks.")
+@click.option('--n_jobs', type=click.INT, default=-1, help="Number of worker processes to use when running in parallel. -1 uses all available cores.")
+@click.option('--replicates', type=click.IntRange(min=1), default=1, help="Number of independent cohorts of num_sim_patients to simulate for confidence intervals on the metrics.")
+@click.option('--stream', type=click.BOOL, default=False, help="Whether to generate and assess patients one chunk at a time without keeping them in memory.")
+@click.option('--tolerance', type=click.FloatRange(min=0, min_open=True), default=None, help="If given, stream chunks until every accuracy and PD sensitivity confidence interval is within this many percentage points, with num_sim_patients as the budget.")
+@click.option('--output_format', type=click.Choice(list(OUTPUT_FORMATS)), default='csv', help="File format to save the synthetic lesion and response data in.")
+@click.option('--partition_size', type=click.IntRange(min=1), default=None, help="If given, save the synthetic data as one file per range of this many patient IDs.")
+@click.option('--cache_ingest', type=click.BOOL, default=True, help="Whether to cache the prepared radiomic data in data/procdata for faster repeat runs.")
+@click.option('--chunk_size', type=click.IntRange(min=1), default=DEFAULT_CHUNK_SIZE, help="Number of patients per chunk of work for batch and parallel runs.")
+@click.option('--criteria', type=click.Choice(list(RESPONSE_CRITERIA)), multiple=True, default=['RECIST'], help="Response criteria to assess alongside RECIST. Can be given more than once.")
+@click.option('--checkpoint', type=click.BOOL, default=False, help="Whether to save each finished chunk to data/procdata so an interrupted run can be resumed.")
+@click.option('--resume', type=click.BOOL, default=False, help="Whether to resume an interrupted checkpointed run with the same options, skipping its finished chunks.")
+@click.option('--estimator', type=click.Choice(['sampled', 'expected']), default='sampled', help="Whether the RECIST metrics use each patient's one sampled target subset or average over every target subset.")
+@click.option('--profile', type=click.Choice(PROFILE_MODES), default='none', help="Profiler to run over the whole pipeline, writing its report next to the outputs.")
+# The plot.PLOT_MODES keys, listed here so plot is only imported when saving
+@click.option('--plot_mode', type=click.Choice(['auto', 'scatter', 'density']), default='auto', help="Whether to plot lesion volumes as scatters or binned density. auto uses density for large cohorts.")
 def pipe(radiomic_features_filepath: str,
          num_sim_patients: int = 100,
          expected_num_lesions: int = 10,
          location_label: str = "LABEL",
+         site_mix: str | None = None,
          save_out: bool = True,
          random_seed: int | None = None,
-         parallel: bool = False
+         parallel: bool = False,
+         batch: bool = False,
+         n_jobs: int = -1,
+         chunk_size: int = DEFAULT_CHUNK_SIZE,
+         replicates: int = 1,
+         stream: bool = False,
+         tolerance: float | None = None,
+         output_format: str = 'csv',
+         partition_size: int | None = None,
+         cache_ingest: bool = True,
+         criteria: tuple[str, ...] = ('RECIST',),
+         checkpoint: bool = False,
+         resume: bool = False,
+         estimator: str = 'sampled',
+         profile: str = 'none',
+         plot_mode: str = 'auto'
          ) -> tuple[pd.DataFrame, pd.DataFrame]:
     """Retiring the Ruler Simulation pipeline
     
        Generate synthetic lesion data with pre- and post-treatment diameters and volumes to perform RECIST assessment.
+       Runs one simulation.Simulation and saves its outputs. To run many simulations from the same dataset, use a Simulation
+       directly, which prepares the radiomic data and starts its worker pool once.
 
     Parameters
     ----------
@@ -49,88 +80,152 @@ def pipe(radiomic_features_filepath: str,
         Expected number of lesions per patient. Used to set up a Poisson distribution to select from.
     location_label: str = "LABEL"
         Label in the radiomic feature data identifying where the ground truth tumor is located.
+    site_mix: str | None = None
+        Share of the synthetic lesions to draw from each location, as comma separated location=share pairs such as
+        "liver=0.4,lung=0.1". Locations left out share the rest in proportion to their number of lesions in the radiomic data.
+        If every location is given, the shares are relative weights. If None, lesions are drawn uniformly from the radiomic data.
     save_out: bool = True
         Whether to save out the simulated lesion data and plots for analysis.
     random_seed: int | None = None
         Random seed to use for reproducible results. Used to initialize the random number generators.
     parallel: bool = False
-        Whether to run the generation in parallel.
+        Whether to run the generation in parallel. Uses the same chunks as batch mode, spread across n_jobs worker processes.
+    batch: bool = False
+        Whether to generate and assess synthetic patients in vectorized chunks instead of one patient at a time.
+    n_jobs: int = -1
+        Number of worker processes to use when running in parallel. -1 uses all available cores.
+    chunk_size: int = 10000
+        Number of patients per chunk of work for batch and parallel runs. Each chunk gets its own random stream, so results
+        for a given random seed and chunk size are the same for any number of workers.
+    replicates: int = 1
+        Number of independent cohorts of num_sim_patients to simulate. If more than 1, all cohorts are simulated together and
+        the mean, standard error and 95% percentile confidence interval of the metrics are calculated over the cohorts.
+    stream: bool = False
+        Whether to generate and assess patients one chunk of chunk_size at a time, updating running metric counts and dropping each
+        chunk so peak memory is bounded by the chunk size. If save_out is True, each chunk is appended to the output CSVs.
+        Uses the same chunks as batch mode, so the metrics match a batch run with the same random seed and chunk size.
+    tolerance: float | None = None
+        If given, run adaptively: patients are streamed one chunk at a time until the half-width of the 95% Wilson confidence interval
+        of every RECIST accuracy and PD sensitivity point is at most tolerance percentage points, or num_sim_patients, the patient
+        budget, have been simulated. Implies stream, so smaller chunk_size values check more often. The patients each point needed
+        are logged and saved to a convergence CSV. Cannot be used with replicates, as the intervals come from the pooled counts.
+    output_format: str = 'csv'
+        File format to save the synthetic lesion and response data in, one of 'csv', 'parquet' (zstd compressed) or 'feather'
+        (Arrow IPC, uncompressed so it can be memory-mapped).
+    partition_size: int | None = None
+        If given, the synthetic lesion and response data are each saved as a directory with one file per range of partition_size
+        patient IDs, so a slice of patients can be read without loading the full table. See output.read_table.
+    cache_ingest: bool = True
+        Whether to cache the prepared radiomic data in data/procdata/radiomic_cache, keyed on the content hash of the radiomic
+        features file, so repeat runs on the same dataset skip reading the CSV.
+    criteria: tuple[str, ...] = ('RECIST',)
+        Response criteria to assess, see criteria.RESPONSE_CRITERIA. RECIST is always assessed. Every criterion is assessed in the same
+        pass with the same target lesions, adding its sums, percent change and response columns to the patient response data.
+        If more than one criterion is assessed, the accuracy and PD sensitivity of each are saved to a criteria_metrics CSV. The
+        confusion matrices of every criterion's category using k targets against using all lesions, for each number of lesions,
+        and the kappa, misclassification direction and per category sensitivity and specificity derived from them are saved to
+        confusion_matrices and confusion_metrics CSVs.
+    checkpoint: bool = False
+        Whether to durably save each finished chunk of generation and assessment, with the run config and the random seed entropy,
+        to a checkpoint directory in data/procdata. Checkpointed runs are always chunked like batch runs, and the checkpoint is
+        deleted once the outputs are saved.
+    resume: bool = False
+        Whether to resume the checkpointed run with the same options and code version, loading its finished chunks and simulating
+        the rest with the same random streams, so the results match an uninterrupted run. Implies checkpoint. If there is no
+        checkpoint to resume, the run starts from the beginning.
+    estimator: str = 'sampled'
+        How RECIST accuracy and PD sensitivity are estimated. 'sampled' compares each patient's response using one random target
+        subset per target count. 'expected' uses each patient's probability of misclassification and of PD over all target subsets,
+        enumerated exactly for patients with few lesions and averaged over many random subsets otherwise, which gives the same
+        precision with far fewer simulated patients. The probabilities are saved to a misclassification_probability table.
+        Needs the lesion data in memory, so cannot be used with stream.
+    profile: str = 'none'
+        Profiler to run over the whole pipeline. 'cprofile' saves cProfile stats and a cumulative time summary, 'tracemalloc' saves
+        the source lines holding the most memory and adds the peak traced memory of each stage to the run profile.
+        The run profile itself, with the wall time, CPU time, peak RSS and rows processed of each stage, is saved to
+        data/procdata as JSON and CSV whenever save_out is True or a profiler is used.
+    plot_mode: str = 'auto'
+        How to plot lesion volume against diameter. 'scatter' draws one point per lesion, 'density' draws a binned 2D histogram
+        whose drawing time does not grow with the cohort, and 'auto' uses density for more than plot.DENSITY_MIN_POINTS lesions.
         
     Returns
     -------
     synth_lesions: pd.DataFrame
         Measurment data for each synthetic lesion, including diameters, volumes, and location.
-        If save_out is set to True, will be saved out to the data/procdata directory. 
+        If replicates is more than 1, a replicate column identifies the cohort of each lesion.
+        If save_out is set to True, will be saved out to the data/procdata directory. None if stream is True.
     synth_response: pd.DataFrame
         Response data for each synthetic patient, including sum of longest diameters (SLD) and RECIST response classification with different numbers of target lesions.
-        If save_out is set to True, will be saved out to the data/procdata directory.
+        If save_out is set to True, will be saved out to the data/procdata directory. None if stream is True.
     """
     dataset_name = Path(radiomic_features_filepath).parent.stem
+    site_mix = parse_site_mix(site_mix) if site_mix else None
+    if stream or tolerance is not None:
+        mode = 'stream'
+    elif batch or parallel or checkpoint or resume:
+        mode = 'batch'
+    else:
+        mode = 'legacy'
+    try:
+        validate_run_options(mode=mode, replicates=replicates, estimator=estimator, tolerance=tolerance)
+    except ValueError as error:
+        raise click.UsageError(str(error)) from error
 
     logging.basicConfig(filename=dirs.LOGS /f'pipe_{dataset_name}.log', level=logging.INFO, format='%(asctime)s %(message)s')
     logger.info('\n')
     logger.info(f'Retiring the Ruler pipeline started for {dataset_name}')
 
-    # Load radiomics data
-    rad_data = pd.read_csv(radiomic_features_filepath)
-
-    # Extract the slice thickness from the radiomics data
-    rad_data['slice_thickness'] = [float(i.split(', ')[-1].strip('()')) for i in rad_data['diagnostics_Image-interpolated_Spacing']]
-
-    # Calculate the true volume of the segmentation
-    rad_data['volume_cc_contoured'] = rad_data['original_shape_VoxelVolume'] * rad_data['slice_thickness'] / 1000
-
-    lesion_selection_rng = np.random.default_rng(random_seed)
-
-    logger.info('Starting synthetic lesion generation.')
-    # Generate lesion measurements for N synthetic patients with 1 to M synthetic lesions based on real lesion data
-    synth_lesions = generate_synthetic_patients(num_sim_patients=num_sim_patients,
-                                                base_radiomic_data=rad_data,
-                                                expected_num_lesions=expected_num_lesions,
-                                                location_label=location_label,
-                                                lesion_selection_rng=lesion_selection_rng,
-                                                random_seed=random_seed,
-                                                parallel=parallel)
-    logger.info('Synthetic lesion generation finished.')
-    logger.info('Performing RECIST assessment of synthetic lesions.')
-    # Assess the RECIST response category of each synthetic patient using all lesions
-    synth_response = recist_assess(synth_lesions, parallel=parallel)
-
-    # Reassess RECIST iteratively using 1-10 target lesions per patient (max 2 per location)
-    for num_targets in tqdm(range(1, 11), desc="RECIST assessment for different target counts"):
-        target_lesions = select_target_lesions(num_lesions=num_targets,
-                                               lesion_data=synth_lesions,
-                                               lesion_selection_rng=lesion_selection_rng,
-                                               parallel=parallel
-                                               )
-        # Reassess RECIST categorization with subset of lesions
-        select_target_response = recist_assess(target_lesions, parallel=parallel)
-        # Add RECIST category for this number of target lesions
-        synth_response[f"RECIST ({num_targets} targets)"] = select_target_response['RECIST (all)']
-
-    logger.info('Finished RECIST assessments.')
-    logger.info('Calculating accuracy and PD sensitivity.')
-    # Calculate the classification accuracy for RECIST as a function of the number of target lesions
-    recist_accuracy, pd_sensitivity = recist_metrics_by_target_count(patient_response=synth_response,
-                                                                     max_targets=11)
-    
-
+    sim_name = f"sim_{num_sim_patients}_pats" if replicates == 1 else f"sim_{num_sim_patients}_pats_{replicates}_reps"
+    out_path = dirs.PROCDATA / dataset_name / sim_name
+    plot_path = dirs.RESULTS / dataset_name / sim_name
+
+    run_profile = RunProfile()
+    profiler = start_profiler(profile)
+
+    # Streamed chunks are appended to the outputs as they finish, file extensions are added by the writers
+    lesion_writer = response_writer = None
+    if save_out and mode == 'stream':
+        lesion_writer = TableWriter(out_path / f"{dataset_name}_synthetic_lesions", output_format=output_format, partition_size=partition_size)
+        response_writer = TableWriter(out_path / f"{dataset_name}_synthetic_patient_response", output_format=output_format, partition_size=partition_size)
+
+    try:
+        with Simulation(radiomic_features_filepath,
+                        location_label=location_label,
+                        n_jobs=n_jobs if parallel else 1,
+                        cache_dir=dirs.PROCDATA / "radiomic_cache" if cache_ingest else None,
+                        profile=run_profile) as simulation:
+            result = simulation.run(num_patients=num_sim_patients,
+                                    expected_num_lesions=expected_num_lesions,
+                                    seed=random_seed,
+                                    replicates=replicates,
+                                    mode=mode,
+                                    criteria=criteria,
+                                    site_mix=site_mix,
+                                    chunk_size=chunk_size,
+                                    estimator=estimator,
+                                    tolerance=tolerance,
+                                    lesion_writer=lesion_writer,
+                                    response_writer=response_writer,
+                                    checkpoint_dir=out_path / "checkpoint" if checkpoint or resume else None,
+                                    resume=resume,
+                                    profile=run_profile)
+    finally:
+        # Close the streamed outputs even if the run fails, so the chunks written so far are readable
+        for writer in (lesion_writer, response_writer):
+            if writer is not None:
+                writer.close()
     if save_out:
-        logger.info('Saving out the synthetic lesion and response data.')
-        out_path = dirs.PROCDATA / dataset_name / f"sim_{num_sim_patients}_pats"
-        out_path.mkdir(parents=True, exist_ok=True)
-
-        synth_lesions.to_csv(out_path / f"{dataset_name}_synthetic_lesions.csv", index_label="index")
-        synth_response.to_csv(out_path / f"{dataset_name}_synthetic_patient_response.csv", index_label="index")
-
-        logger.info('Plotting analysis results.')
-        plot_path = dirs.RESULTS / dataset_name / f"sim_{num_sim_patients}_pats"
-        plot_recist_accuracy(recist_accuracy, plot_path)
-        plot_pd_sensitivity(pd_sensitivity, plot_path)
-        plot_acc_and_sens(recist_accuracy, pd_sensitivity, plot_path)
-        plot_vol_vs_diameter(synth_lesions, plot_path)
+        result.save(out_path, output_format=output_format, partition_size=partition_size)
+        result.plot(plot_path, plot_mode=plot_mode, n_jobs=n_jobs)
+    else:
+        result.remove_checkpoint()
+
+    stop_profiler(profile, profiler, out_path / dataset_name)
+    if save_out or profile != 'none':
+        run_profile.save(out_path / f"{dataset_name}_run_profile")
+        logger.info(f'Saved the run profile to {out_path}.')
     
-    return synth_lesions, synth_response
+    return result.synth_lesions, result.synth_response
 
 
 if __name__ == '__main__':
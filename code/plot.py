@@ -1,11 +1,31 @@
+from collections.abc import Callable
 from pathlib import Path
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import seaborn as sns
+from joblib import Parallel, delayed
+from lesion_store import LesionStore
+from matplotlib.colors import LogNorm
 from matplotlib.figure import Figure
 
+# Figures are made with matplotlib.figure.Figure rather than pyplot, so they are rendered with the non-interactive Agg canvas
+# whatever the pyplot backend is, are never held open by pyplot, and independent figures can be rendered in separate workers.
+
+# Point clouds with more points than this are drawn as a binned 2D histogram rather than one scatter point each
+DENSITY_MIN_POINTS = 50_000
+
+# Plot modes for point clouds, mapped to the density argument of plot_vol_vs_diameter. auto uses density plots for large cohorts.
+PLOT_MODES = {'auto': None, 'scatter': False, 'density': True}
+
+# Number of bins along each axis of the density plots
+DENSITY_BINS = 200
+
+# Axis limits of the volume vs. diameter plots, also the ranges binned in density mode
+DIAMETER_LIMITS = (0, 20)
+VOLUME_LIMITS = (0, 2000)
+VOLUME_VARIATION_LIMITS = (-1000, 1000)
+
 
 def save_plot(figure: Figure,
               filepath:Path
@@ -18,17 +38,51 @@ def save_plot(figure: Figure,
                    )
 
 
+def render_plots(plots: list[tuple[Callable, dict]],
+                 n_jobs: int = -1
+                 ) -> None:
+    """Render and save independent figures concurrently, calling each plot function with its keyword arguments.
+
+    Each plot function must save its own figures, for example by being given a save_path, and is run in a worker thread. As the
+    figures are not made through pyplot they do not share any state, and the threads avoid importing matplotlib in new processes.
+    The figures are dropped once saved rather than returned.
+    """
+    Parallel(n_jobs=n_jobs, prefer='threads')(delayed(render_plot)(plot_func, kwargs) for plot_func, kwargs in plots)
+
+
+def render_plot(plot_func: Callable, kwargs: dict) -> None:
+    """Call plot_func with kwargs, dropping the figures it returns."""
+    plot_func(**kwargs)
+
+
+def interval_to_yerr(values: np.ndarray,
+                     interval: tuple[list, list]
+                     ) -> np.ndarray:
+    """Convert (lower, upper) interval bounds around values into the distances below and above each value used by plt.errorbar."""
+    lower, upper = np.minimum(*interval), np.maximum(*interval)
+    # Clip in case the mean falls outside of a percentile interval
+    return np.clip([values - lower, upper - values], 0, None)
+
+
 def plot_recist_accuracy(recist_accuracy:list,
-                         save_path: Path | None = None
+                         save_path: Path | None = None,
+                         accuracy_interval: tuple[list, list] | None = None
                          ) -> Figure:
-    """Plot RECIST response categorization accuracy values as a scatter plot with a red line at 5 lesions (RECIST 1.1 standard)."""
-    fig = plt.figure(figsize=(8, 6))
-    plt.axvline(5, color='red', linestyle='--', label='RECIST v1.1')
-    plt.scatter(range(1, 11), 1 - np.array(recist_accuracy) / 100, marker='o', s=75, label = 'Observation')
-    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
-    sns.despine()
-    plt.xlabel('Target Lesions')
-    plt.ylabel('Misclassified Patients')
+    """Plot RECIST response categorization accuracy values as a scatter plot with a red line at 5 lesions (RECIST 1.1 standard).
+    
+       If accuracy_interval is given as (lower, upper) accuracy bounds, they are drawn as error bars.
+       """
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
+    ax.axvline(5, color='red', linestyle='--', label='RECIST v1.1')
+    misclassified = 1 - np.array(recist_accuracy) / 100
+    ax.scatter(range(1, 11), misclassified, marker='o', s=75, label = 'Observation')
+    if accuracy_interval is not None:
+        ax.errorbar(range(1, 11), misclassified, yerr=interval_to_yerr(misclassified, 1 - np.array(accuracy_interval) / 100), fmt='none', capsize=4)
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
+    sns.despine(fig=fig)
+    ax.set_xlabel('Target Lesions')
+    ax.set_ylabel('Misclassified Patients')
 
     if save_path:
         save_file = save_path / "recist_accuracy.png"
@@ -38,16 +92,24 @@ def plot_recist_accuracy(recist_accuracy:list,
 
 
 def plot_pd_sensitivity(pd_sensitivity:list,
-                        save_path: Path | None = None
+                        save_path: Path | None = None,
+                        sensitivity_interval: tuple[list, list] | None = None
                         ) -> Figure:
-    """Plot sensitivity to progressive disease (PD) status of RECIST classification at different numbers of target lesions as a scatter plot."""
-    fig = plt.figure(figsize=(8, 6))
-    plt.axvline(5, color='red', linestyle='--', label='RECIST v1.1')
-    plt.scatter(range(1, 11), np.array(pd_sensitivity) / 100, marker='o', s=75, label = 'Observation')
-    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
-    sns.despine()
-    plt.xlabel('Target Lesions')
-    plt.ylabel('Sensitivity')
+    """Plot sensitivity to progressive disease (PD) status of RECIST classification at different numbers of target lesions as a scatter plot.
+    
+       If sensitivity_interval is given as (lower, upper) sensitivity bounds, they are drawn as error bars.
+       """
+    fig = Figure(figsize=(8, 6))
+    ax = fig.subplots()
+    ax.axvline(5, color='red', linestyle='--', label='RECIST v1.1')
+    sensitivity = np.array(pd_sensitivity) / 100
+    ax.scatter(range(1, 11), sensitivity, marker='o', s=75, label = 'Observation')
+    if sensitivity_interval is not None:
+        ax.errorbar(range(1, 11), sensitivity, yerr=interval_to_yerr(sensitivity, np.array(sensitivity_interval) / 100), fmt='none', capsize=4)
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
+    sns.despine(fig=fig)
+    ax.set_xlabel('Target Lesions')
+    ax.set_ylabel('Sensitivity')
 
     if save_path:
         save_file = save_path / "PD_sensitivity.png"
@@ -58,23 +120,32 @@ def plot_pd_sensitivity(pd_sensitivity:list,
 
 def plot_acc_and_sens(accuracy:list,
                       sensitivity:list,
-                      save_path: Path | None = None
+                      save_path: Path | None = None,
+                      accuracy_interval: tuple[list, list] | None = None,
+                      sensitivity_interval: tuple[list, list] | None = None
                       ) -> Figure:
-    """Scatter plots of accuracy (blue) and PD sensitivity (brown) on the same plot."""
+    """Scatter plots of accuracy (blue) and PD sensitivity (brown) on the same plot, with optional (lower, upper) bounds drawn as error bars."""
     # Plot sensitivity and misclassification rate on the same plot
-    fig, ax1 = plt.subplots(figsize=(8, 6))
+    fig = Figure(figsize=(8, 6))
+    ax1 = fig.subplots()
 
     color = 'tab:blue'
     ax1.set_xlabel('Target Lesions')
     ax1.set_ylabel('Misclassified Patients', color=color)
-    ax1.scatter(range(1, 11), 1 - np.array(accuracy) / 100, marker='o', s=75, label='Misclassified Patients', color=color)
+    misclassified = 1 - np.array(accuracy) / 100
+    ax1.scatter(range(1, 11), misclassified, marker='o', s=75, label='Misclassified Patients', color=color)
+    if accuracy_interval is not None:
+        ax1.errorbar(range(1, 11), misclassified, yerr=interval_to_yerr(misclassified, 1 - np.array(accuracy_interval) / 100), fmt='none', capsize=4, color=color)
     ax1.tick_params(axis='y', labelcolor=color)
 
 
     ax2 = ax1.twinx()  # instantiate a second axes that shares the same x-axis
     color = 'tab:brown'
     ax2.set_ylabel('Sensitivity', color=color)  # we already handled the x-label with ax1
-    ax2.scatter(range(1, 11), np.array(sensitivity) / 100, marker='o', s=75, label='Sensitivity', color=color)
+    sensitivity = np.array(sensitivity) / 100
+    ax2.scatter(range(1, 11), sensitivity, marker='o', s=75, label='Sensitivity', color=color)
+    if sensitivity_interval is not None:
+        ax2.errorbar(range(1, 11), sensitivity, yerr=interval_to_yerr(sensitivity, np.array(sensitivity_interval) / 100), fmt='none', capsize=4, color=color)
     ax2.tick_params(axis='y', labelcolor=color, length=0)
     ax1.axvline(5, color='red', linestyle='--', label='RECIST v1.1')
 
@@ -88,7 +159,7 @@ def plot_acc_and_sens(accuracy:list,
 
     # Place legend outside, 1 row x 3 columns
     fig.legend(handles, labels, loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=3)
-    sns.despine()
+    sns.despine(fig=fig)
 
     if save_path:
         save_file = save_path / "recist_accuracy_and_sensitivity.png"
@@ -97,14 +168,37 @@ def plot_acc_and_sens(accuracy:list,
     return fig
 
 
-def plot_vol_vs_diameter(lesion_data: pd.DataFrame,
-                        save_path: Path | None = None
-                        ) -> tuple[Figure, Figure]:
-    """Scatter plot of observed volume vs. expected volume and separate scatter plot of volume varition and expected volume."""
-    diameters = lesion_data['diameter_pre'].to_numpy() / 10
-    volumes = lesion_data['volume_cc_contoured'].to_numpy()
+def bin_points(x: np.ndarray,
+               y: np.ndarray,
+               x_range: tuple[float, float],
+               y_range: tuple[float, float],
+               bins: int = DENSITY_BINS
+               ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Count points in a bins x bins grid over x_range and y_range, like np.histogram2d but with one np.bincount.
 
-    expected_volume = 4/3 * np.pi * (np.linspace(0,25,100)/2)**3
+    Points outside the ranges are dropped. Returns the (bins, bins) counts indexed by x then y bin, and the x and y bin edges.
+    """
+    x_index = np.floor((x - x_range[0]) / (x_range[1] - x_range[0]) * bins)
+    y_index = np.floor((y - y_range[0]) / (y_range[1] - y_range[0]) * bins)
+    # Points on the upper edges fall in the last bin, as with np.histogram2d
+    x_index[x == x_range[1]] = bins - 1
+    y_index[y == y_range[1]] = bins - 1
+    in_range = (x_index >= 0) & (x_index < bins) & (y_index >= 0) & (y_index < bins)
+
+    counts = np.bincount((x_index[in_range] * bins + y_index[in_range]).astype(np.int64), minlength=bins * bins).reshape(bins, bins)
+    return counts, np.linspace(*x_range, bins + 1), np.linspace(*y_range, bins + 1)
+
+
+def vol_vs_diameter_data(lesion_data: pd.DataFrame | LesionStore,
+                         density: bool | None = None
+                         ) -> dict:
+    """Prepare the points of the volume vs. diameter plots, as keyword arguments for draw_vol_vs_diameter.
+
+    In density mode the points are binned over the plotted ranges with bin_points, so the data to draw does not grow with the
+    number of lesions. If density is None, density mode is used for more than DENSITY_MIN_POINTS lesions.
+    """
+    diameters = np.asarray(lesion_data['diameter_pre']) / 10
+    volumes = np.asarray(lesion_data['volume_cc_contoured'])
 
     # remove any points where the volume is >100 if the diameter is <= 3
     idx_to_keep = ~np.logical_and(diameters <= 3, volumes >= 100)
@@ -112,28 +206,65 @@ def plot_vol_vs_diameter(lesion_data: pd.DataFrame,
     volumes = volumes[idx_to_keep]
 
     volume_variation = volumes - 4/3 * np.pi * (diameters/2)**3
-    
+
+    if density is None:
+        density = len(diameters) > DENSITY_MIN_POINTS
+    if not density:
+        return {'observed': (diameters, volumes), 'variation': (diameters, volume_variation), 'density': False}
+
+    observed = bin_points(diameters, volumes, DIAMETER_LIMITS, VOLUME_LIMITS)
+    variation = bin_points(diameters, volume_variation, DIAMETER_LIMITS, VOLUME_VARIATION_LIMITS)
+    return {'observed': observed, 'variation': variation, 'density': True}
+
+
+def draw_points(ax: object,
+                points: tuple,
+                density: bool,
+                label: str | None = None
+                ) -> None:
+    """Draw (x, y) points as a labelled scatter, or (counts, x_edges, y_edges) bins from bin_points as a log-scaled density plot with a colorbar."""
+    if not density:
+        ax.scatter(*points, alpha=0.5, label=label)
+        return
+
+    counts, x_edges, y_edges = points
+    # Empty bins are left blank
+    counts = np.where(counts > 0, counts, np.nan)
+    mesh = ax.pcolormesh(x_edges, y_edges, counts.T, cmap='Blues', norm=LogNorm(vmin=1))
+    ax.figure.colorbar(mesh, ax=ax, label='Lesions')
+
+
+def draw_vol_vs_diameter(observed: tuple,
+                         variation: tuple,
+                         density: bool = False,
+                         save_path: Path | None = None
+                         ) -> tuple[Figure, Figure]:
+    """Draw the volume vs. diameter and volume variation vs. diameter plots from the points prepared by vol_vs_diameter_data."""
+    expected_volume = 4/3 * np.pi * (np.linspace(0,25,100)/2)**3
+
     # Scatter plot of volume versus diameter
-    vol_v_diam_fig = plt.figure(figsize=(8, 7))
-    plt.scatter(diameters, volumes, alpha=0.5, label='Observed volume')
-    plt.plot(np.linspace(0, 25, 100), expected_volume, color='red', label='Expected volume')
-    plt.ylim(0, 2000)
-    plt.xlim(0, 20)
-    plt.xlabel('Diameter (cm)')
-    plt.ylabel(r'Volume ($cm^3$)')
-    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
-    sns.despine(trim=True, offset=5)
+    vol_v_diam_fig = Figure(figsize=(8, 7))
+    ax = vol_v_diam_fig.subplots()
+    draw_points(ax, observed, density, label='Observed volume')
+    ax.plot(np.linspace(0, 25, 100), expected_volume, color='red', label='Expected volume')
+    ax.set_ylim(*VOLUME_LIMITS)
+    ax.set_xlim(*DIAMETER_LIMITS)
+    ax.set_xlabel('Diameter (cm)')
+    ax.set_ylabel(r'Volume ($cm^3$)')
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
+    sns.despine(ax=ax, trim=True, offset=5)
 
     # Residuals plot of volume variation
-    vol_var_v_diam_fig = plt.figure(figsize=(8, 7))
-    plt.scatter(diameters, volume_variation, alpha=0.5, label='Volume Variation')
-    plt.axhline(0, color='red', linestyle='--', label='Expected Volume')
-    plt.ylim(-1000, 1000)
-    plt.xlim(0, 20)
-    plt.xlabel('Diameter (cm)')
-    plt.ylabel('Volume variation ($cm^3$)')
-    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
-    sns.despine()
+    vol_var_v_diam_fig = Figure(figsize=(8, 7))
+    ax = vol_var_v_diam_fig.subplots()
+    draw_points(ax, variation, density, label='Volume Variation')
+    ax.axhline(0, color='red', linestyle='--', label='Expected Volume')
+    ax.set_ylim(*VOLUME_VARIATION_LIMITS)
+    ax.set_xlim(*DIAMETER_LIMITS)
+    ax.set_xlabel('Diameter (cm)')
+    ax.set_ylabel('Volume variation ($cm^3$)')
+    ax.legend(loc='upper center', bbox_to_anchor=(0.5, -0.09), ncol=2)
+    sns.despine(ax=ax)
 
     if save_path:
         vol_v_diam_file = save_path / "expected_vs_observed_volume.png"
@@ -143,4 +274,14 @@ def plot_vol_vs_diameter(lesion_data: pd.DataFrame,
         save_plot(vol_var_v_diam_fig, vol_var_v_diam_file)
 
     return vol_v_diam_fig, vol_var_v_diam_fig
-    
\ No newline at end of file
+
+
+def plot_vol_vs_diameter(lesion_data: pd.DataFrame | LesionStore,
+                         save_path: Path | None = None,
+                         density: bool | None = None
+                         ) -> tuple[Figure, Figure]:
+    """Scatter plot of observed volume vs. expected volume and separate scatter plot of volume varition and expected volume.
+
+       Large cohorts are drawn as binned density plots instead, see vol_vs_diameter_data.
+       """
+    return draw_vol_vs_diameter(**vol_vs_diameter_data(lesion_data, density=density), save_path=save_path)
@@ -0,0 +1,141 @@
+import cProfile
+import json
+import pstats
+import sys
+import time
+import tracemalloc
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS is not recorded
+    resource = None
+
+# Optional profilers that can be run over a whole pipeline run
+PROFILE_MODES = ['none', 'cprofile', 'tracemalloc']
+
+# Number of functions or allocation sites listed in the profiler reports
+PROFILE_REPORT_LINES = 30
+
+
+def peak_rss_mb() -> float | None:
+    """Return the peak resident set size of the current process so far in MB, or None if it cannot be measured on this platform."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return max_rss / 1e6 if sys.platform == 'darwin' else max_rss / 1e3
+
+
+@contextmanager
+def time_stage(stage_records: list[dict],
+               stage: str,
+               rows: int | None = None
+               ) -> Iterator[dict]:
+    """Time a block of code, appending a record of its wall time, CPU time, peak RSS and rows processed to stage_records.
+
+    The yielded record can be updated inside the block, for example to set rows once they are known. If tracemalloc is tracing,
+    the peak traced Python memory of the block is recorded too.
+    """
+    record = {'stage': stage, 'rows': rows}
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        record['peak_rss_mb'] = peak_rss_mb()
+        if tracemalloc.is_tracing():
+            record['peak_traced_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        stage_records.append(record)
+
+
+class RunProfile:
+    """Stage-level timing and memory records for one pipeline run.
+
+    Stages run in the main process are recorded with stage. Chunk stages run by simulate_chunk, possibly in worker processes, are
+    added with add_chunk_stages and summed over chunks, so their wall time can exceed the elapsed time of a parallel run.
+    Peak RSS is the high-water mark of the process that ran the stage when it finished.
+    """
+
+    def __init__(self) -> None:
+        self.stages = []
+        self.chunk_stages = {}
+
+    def stage(self,
+              stage: str,
+              rows: int | None = None
+              ) -> AbstractContextManager[dict]:
+        """Time a stage run in the main process, see time_stage."""
+        return time_stage(self.stages, stage, rows=rows)
+
+    def add_chunk_stages(self, stage_records: list[dict]) -> None:
+        """Add the stage records of one chunk, summing times and rows and keeping the largest peak RSS of each stage."""
+        for record in stage_records:
+            total = self.chunk_stages.setdefault(record['stage'], {'stage': record['stage'], 'num_chunks': 0, 'rows': 0,
+                                                                   'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'peak_rss_mb': None})
+            total['num_chunks'] += 1
+            total['rows'] += record['rows'] or 0
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            if record['peak_rss_mb'] is not None:
+                total['peak_rss_mb'] = max(total['peak_rss_mb'] or 0, record['peak_rss_mb'])
+
+    def to_frame(self) -> pd.DataFrame:
+        """Return one row per stage with a scope column of 'main' for main process stages and 'chunks' for summed chunk stages."""
+        profile = pd.DataFrame([{'scope': 'main', **record} for record in self.stages]
+                               + [{'scope': 'chunks', **record} for record in self.chunk_stages.values()])
+        return profile.astype({column: 'Int64' for column in ('rows', 'num_chunks') if column in profile.columns})
+
+    def save(self, output_path: Path) -> None:
+        """Write the run profile to output_path as both JSON and CSV, adding the file extensions."""
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        profile = self.to_frame()
+        output_path.with_name(output_path.name + '.json').write_text(json.dumps(profile.to_dict(orient='records'), indent=2))
+        profile.to_csv(output_path.with_name(output_path.name + '.csv'), index=False)
+
+
+def start_profiler(mode: str) -> cProfile.Profile | None:
+    """Start the cprofile or tracemalloc profiler, returning the cProfile.Profile if mode is cprofile."""
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if mode == 'tracemalloc':
+        tracemalloc.start()
+    return None
+
+
+def stop_profiler(mode: str,
+                  profiler: cProfile.Profile | None,
+                  output_path: Path
+                  ) -> None:
+    """Stop the profiler started by start_profiler and write its report to output_path.
+
+    cprofile writes the raw stats to a .prof file, readable with pstats or snakeviz, and a .txt summary of the functions with
+    the most cumulative time. tracemalloc writes a .txt summary of the source lines holding the most memory at the end of the run.
+    Nothing is written, and no directory is made, if mode is none.
+    """
+    if mode == 'none':
+        return
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if mode == 'cprofile':
+        profiler.disable()
+        profiler.dump_stats(output_path.with_name(output_path.name + '_cprofile.prof'))
+        with output_path.with_name(output_path.name + '_cprofile.txt').open('w') as report:
+            pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+    elif mode == 'tracemalloc':
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        top_lines = snapshot.statistics('lineno')[:PROFILE_REPORT_LINES]
+        output_path.with_name(output_path.name + '_tracemalloc.txt').write_text('\n'.join(str(line) for line in top_lines))
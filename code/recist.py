@@ -1,13 +1,23 @@
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
-from tqdm import tqdm
+from chunking import DEFAULT_CHUNK_SIZE, chunk_bounds, map_chunks, spawn_chunk_rngs
+from lesion_store import LesionStore
+from shared_table import SharedTable, share_with_workers, table_frame
 
 # RECIST response category thresholds
 PD_THRESHOLD = 20
 SD_THRESHOLD = -30
 PR_THRESHOLD = -100
 
+# Maximum number of target lesions that can be selected from one location
+MAX_TARGETS_PER_LOCATION = 2
+
+# RECIST response categories, ordered from best to worst response
+RECIST_CATEGORIES = ('CR', 'PR', 'SD', 'PD')
+
+# Largest number of lesions counted separately in confusion_matrices, patients with more lesions are counted together with it
+MAX_LESION_STRATUM = 30
+
 def recist_thresholding(sld_chg):
     if sld_chg > PD_THRESHOLD:
         return 'PD'
@@ -19,98 +29,216 @@ def recist_thresholding(sld_chg):
         return 'CR'
 
 
-def recist_assess(lesion_data:pd.DataFrame,
-                  parallel:bool = False
-                  ) -> pd.DataFrame:
-    """Calculate RECIST response category from lesion diameter data."""
-    patients, lesion_counts = np.unique(lesion_data['patient_id'], return_counts=True)
+def recist_codes(sld_chg: np.ndarray) -> np.ndarray:
+    """Vectorized version of recist_thresholding. Returns the index of each response category in RECIST_CATEGORIES, or -1 where no category applies."""
+    sld_chg = np.asarray(sld_chg)
+    codes = np.select([sld_chg > PD_THRESHOLD,
+                       sld_chg > SD_THRESHOLD,
+                       sld_chg > PR_THRESHOLD,
+                       sld_chg == PR_THRESHOLD],
+                      [3, 2, 1, 0],
+                      default=-1)
+    return codes.astype(np.int8)
 
-    # Calculate the sum of longest diameters (sld) for pre, post
-    sld_pre = [np.sum(lesion_data['diameter_pre'][lesion_data['patient_id'] == p]) for p in patients]
-    sld_post = [np.sum(lesion_data['diameter_post'][lesion_data['patient_id'] == p]) for p in patients]
 
-    # Calculte the percentage different in the sum of longest diameters (sld) pre and post
-    sld_chg = [(sld_post[i] - sld_pre[i])/sld_pre[i] * 100 for i in range(len(sld_pre))]
+def recist_labels(codes: np.ndarray) -> np.ndarray:
+    """Convert RECIST category codes from recist_codes to category labels, with None where no category applies."""
+    # Code -1 indexes the trailing None
+    labels = np.array([*RECIST_CATEGORIES, None], dtype=object)
+    return labels[codes]
 
-    # Initialize RECIST response vector
-    recist_response = []
 
-    # Classify each patient's response based on the percent change in sld
-    if parallel:
-        recist_response = Parallel()(
-            delayed(recist_thresholding)(
-                sld_chg=sld_chg[pat_idx]
-            )
-            for pat_idx in tqdm(range(len(patients)), 
-                                desc="Performing RECIST assessment...", 
-                                total=len(patients))
-        )
-    else:
-        recist_response = [
-            recist_thresholding(
-                sld_chg = sld_chg[pat_idx]
-            ) 
-            for pat_idx in tqdm(range(len(patients)), 
-                                desc="Performing RECIST assessment...", 
-                                total=len(patients))
-        ]
+def recist_kernel(patient_ids: np.ndarray,
+                  diameter_pre: np.ndarray,
+                  diameter_post: np.ndarray
+                  ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Calculate the sum of longest diameters (SLD) and RECIST response category for each patient from lesion-level arrays.
+
+    Patient IDs are factorized once and the SLDs are summed with np.bincount, so the cost is linear in the number of lesions.
+
+    Parameters
+    ----------
+    patient_ids: np.ndarray
+        Patient ID of each lesion.
+    diameter_pre: np.ndarray
+        Pre-treatment diameter of each lesion.
+    diameter_post: np.ndarray
+        Post-treatment diameter of each lesion.
+
+    Returns
+    -------
+    patients: np.ndarray
+        Sorted unique patient IDs.
+    lesion_counts: np.ndarray
+        Number of lesions for each patient.
+    sld_pre: np.ndarray
+        Pre-treatment SLD for each patient.
+    sld_post: np.ndarray
+        Post-treatment SLD for each patient.
+    sld_chg: np.ndarray
+        Percent change in SLD for each patient.
+    recist_response: np.ndarray
+        RECIST category code for each patient, see recist_codes.
+    """
+    patient_codes, patients = pd.factorize(np.asarray(patient_ids), sort=True)
+    num_patients = len(patients)
+
+    lesion_counts = np.bincount(patient_codes, minlength=num_patients)
+    sld_pre = np.bincount(patient_codes, weights=diameter_pre, minlength=num_patients)
+    sld_post = np.bincount(patient_codes, weights=diameter_post, minlength=num_patients)
+
+    # Calculate the percentage difference in the sum of longest diameters (sld) pre and post
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sld_chg = (sld_post - sld_pre) / sld_pre * 100
+
+    return patients, lesion_counts, sld_pre, sld_post, sld_chg, recist_codes(sld_chg)
+
+
+def lesion_location_codes(lesion_data: pd.DataFrame | LesionStore) -> np.ndarray:
+    """Return an integer code for the location of each lesion, using the codes already held by a LesionStore."""
+    if isinstance(lesion_data, LesionStore):
+        return lesion_data.column('location_code')
+    return pd.factorize(lesion_data['location'].to_numpy())[0]
+
+
+def recist_assess(lesion_data:pd.DataFrame | LesionStore,
+                  parallel:bool = False
+                  ) -> pd.DataFrame:
+    """Calculate RECIST response category from lesion diameter data.
+    
+       The assessment runs as a single vectorized pass with recist_kernel, parallel is kept for backwards compatibility and has no effect.
+       """
+    patients, lesion_counts, sld_pre, sld_post, sld_chg, recist_response = recist_kernel(patient_ids=np.asarray(lesion_data['patient_id']),
+                                                                                          diameter_pre=np.asarray(lesion_data['diameter_pre']),
+                                                                                          diameter_post=np.asarray(lesion_data['diameter_post']))
 
     patient_response = pd.DataFrame({'patient_id': patients, 
                                 'num_lesions': lesion_counts, 
                                 'sld_pre': sld_pre, 
                                 'sld_post': sld_post, 
                                 'sld_chg': sld_chg, 
-                                'RECIST (all)': recist_response})
-    patient_response = patient_response.sort_values(by='patient_id', ignore_index=True)
+                                'RECIST (all)': recist_labels(recist_response)})
     return patient_response
 
 
 
-def select_target_lesions(num_lesions:int,
-                          lesion_data:pd.DataFrame,
-                          lesion_selection_rng: np.random.Generator,
-                          parallel: bool = False) -> pd.DataFrame:
-    """Randomly select specified number of target lesions from lesion data, ensuring no more than 2 are selected for each location following RECIST specifications.
-       
-       Returns the selected target lesion rows from lesion data.
+def select_chunk_target_lesions(num_lesions: int,
+                                lesion_data: pd.DataFrame,
+                                lesion_selection_rng: np.random.Generator
+                                ) -> list:
+    """Randomly select target lesions for every patient in lesion_data, with no more than 2 selected for each location.
+
+       Returns the index labels of the selected target lesions.
        """
-    patients = np.unique(lesion_data['patient_id'])
+    if lesion_data.empty:
+        return []
+
+    # Group the lesion rows by patient and then location once, keeping their original order within each group
+    patient_codes = pd.factorize(lesion_data['patient_id'].to_numpy(), sort=True)[0]
+    location_codes = pd.factorize(lesion_data['location'].to_numpy(), sort=True)[0]
+    row_order = np.lexsort((location_codes, patient_codes))
+    index = lesion_data.index.to_numpy()[row_order]
+    # Missing locations are coded -1, so shift the codes to keep them as their own group, as in rank_target_lesions
+    location_groups = patient_codes.astype(np.int64) * (np.max(location_codes, initial=0) + 2) + location_codes + 1
+    group_starts = np.flatnonzero(np.diff(location_groups[row_order], prepend=-1))
+    patient_starts = np.flatnonzero(np.diff(patient_codes[row_order], prepend=-1))
+    group_bounds = np.append(group_starts, len(row_order))
 
-    def selection_process(patient):
-        # ensure that there are not more than 2 target lesions per location
-        # get the locations for the patient
-        locations = np.unique(lesion_data['location'][lesion_data['patient_id'] == patient])
+    def selection_process(first_group: int, last_group: int) -> list:
         selected_lesion_idx = []
 
         # for each location, select up to 2 lesions
-        for location in locations:
+        for group in range(first_group, last_group):
             # get the indices of the lesions at the location
-            targets_at_loc_idx = lesion_data[(lesion_data['patient_id'] == patient) & (lesion_data['location'] == location)].index
-            
+            targets_at_loc_idx = index[group_bounds[group]:group_bounds[group + 1]]
+
             # select up to 2 lesions
             if len(targets_at_loc_idx) > 2:
                 # select 2 random indices
                 targets_at_loc_idx = lesion_selection_rng.choice(list(targets_at_loc_idx), 2, replace=False)
-                selected_lesion_idx.extend(targets_at_loc_idx)
-            else:
-                selected_lesion_idx.extend(targets_at_loc_idx)
-        
-        # If there are more selected lesions from this location than the required number of lesions, randomly select from these
+            selected_lesion_idx.extend(targets_at_loc_idx)
+
+        # If there are more selected lesions from this location than the required number of lesions, randomly select from these,
+        # without replacement so no lesion is counted twice, as in rank_target_lesions
         if len(selected_lesion_idx) > num_lesions:
-            return lesion_selection_rng.choice(selected_lesion_idx, num_lesions)
+            return lesion_selection_rng.choice(selected_lesion_idx, num_lesions, replace=False)
         else:
             return selected_lesion_idx
-    
-    if parallel:
-        target_lesions = Parallel()(
-            delayed(selection_process)(patient=patient)
-            for patient in patients
-        )
-    else:
-        target_lesions = [selection_process(patient=patient) for patient in patients]
 
+    # Each patient's location groups run from its first group to the next patient's first group
+    patient_groups = np.append(np.searchsorted(group_starts, patient_starts), len(group_starts))
     # Flatten the list of lesion lists for each patient
-    lesion_idxs = [idx for patient in target_lesions for idx in patient]
+    return [idx for first_group, last_group in zip(patient_groups[:-1], patient_groups[1:], strict=True)
+            for idx in selection_process(first_group, last_group)]
+
+
+
+def select_table_target_lesions(num_lesions: int,
+                                lesion_table: pd.DataFrame | SharedTable,
+                                first_row: int,
+                                last_row: int,
+                                lesion_selection_rng: np.random.Generator
+                                ) -> list:
+    """Select target lesions with select_chunk_target_lesions for rows first_row to last_row of a table of lesion index labels, patient IDs and locations."""
+    lesion_data = table_frame(lesion_table).iloc[first_row:last_row].set_index('index')
+    return select_chunk_target_lesions(num_lesions=num_lesions,
+                                       lesion_data=lesion_data,
+                                       lesion_selection_rng=lesion_selection_rng)
+
+
+def select_target_lesions(num_lesions:int,
+                          lesion_data:pd.DataFrame | LesionStore,
+                          lesion_selection_rng: np.random.Generator,
+                          parallel: bool = False,
+                          n_jobs: int = -1,
+                          chunk_size: int = DEFAULT_CHUNK_SIZE) -> pd.DataFrame | LesionStore:
+    """Randomly select specified number of target lesions from lesion data, ensuring no more than 2 are selected for each location following RECIST specifications.
+
+       Each patient's targets are distinct lesions, drawn without replacement, whatever the type of lesion_data. If lesion_data is a
+       LesionStore, the targets are selected in one vectorized pass with rank_target_lesions and returned as a view of the store,
+       without copying any lesion data.
+
+       If parallel is True, patients are split into chunks of chunk_size that are selected across n_jobs worker processes. The patient
+       and location columns are published to the workers once as a SharedTable, each chunk only receives the bounds of its own
+       patients' rows in it and draws from its own random stream spawned from lesion_selection_rng, so the
+       selection for a given seed and chunk_size does not depend on the number of workers.
+       
+       Returns the selected target lesion rows from lesion data.
+       """
+    if isinstance(lesion_data, LesionStore):
+        patient_codes = pd.factorize(lesion_data['patient_id'], sort=True)[0]
+        eligible, target_rank = rank_target_lesions(patient_codes, lesion_data['location_code'], lesion_selection_rng)
+        return lesion_data.take(np.sort(eligible[target_rank < num_lesions]))
+
+    if parallel:
+        patients = np.unique(lesion_data['patient_id'])
+        bounds = chunk_bounds(len(patients), chunk_size)
+        chunk_rngs = spawn_chunk_rngs(lesion_selection_rng, len(bounds))
+
+        # Group the lesion rows by the chunk their patient belongs to
+        row_chunks = np.searchsorted(patients, lesion_data['patient_id'].to_numpy()) // chunk_size
+        row_order = np.argsort(row_chunks, kind='stable')
+        chunk_starts = np.searchsorted(row_chunks[row_order], np.arange(len(bounds) + 1))
+
+        # Only the columns selection needs are published, once, and each chunk is sent just its row bounds into them
+        lesion_table = share_with_workers(pd.DataFrame({'index': lesion_data.index.to_numpy()[row_order],
+                                                        'patient_id': lesion_data['patient_id'].to_numpy()[row_order],
+                                                        'location': lesion_data['location'].to_numpy()[row_order]}),
+                                          n_jobs=n_jobs,
+                                          num_chunks=len(bounds))
+        target_lesions = map_chunks(select_table_target_lesions,
+                                    [{'num_lesions': num_lesions,
+                                      'lesion_table': lesion_table,
+                                      'first_row': chunk_starts[chunk],
+                                      'last_row': chunk_starts[chunk + 1],
+                                      'lesion_selection_rng': chunk_rng}
+                                     for chunk, chunk_rng in enumerate(chunk_rngs)],
+                                    n_jobs=n_jobs)
+        lesion_idxs = [idx for chunk in target_lesions for idx in chunk]
+    else:
+        lesion_idxs = select_chunk_target_lesions(num_lesions=num_lesions,
+                                                  lesion_data=lesion_data,
+                                                  lesion_selection_rng=lesion_selection_rng)
 
     # Select out the rows of the lesion data for the selected target lesions
     selected_target_lesions = lesion_data.copy().iloc[lesion_idxs]
@@ -119,6 +247,142 @@ def select_target_lesions(num_lesions:int,
 
 
 
+def rank_within_groups(group_keys: np.ndarray) -> np.ndarray:
+    """Return the position of each element within its run of equal keys, for an array of group keys that is already sorted."""
+    new_group = np.ones(len(group_keys), dtype=bool)
+    new_group[1:] = group_keys[1:] != group_keys[:-1]
+    positions = np.arange(len(group_keys))
+    group_starts = np.maximum.accumulate(np.where(new_group, positions, 0))
+    return positions - group_starts
+
+
+def shuffle_within_groups(group_keys: np.ndarray,
+                          rng: np.random.Generator
+                          ) -> np.ndarray:
+    """Return an ordering that sorts non-negative integer group_keys, with the elements of each group in random order.
+
+    Random bits are packed below the group key so a single int64 argsort does the work of a lexsort.
+    """
+    group_keys = np.asarray(group_keys, dtype=np.int64)
+    random_bits = 62 - int(np.max(group_keys, initial=0)).bit_length()
+    sort_keys = (group_keys << random_bits) | rng.integers(0, 1 << random_bits, size=len(group_keys), dtype=np.int64)
+    return np.argsort(sort_keys)
+
+
+def rank_target_lesions(patient_codes: np.ndarray,
+                        location_codes: np.ndarray,
+                        lesion_selection_rng: np.random.Generator
+                        ) -> tuple[np.ndarray, np.ndarray]:
+    """Randomly rank each patient's lesions as target lesion candidates, with at most MAX_TARGETS_PER_LOCATION lesions per location eligible.
+
+    Returns the row positions of the eligible lesions, sorted by patient code and then rank, and the rank of each within its patient.
+    Selecting k target lesions for a patient takes their eligible lesions with rank below k.
+    """
+    patient_codes = np.asarray(patient_codes)
+    location_codes = np.asarray(location_codes)
+
+    # Randomly rank the lesions at each of a patient's locations and keep up to 2 of them as eligible targets
+    # (location codes are shifted by 1 so missing locations coded -1 still form their own group)
+    location_groups = patient_codes.astype(np.int64) * (np.max(location_codes, initial=0) + 2) + location_codes + 1
+    location_order = shuffle_within_groups(location_groups, lesion_selection_rng)
+    location_rank = rank_within_groups(location_groups[location_order])
+    eligible = location_order[location_rank < MAX_TARGETS_PER_LOCATION]
+
+    # Randomly rank each patient's eligible lesions, targets for k lesions are the first k of this ranking
+    eligible = eligible[shuffle_within_groups(patient_codes[eligible], lesion_selection_rng)]
+    return eligible, rank_within_groups(patient_codes[eligible])
+
+
+def target_sum_sweep(patient_codes: np.ndarray,
+                     location_codes: np.ndarray,
+                     values: np.ndarray,
+                     num_patients: int,
+                     lesion_selection_rng: np.random.Generator,
+                     max_targets: int = 10
+                     ) -> np.ndarray:
+    """Sum lesion values over randomly selected target lesions for every target count from 1 to max_targets in one pass.
+
+    Each patient gets one random ranking of their lesions, in which at most MAX_TARGETS_PER_LOCATION lesions per location are
+    eligible. The targets for k lesions are the first k eligible lesions of the ranking, so the target subsets are nested and the sums
+    for every k come from a single cumulative sum. Patients with fewer eligible lesions than k use all of their eligible lesions.
+
+    Parameters
+    ----------
+    patient_codes: np.ndarray
+        Integer code in the range 0 to num_patients - 1 identifying the patient of each lesion.
+    location_codes: np.ndarray
+        Integer code identifying the location of each lesion.
+    values: np.ndarray
+        Lesion values to sum, either one value per lesion or an array of shape (lesions, measures).
+    num_patients: int
+        Number of patients in patient_codes.
+    lesion_selection_rng: np.random.Generator
+        Random number generator to use for the target lesion rankings.
+    max_targets: int = 10
+        Maximum number of target lesions to sum over.
+
+    Returns
+    -------
+    np.ndarray
+        Target lesion sums of shape (patients, max_targets) or (patients, max_targets, measures), where index k - 1 holds the sum for k targets.
+    """
+    patient_codes = np.asarray(patient_codes)
+    values = np.asarray(values)
+
+    eligible, target_rank = rank_target_lesions(patient_codes, location_codes, lesion_selection_rng)
+    in_sweep = target_rank < max_targets
+    eligible = eligible[in_sweep]
+
+    target_values = np.zeros((num_patients, max_targets, *values.shape[1:]))
+    target_values[patient_codes[eligible], target_rank[in_sweep]] = values[eligible]
+
+    return np.cumsum(target_values, axis=1)
+
+
+def target_lesion_sweep(lesion_data: pd.DataFrame | LesionStore,
+                        lesion_selection_rng: np.random.Generator,
+                        max_targets: int = 10
+                        ) -> pd.DataFrame:
+    """Assess RECIST response using 1 to max_targets randomly selected target lesions per patient in a single pass.
+
+    Target lesions are chosen following RECIST specifications (no more than 2 per location) from one random ranking per patient, so the
+    target lesions used for k targets are also used for k + 1 targets. See target_sum_sweep.
+
+    Parameters
+    ----------
+    lesion_data: pd.DataFrame | LesionStore
+        Lesion measurement data, like that output by generate_synthetic_patients.
+    lesion_selection_rng: np.random.Generator
+        Random number generator to use for target lesion selection.
+    max_targets: int = 10
+        Maximum number of target lesions to assess with.
+
+    Returns
+    -------
+    pd.DataFrame
+        Sorted patient IDs and a "RECIST (k targets)" response category column for each k from 1 to max_targets.
+    """
+    patient_codes, patients = pd.factorize(np.asarray(lesion_data['patient_id']), sort=True)
+    location_codes = lesion_location_codes(lesion_data)
+
+    target_slds = target_sum_sweep(patient_codes=patient_codes,
+                                   location_codes=location_codes,
+                                   values=np.stack([lesion_data['diameter_pre'], lesion_data['diameter_post']], axis=-1),
+                                   num_patients=len(patients),
+                                   lesion_selection_rng=lesion_selection_rng,
+                                   max_targets=max_targets)
+
+    # Percent change in the target lesion SLD for every patient and target count
+    with np.errstate(divide='ignore', invalid='ignore'):
+        target_sld_chg = (target_slds[..., 1] - target_slds[..., 0]) / target_slds[..., 0] * 100
+    target_response = recist_labels(recist_codes(target_sld_chg))
+
+    return pd.DataFrame({'patient_id': patients,
+                         **{f"RECIST ({num_targets} targets)": target_response[:, num_targets - 1]
+                            for num_targets in range(1, max_targets + 1)}})
+
+
+
 def recist_metrics_by_target_count(patient_response: pd.DataFrame,
                                     max_targets: int = 11
                                     ) -> tuple[list, list]:
@@ -138,25 +402,248 @@ def recist_metrics_by_target_count(patient_response: pd.DataFrame,
     pd_sensitivity: list
         Sensitivity values for each number of targets selected.
     """
-    accuracy = []
-    pd_sensitivity = []
-    for num_targets in range(1, max_targets):
-        # Get patients with more than num_targets lesions
-        acc_idxs = patient_response['num_lesions'] > num_targets
-        # Check that there are patients with enough lesions
-        if acc_idxs.any():
-            # Get percentage of patients that have the same response category for RECIST (all) as RECIST (num_targets targets) 
-            accuracy.append(np.sum(patient_response['RECIST (all)'][acc_idxs] == patient_response[f"RECIST ({num_targets} targets)"][acc_idxs]) / np.sum(acc_idxs) * 100)
-        else:
-            accuracy.append(0)
-
-        # Get number of patients with more than num_targets and RECIST category is PD
-        sens_idxs = np.logical_and(patient_response['num_lesions'] > num_targets, patient_response['RECIST (all)'] == 'PD')
-        # Check that there are patients with enough targets with category PD
-        if sens_idxs.any():
-            # Calculate sensitivity for detecting progressive disease (PD)
-            pd_sensitivity.append(np.sum(patient_response[f"RECIST ({num_targets} targets)"][sens_idxs] == 'PD') / np.sum(sens_idxs) * 100)
-        else:
-            pd_sensitivity.append(0)
+    # Categories are compared as small integer codes in one confusion matrix pass, rather than as labels for each target count
+    target_columns = [f"RECIST ({num_targets} targets)" for num_targets in range(1, max_targets)]
+    num_lesions = patient_response['num_lesions'].to_numpy()
+    all_response = recist_response_codes(patient_response, ['RECIST (all)'])[:, 0]
+    matrices = confusion_matrices(num_lesions=num_lesions,
+                                  all_response=all_response,
+                                  target_response=recist_response_codes(patient_response, target_columns))[0]
+    _, num_agree, _, num_detected = confusion_metric_counts(matrices)
+
+    # The confusion matrices leave out patients without a category, but they still count as disagreeing with all lesions
+    eligible = num_lesions[:, np.newaxis] > np.arange(1, max_targets)
+    num_eligible = eligible.sum(axis=0)
+    num_progressive = (eligible & (all_response == RECIST_CATEGORIES.index('PD'))[:, np.newaxis]).sum(axis=0)
+    accuracy, pd_sensitivity = recist_metrics_from_counts(num_eligible, num_agree, num_progressive, num_detected)
+    return accuracy.tolist(), pd_sensitivity.tolist()
+
+
+def recist_response_codes(patient_response: pd.DataFrame,
+                          columns: list[str]
+                          ) -> np.ndarray:
+    """Encode RECIST category label columns of patient_response as category codes, see recist_codes. Returns an array of shape (patients, columns)."""
+    return np.stack([pd.Categorical(patient_response[column], categories=RECIST_CATEGORIES).codes for column in columns], axis=-1)
+
+
+def confusion_matrices(num_lesions: np.ndarray,
+                       all_response: np.ndarray,
+                       target_response: np.ndarray,
+                       groups: np.ndarray | None = None,
+                       num_groups: int = 1,
+                       max_lesions: int = MAX_LESION_STRATUM
+                       ) -> np.ndarray:
+    """Count patients by their RECIST category using all lesions and using k target lesions, for every target count and number of lesions, in one np.bincount.
+
+    Parameters
+    ----------
+    num_lesions: np.ndarray
+        Number of lesions for each patient, shape (patients,).
+    all_response: np.ndarray
+        RECIST category code using all lesions, shape (patients,).
+    target_response: np.ndarray
+        RECIST category code using 1 to K target lesions, shape (patients, K).
+    groups: np.ndarray | None = None
+        Group of each patient, such as its replicate cohort, from 0 to num_groups - 1. If None, all patients are one group.
+    num_groups: int = 1
+        Number of groups.
+    max_lesions: int = MAX_LESION_STRATUM
+        Patients with more lesions than this are counted with those with max_lesions. Must be more than K.
+
+    Returns
+    -------
+    np.ndarray
+        Patient counts of shape (groups, K, max_lesions + 1, 4, 4), indexed by group, k - 1, number of lesions, category using all
+        lesions and category using k targets, in RECIST_CATEGORIES order. Patients without a category (code -1) are not counted.
+    """
+    num_categories = len(RECIST_CATEGORIES)
+    num_targets = target_response.shape[-1]
+    groups = np.zeros(len(num_lesions), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    all_response = np.asarray(all_response, dtype=np.int64)[:, np.newaxis]
+    target_response = np.asarray(target_response, dtype=np.int64)
+    stratum = np.minimum(num_lesions, max_lesions).astype(np.int64)[:, np.newaxis]
+
+    # Flat index of each patient and target count into the (groups, K, strata, 4, 4) matrices
+    cell = (((groups[:, np.newaxis] * num_targets + np.arange(num_targets)) * (max_lesions + 1) + stratum) * num_categories
+            + all_response) * num_categories + target_response
+    counted = (all_response >= 0) & (target_response >= 0)
+    counts = np.bincount(cell[counted], minlength=num_groups * num_targets * (max_lesions + 1) * num_categories ** 2)
+    return counts.reshape(num_groups, num_targets, max_lesions + 1, num_categories, num_categories)
+
+
+def eligible_confusion(matrices: np.ndarray) -> np.ndarray:
+    """Sum confusion_matrices of shape (..., K, strata, 4, 4) over the patients with more than k lesions, returning shape (..., K, 4, 4)."""
+    num_targets, num_strata = matrices.shape[-4:-2]
+    eligible = np.arange(num_strata) > np.arange(1, num_targets + 1)[:, np.newaxis]
+    return np.sum(matrices * eligible[..., np.newaxis, np.newaxis], axis=-3)
+
+
+def confusion_metric_counts(matrices: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Count the patients behind RECIST accuracy and PD sensitivity for every target count from confusion_matrices of shape (..., K, strata, 4, 4).
+
+    Returns
+    -------
+    num_eligible: np.ndarray
+        Number of patients with more than k lesions, shape (..., K).
+    num_agree: np.ndarray
+        Number of those patients with the same category using k targets as using all lesions.
+    num_progressive: np.ndarray
+        Number of patients with more than k lesions and category PD using all lesions.
+    num_detected: np.ndarray
+        Number of those patients that are also PD using k targets.
+    """
+    pooled = eligible_confusion(matrices)
+    progressive = RECIST_CATEGORIES.index('PD')
+    return (pooled.sum(axis=(-2, -1)),
+            np.trace(pooled, axis1=-2, axis2=-1),
+            pooled[..., progressive, :].sum(axis=-1),
+            pooled[..., progressive, progressive])
+
+
+def confusion_metrics_table(matrices: np.ndarray) -> pd.DataFrame:
+    """Tabulate the metrics of confusion_matrices of shape (K, strata, 4, 4) for the patients with more than k lesions, one row per target count.
+
+    Along with accuracy, the agreement of the category using k targets with that using all lesions, this gives Cohen's kappa, the
+    percentage of patients whose k target category is a more or less favourable response than their all lesion category, and the
+    sensitivity and specificity of the k target category for each RECIST category. Percentages are NaN where there are no patients
+    to calculate them from.
+    """
+    pooled = eligible_confusion(matrices).astype(float)
+    num_eligible = pooled.sum(axis=(-2, -1))
+    all_totals = pooled.sum(axis=-1)
+    target_totals = pooled.sum(axis=-2)
+    agree = np.trace(pooled, axis1=-2, axis2=-1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        observed = agree / num_eligible
+        expected = np.sum(all_totals * target_totals, axis=-1) / num_eligible ** 2
+        metrics = {'num_targets': np.arange(1, pooled.shape[0] + 1),
+                   'num_eligible': num_eligible.astype(np.int64),
+                   'accuracy': observed * 100,
+                   'kappa': (observed - expected) / (1 - expected),
+                   # Categories are ordered from best to worst response, so targets below the diagonal understate progression
+                   'more_favourable': np.tril(pooled, k=-1).sum(axis=(-2, -1)) / num_eligible * 100,
+                   'less_favourable': np.triu(pooled, k=1).sum(axis=(-2, -1)) / num_eligible * 100}
+        for index, category in enumerate(RECIST_CATEGORIES):
+            true_positive = pooled[:, index, index]
+            false_positive = target_totals[:, index] - true_positive
+            negatives = num_eligible - all_totals[:, index]
+            metrics[f'{category}_sensitivity'] = true_positive / all_totals[:, index] * 100
+            metrics[f'{category}_specificity'] = (negatives - false_positive) / negatives * 100
+
+    return pd.DataFrame(metrics)
+
 
+def confusion_matrix_table(matrices: np.ndarray) -> pd.DataFrame:
+    """Tabulate the non-zero counts of confusion_matrices of shape (K, strata, 4, 4), one row per target count, number of lesions and pair of categories."""
+    num_targets, num_lesions, all_response, target_response = np.nonzero(matrices)
+    categories = np.asarray(RECIST_CATEGORIES, dtype=object)
+    return pd.DataFrame({'num_targets': num_targets + 1,
+                         'num_lesions': num_lesions,
+                         'all_response': categories[all_response],
+                         'target_response': categories[target_response],
+                         'count': matrices[num_targets, num_lesions, all_response, target_response]})
+
+
+def recist_metrics_from_counts(num_eligible: np.ndarray,
+                               num_agree: np.ndarray,
+                               num_progressive: np.ndarray,
+                               num_detected: np.ndarray
+                               ) -> tuple[np.ndarray, np.ndarray]:
+    """Calculate accuracy and PD sensitivity percentages from the counts returned by confusion_metric_counts, using 0 where there are no patients to count."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = np.where(num_eligible > 0, num_agree / num_eligible * 100, 0)
+        pd_sensitivity = np.where(num_progressive > 0, num_detected / num_progressive * 100, 0)
     return accuracy, pd_sensitivity
+
+
+def recist_metrics_by_replicate(num_lesions: np.ndarray,
+                                all_response: np.ndarray,
+                                target_response: np.ndarray
+                                ) -> tuple[np.ndarray, np.ndarray]:
+    """Calculate RECIST accuracy and PD sensitivity for every replicate cohort and target count at once.
+
+    Parameters
+    ----------
+    num_lesions: np.ndarray
+        Number of lesions for each patient, shape (replicates, patients).
+    all_response: np.ndarray
+        RECIST category code using all lesions, shape (replicates, patients).
+    target_response: np.ndarray
+        RECIST category code using 1 to K target lesions, shape (replicates, patients, K).
+
+    Returns
+    -------
+    accuracy: np.ndarray
+        Accuracy values of shape (replicates, K), 0 where no patients have more than k lesions.
+    pd_sensitivity: np.ndarray
+        PD sensitivity values of shape (replicates, K), 0 where no patients with more than k lesions are PD.
+    """
+    num_replicates, num_patients = num_lesions.shape
+    matrices = confusion_matrices(num_lesions=num_lesions.ravel(),
+                                  all_response=all_response.ravel(),
+                                  target_response=target_response.reshape(num_replicates * num_patients, -1),
+                                  groups=np.repeat(np.arange(num_replicates), num_patients),
+                                  num_groups=num_replicates)
+    return recist_metrics_from_counts(*confusion_metric_counts(matrices))
+
+
+def summarize_replicates(values: np.ndarray,
+                         confidence_level: float = 0.95
+                         ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Summarize replicate values of shape (replicates, K) with the mean, standard error and percentile confidence interval for each of the K columns."""
+    num_replicates = values.shape[0]
+    mean = np.mean(values, axis=0)
+    std_err = np.std(values, axis=0, ddof=1) / np.sqrt(num_replicates) if num_replicates > 1 else np.full(values.shape[1], np.nan)
+    ci_low, ci_high = np.percentile(values, [(1 - confidence_level) / 2 * 100, (1 + confidence_level) / 2 * 100], axis=0)
+    return mean, std_err, ci_low, ci_high
+
+
+def replicate_metrics_table(accuracy: np.ndarray,
+                            pd_sensitivity: np.ndarray,
+                            confidence_level: float = 0.95
+                            ) -> pd.DataFrame:
+    """Tabulate the summarize_replicates statistics of replicate accuracy and PD sensitivity values of shape (replicates, K), one row per number of target lesions."""
+    replicate_metrics = pd.DataFrame({'num_targets': range(1, accuracy.shape[1] + 1)})
+    for metric, values in (('accuracy', accuracy), ('pd_sensitivity', pd_sensitivity)):
+        mean, std_err, ci_low, ci_high = summarize_replicates(values, confidence_level=confidence_level)
+        replicate_metrics[f'{metric}_mean'] = mean
+        replicate_metrics[f'{metric}_std_err'] = std_err
+        replicate_metrics[f'{metric}_ci_low'] = ci_low
+        replicate_metrics[f'{metric}_ci_high'] = ci_high
+
+    return replicate_metrics
+
+
+def recist_metrics_replicates(patient_response: pd.DataFrame,
+                              num_replicates: int,
+                              max_targets: int = 11,
+                              confidence_level: float = 0.95
+                              ) -> pd.DataFrame:
+    """Calculate the mean, standard error and percentile confidence interval of RECIST accuracy and PD sensitivity over replicate cohorts, for each number of target lesions in the range 1 to max_targets.
+
+    Parameters
+    ----------
+    patient_response: pd.DataFrame
+        Response data for num_replicates equally sized cohorts, like that output by recist_assess with target lesion columns added.
+        Patients must be sorted so each consecutive block of len(patient_response) / num_replicates rows is one cohort.
+    num_replicates: int
+        Number of replicate cohorts in patient_response.
+    max_targets: int = 11
+        Maximum number of target lesions to test.
+    confidence_level: float = 0.95
+        Coverage of the percentile confidence interval.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per number of target lesions with the mean, std_err, ci_low and ci_high of accuracy and pd_sensitivity.
+    """
+    num_patients = len(patient_response) // num_replicates
+    target_columns = [f"RECIST ({num_targets} targets)" for num_targets in range(1, max_targets)]
+
+    accuracy, pd_sensitivity = recist_metrics_by_replicate(num_lesions=patient_response['num_lesions'].to_numpy().reshape(num_replicates, num_patients),
+                                                           all_response=recist_response_codes(patient_response, ['RECIST (all)']).reshape(num_replicates, num_patients),
+                                                           target_response=recist_response_codes(patient_response, target_columns).reshape(num_replicates, num_patients, len(target_columns)))
+
+    return replicate_metrics_table(accuracy, pd_sensitivity, confidence_level=confidence_level)
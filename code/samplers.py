@@ -0,0 +1,215 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+
+class ChangeSampler(ABC):
+    """Distribution of the fractional diameter change of each lesion, drawn with a NumPy Generator.
+
+    Subclasses implement sample, which draws every value in one call from the given generator, so a batch of lesions only
+    uses the run's own random stream. A subclass without sample cannot be instantiated. Pass an instance as change_sampler to
+    the lesion generators to simulate another distribution.
+    """
+
+    @abstractmethod
+    def sample(self,
+               rng: np.random.Generator,
+               size: int | tuple[int, ...]
+               ) -> np.ndarray:
+        """Draw an array of size diameter changes from rng."""
+
+
+class TruncatedNormalSampler(ChangeSampler):
+    """Normal distribution with mean and std_dev truncated to low_end to high_end, sampled by vectorized rejection.
+
+    Normal values outside the bounds are redrawn together until none are left, which takes few rounds as long as the bounds
+    keep most of the distribution, as with the default change of mean 0 and standard deviation 0.3 truncated to -1 to 3.
+    """
+
+    def __init__(self,
+                 mean: float = 0,
+                 std_dev: float = 0.3,
+                 low_end: float = -1,
+                 high_end: float = 3
+                 ) -> None:
+        if std_dev <= 0 or low_end >= high_end:
+            message = f"std_dev must be positive and low_end below high_end, got std_dev {std_dev} and bounds {low_end} to {high_end}."
+            raise ValueError(message)
+
+        self.mean = mean
+        self.std_dev = std_dev
+        self.low_end = low_end
+        self.high_end = high_end
+
+    def sample(self,
+               rng: np.random.Generator,
+               size: int | tuple[int, ...]
+               ) -> np.ndarray:
+        """Draw an array of size truncated normal values from rng."""
+        changes = rng.normal(self.mean, self.std_dev, size=size)
+
+        redraw = (changes < self.low_end) | (changes > self.high_end)
+        while redraw.any():
+            changes[redraw] = rng.normal(self.mean, self.std_dev, size=np.sum(redraw))
+            redraw = (changes < self.low_end) | (changes > self.high_end)
+
+        return changes
+
+
+class EmpiricalSampler(ChangeSampler):
+    """Observed diameter changes, such as those measured between two scans of a real cohort, resampled with replacement."""
+
+    def __init__(self, changes: np.ndarray) -> None:
+        changes = np.asarray(changes, dtype=float)
+        changes = changes[np.isfinite(changes)]
+        if len(changes) == 0:
+            message = "At least one finite diameter change is needed to resample from."
+            raise ValueError(message)
+
+        self.changes = changes
+
+    def sample(self,
+               rng: np.random.Generator,
+               size: int | tuple[int, ...]
+               ) -> np.ndarray:
+        """Draw an array of size observed changes from rng."""
+        return self.changes[rng.integers(0, len(self.changes), size=size)]
+
+
+class ScipySampler(ChangeSampler):
+    """Any frozen scipy.stats distribution, such as truncate_normal_distribution, sampled with its rvs method."""
+
+    def __init__(self, distribution: object) -> None:
+        self.distribution = distribution
+
+    def sample(self,
+               rng: np.random.Generator,
+               size: int | tuple[int, ...]
+               ) -> np.ndarray:
+        """Draw an array of size values from the distribution using rng."""
+        return np.asarray(self.distribution.rvs(size=size, random_state=rng))
+
+
+# Diameter change distribution used when no change_sampler is given, matching the original scipy truncated normal
+DEFAULT_CHANGE_SAMPLER = TruncatedNormalSampler(mean=0, std_dev=0.3, low_end=-1, high_end=3)
+
+
+def parse_site_mix(site_mix: str) -> dict[str, float]:
+    """Parse a site mix given on the command line as comma separated location=share pairs, such as "liver=0.4,lung=0.1"."""
+    shares = {}
+    for pair in site_mix.split(','):
+        location, separator, share = pair.partition('=')
+        try:
+            shares[location.strip()] = float(share)
+        except ValueError:
+            separator = ''
+        if not separator or not location.strip():
+            message = f"Site mix entries must be location=share, got {pair!r}."
+            raise ValueError(message)
+    return shares
+
+
+def site_mix_shares(locations: np.ndarray,
+                    location_counts: np.ndarray,
+                    site_mix: dict[str, float]
+                    ) -> np.ndarray:
+    """Return the share of lesions to draw at each location from a site mix of location shares.
+
+    If every location is in site_mix, the shares are relative weights and are normalised. Otherwise they are fractions of all
+    lesions, summing to at most 1, and the rest is split across the other locations in proportion to their number of base rows.
+    """
+    locations = [str(location) for location in locations]
+    unknown = [location for location in site_mix if location not in locations]
+    if unknown:
+        message = f"{unknown} in the site mix are not locations in the radiomic data, must be in {locations}."
+        raise ValueError(message)
+    if any(share < 0 for share in site_mix.values()):
+        message = f"Site mix shares cannot be negative, got {site_mix}."
+        raise ValueError(message)
+
+    listed = np.array([location in site_mix for location in locations])
+    shares = np.array([site_mix.get(location, 0.0) for location in locations])
+    if listed.all():
+        if shares.sum() <= 0:
+            message = "At least one location in the site mix must have a positive share."
+            raise ValueError(message)
+        return shares / shares.sum()
+
+    if shares.sum() > 1:
+        message = f"Site mix shares must sum to at most 1 when some locations are left out, got {shares.sum():g}."
+        raise ValueError(message)
+    shares[~listed] = (1 - shares.sum()) * location_counts[~listed] / location_counts[~listed].sum()
+    return shares
+
+
+class AliasTable:
+    """Walker alias table for drawing the integers 0 to len(weights) - 1 with probability proportional to weights in O(1) per draw.
+
+    Each draw picks a column uniformly and keeps it with the column's probability, or takes its alias otherwise.
+    """
+
+    def __init__(self, weights: np.ndarray) -> None:
+        weights = np.asarray(weights, dtype=float)
+        if weights.ndim != 1 or len(weights) == 0 or not np.isfinite(weights).all() or (weights < 0).any() or weights.sum() <= 0:
+            message = "Weights must be a non-empty 1D array of finite, non-negative values with a positive sum."
+            raise ValueError(message)
+
+        num_columns = len(weights)
+        scaled = weights / weights.sum() * num_columns
+        self.probability = np.ones(num_columns)
+        self.alias = np.arange(num_columns)
+
+        # Vose's method, pairing each column below the average with one above it
+        small = [column for column in range(num_columns) if scaled[column] < 1]
+        large = [column for column in range(num_columns) if scaled[column] >= 1]
+        while small and large:
+            short_column, tall_column = small.pop(), large.pop()
+            self.probability[short_column] = scaled[short_column]
+            self.alias[short_column] = tall_column
+            scaled[tall_column] -= 1 - scaled[short_column]
+            (small if scaled[tall_column] < 1 else large).append(tall_column)
+        # Any columns left over are full up to rounding error and keep probability 1
+
+    def sample(self,
+               rng: np.random.Generator,
+               size: int | tuple[int, ...]
+               ) -> np.ndarray:
+        """Draw an array of size integers from rng."""
+        columns = rng.integers(0, len(self.probability), size=size)
+        return np.where(rng.random(size) < self.probability[columns], columns, self.alias[columns])
+
+
+class LocationRowSampler:
+    """Precomputed index for drawing rows of the base radiomic data, stratified by location to match a site mix.
+
+    Without a site mix, rows are drawn uniformly with one lesion_selection_rng.integers call, the same draws as the original
+    per-lesion choice. With a site mix, each lesion's location is drawn from an alias table of the site_mix_shares and a row
+    is then drawn uniformly among that location's rows, so every draw takes constant time however many rows there are.
+    """
+
+    def __init__(self,
+                 locations: np.ndarray,
+                 site_mix: dict[str, float] | None = None
+                 ) -> None:
+        location_codes, location_labels = pd.factorize(np.asarray(locations), sort=True, use_na_sentinel=False)
+        self.num_rows = len(location_codes)
+        self.site_mix = site_mix
+        self.location_labels = np.asarray(location_labels, dtype=object)
+        self.location_counts = np.bincount(location_codes, minlength=len(location_labels))
+        # Row positions grouped by location, with the first position of each location's rows
+        self.location_rows = np.argsort(location_codes, kind='stable')
+        self.location_starts = np.cumsum(self.location_counts) - self.location_counts
+        self.location_table = AliasTable(site_mix_shares(self.location_labels, self.location_counts, site_mix)) if site_mix else None
+
+    def sample(self,
+               rng: np.random.Generator,
+               size: int
+               ) -> np.ndarray:
+        """Draw size row positions of the base radiomic data from rng."""
+        if self.location_table is None:
+            return rng.integers(0, self.num_rows, size=size)
+
+        location = self.location_table.sample(rng, size)
+        offset = (rng.random(size) * self.location_counts[location]).astype(np.int64)
+        return self.location_rows[self.location_starts[location] + offset]
@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+import weakref
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Shared memory filesystem the table files are written to where it exists, so mapping them never touches the disk
+SHARED_MEMORY_DIR = Path("/dev/shm")
+
+# Tables already mapped by this process, keyed by directory, so every chunk a worker runs reuses the same mapping. Only the
+# most recent are kept, as long-lived pool workers would otherwise hold on to the memory of tables their publisher has removed.
+_attached_frames: dict[Path, pd.DataFrame] = {}
+MAX_ATTACHED_TABLES = 4
+
+
+class SharedTable:
+    """Columns of a DataFrame published once as memory-mapped .npy files, so worker processes read them without a copy.
+
+    A SharedTable pickles as only its directory, column names and the labels of any text columns, so sending it with every
+    chunk of work costs the same however large the table is. Each process maps the files the first time it calls frame, and
+    the DataFrame it gets is backed by the mapped arrays. Text columns, such as the lesion location, are stored as integer
+    codes and read back as categoricals. The files are deleted when the publishing SharedTable is garbage collected, when
+    remove is called, or when the process exits.
+    """
+
+    def __init__(self,
+                 frame: pd.DataFrame,
+                 directory: Path | None = None
+                 ) -> None:
+        if directory is None and SHARED_MEMORY_DIR.is_dir():
+            directory = SHARED_MEMORY_DIR
+        self.directory = Path(tempfile.mkdtemp(prefix="shared_table_", dir=directory))
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+
+        self.columns = list(frame.columns)
+        self.labels = {}
+        for index, column in enumerate(self.columns):
+            values = frame[column].to_numpy()
+            if values.dtype == object:
+                values, labels = pd.factorize(values, sort=True)
+                self.labels[column] = np.asarray(labels, dtype=object)
+            np.save(self.directory / f"{index}.npy", values)
+
+    def __getstate__(self) -> dict:
+        # Only the publishing process owns the files
+        return {'directory': self.directory, 'columns': self.columns, 'labels': self.labels}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._finalizer = None
+
+    def frame(self) -> pd.DataFrame:
+        """Return the table as a DataFrame backed by the read-only memory-mapped column files."""
+        if self.directory not in _attached_frames:
+            columns = {}
+            for index, column in enumerate(self.columns):
+                values = np.load(self.directory / f"{index}.npy", mmap_mode='r')
+                if column in self.labels:
+                    values = pd.Categorical.from_codes(values, categories=self.labels[column])
+                columns[column] = values
+            if len(_attached_frames) >= MAX_ATTACHED_TABLES:
+                _attached_frames.pop(next(iter(_attached_frames)))
+            _attached_frames[self.directory] = pd.DataFrame(columns, copy=False)
+        return _attached_frames[self.directory]
+
+    def remove(self) -> None:
+        """Delete the column files. Only has an effect in the process that published the table."""
+        _attached_frames.pop(self.directory, None)
+        if self._finalizer is not None:
+            self._finalizer()
+
+
+def share_with_workers(frame: pd.DataFrame,
+                       n_jobs: int,
+                       num_chunks: int
+                       ) -> pd.DataFrame | SharedTable:
+    """Publish frame as a SharedTable if num_chunks chunks of work are going to a pool of n_jobs worker processes, otherwise return it as is."""
+    return SharedTable(frame) if n_jobs != 1 and num_chunks > 1 else frame
+
+
+def table_frame(table: pd.DataFrame | SharedTable) -> pd.DataFrame:
+    """Return table as a DataFrame, mapping it if it is a SharedTable."""
+    return table.frame() if isinstance(table, SharedTable) else table
@@ -0,0 +1,570 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from checkpoint import RunCheckpoint
+from chunking import DEFAULT_CHUNK_SIZE
+from criteria import assess_criteria, criteria_metrics_table
+from ingest import file_hash, load_radiomic_data
+from output import TableWriter, write_table
+from profiling import RunProfile
+from recist import (
+    recist_metrics_by_target_count,
+    recist_metrics_from_counts,
+    recist_metrics_replicates,
+    replicate_metrics_table,
+)
+from shared_table import SharedTable
+from streaming import (
+    ConvergenceTracker,
+    MetricAccumulator,
+    simulate_patients,
+    stream_simulation,
+)
+from synthetic_gen import generate_synthetic_patients, select_base_columns
+from target_probability import (
+    expected_metric_counts,
+    expected_replicate_metrics,
+    target_misclassification_probability,
+)
+from version import code_version
+
+logger = logging.getLogger(__name__)
+
+# How a run generates and assesses its patients: one patient at a time, in vectorized chunks kept in memory, or in chunks that
+# are dropped once counted
+SIMULATION_MODES = ['legacy', 'batch', 'stream']
+
+
+def validate_run_options(mode: str = 'batch',
+                         replicates: int = 1,
+                         estimator: str = 'sampled',
+                         tolerance: float | None = None
+                         ) -> None:
+    """Raise a ValueError if the options of a Simulation run cannot be used together."""
+    if mode not in SIMULATION_MODES:
+        message = f"{mode} is not a simulation mode, must be one of {SIMULATION_MODES}."
+        raise ValueError(message)
+    if estimator not in ['sampled', 'expected']:
+        message = f"{estimator} is not an estimator, must be 'sampled' or 'expected'."
+        raise ValueError(message)
+    if tolerance is not None and replicates > 1:
+        message = "Adaptive runs with a tolerance take their confidence intervals from one pooled cohort, so they cannot be used with replicates."
+        raise ValueError(message)
+    if estimator == 'expected' and (mode == 'stream' or tolerance is not None):
+        message = "The expected estimator needs every patient's lesions, so it cannot be used with stream or tolerance."
+        raise ValueError(message)
+
+
+class SimulationResult:
+    """Synthetic lesion and response data of one Simulation run, with the metrics calculated from them.
+
+    synth_lesions and synth_response are None for streamed runs, which only keep the metric counts in accumulators, one
+    MetricAccumulator per criterion. The interval attributes and replicate_metrics are None unless the run had replicates,
+    criteria_metrics is None unless more than one criterion was assessed, target_probability is None unless the expected
+    estimator was used, and convergence is None unless the run had a tolerance.
+    """
+
+    def __init__(self,
+                 dataset_name: str,
+                 synth_lesions: pd.DataFrame | None,
+                 synth_response: pd.DataFrame | None,
+                 accumulators: list[MetricAccumulator],
+                 recist_accuracy: list,
+                 pd_sensitivity: list,
+                 confusion_metrics: pd.DataFrame,
+                 confusion_counts: pd.DataFrame,
+                 profile: RunProfile,
+                 accuracy_interval: tuple | None = None,
+                 sensitivity_interval: tuple | None = None,
+                 replicate_metrics: pd.DataFrame | None = None,
+                 criteria_metrics: pd.DataFrame | None = None,
+                 target_probability: pd.DataFrame | None = None,
+                 convergence: pd.DataFrame | None = None,
+                 checkpoint: RunCheckpoint | None = None
+                 ) -> None:
+        self.dataset_name = dataset_name
+        self.synth_lesions = synth_lesions
+        self.synth_response = synth_response
+        self.accumulators = accumulators
+        self.recist_accuracy = recist_accuracy
+        self.pd_sensitivity = pd_sensitivity
+        self.confusion_metrics = confusion_metrics
+        self.confusion_counts = confusion_counts
+        self.profile = profile
+        self.accuracy_interval = accuracy_interval
+        self.sensitivity_interval = sensitivity_interval
+        self.replicate_metrics = replicate_metrics
+        self.criteria_metrics = criteria_metrics
+        self.target_probability = target_probability
+        self.convergence = convergence
+        self.checkpoint = checkpoint
+
+    def save(self,
+             out_path: Path,
+             output_format: str = 'csv',
+             partition_size: int | None = None
+             ) -> None:
+        """Save the synthetic data, if kept, and every metric table of the run to out_path, named after the dataset."""
+        out_path = Path(out_path)
+        out_path.mkdir(parents=True, exist_ok=True)
+        with self.profile.stage('save'):
+            if self.synth_lesions is not None:
+                logger.info('Saving out the synthetic lesion and response data.')
+                write_table(self.synth_lesions, out_path / f"{self.dataset_name}_synthetic_lesions",
+                            output_format=output_format, partition_size=partition_size)
+                write_table(self.synth_response, out_path / f"{self.dataset_name}_synthetic_patient_response",
+                            output_format=output_format, partition_size=partition_size)
+            if self.target_probability is not None:
+                write_table(self.target_probability, out_path / f"{self.dataset_name}_misclassification_probability", output_format=output_format)
+            if self.replicate_metrics is not None:
+                self.replicate_metrics.to_csv(out_path / f"{self.dataset_name}_replicate_metrics.csv", index=False)
+            if self.criteria_metrics is not None:
+                self.criteria_metrics.to_csv(out_path / f"{self.dataset_name}_criteria_metrics.csv", index=False)
+            self.confusion_metrics.to_csv(out_path / f"{self.dataset_name}_confusion_metrics.csv", index=False)
+            if self.convergence is not None:
+                self.convergence.to_csv(out_path / f"{self.dataset_name}_convergence.csv", index=False)
+            self.confusion_counts.to_csv(out_path / f"{self.dataset_name}_confusion_matrices.csv", index=False)
+        # The saved outputs hold everything in the checkpoint
+        self.remove_checkpoint()
+
+    def remove_checkpoint(self) -> None:
+        """Remove the checkpoint of the completed run, if it was checkpointed."""
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+            self.checkpoint = None
+            logger.info('Removed the run checkpoint.')
+
+    def plot(self,
+             plot_path: Path,
+             plot_mode: str = 'auto',
+             n_jobs: int = -1
+             ) -> None:
+        """Plot the accuracy and PD sensitivity by number of target lesions and, if the lesion data was kept, lesion volume against diameter."""
+        logger.info('Plotting analysis results.')
+        with self.profile.stage('plotting'):
+            # Plotting libraries are only imported when plotting, as they take longer to import than the rest of the pipeline
+            from plot import (
+                PLOT_MODES,
+                draw_vol_vs_diameter,
+                plot_acc_and_sens,
+                plot_pd_sensitivity,
+                plot_recist_accuracy,
+                render_plots,
+                vol_vs_diameter_data,
+            )
+
+            plots = [(plot_recist_accuracy, {'recist_accuracy': self.recist_accuracy,
+                                             'save_path': plot_path,
+                                             'accuracy_interval': self.accuracy_interval}),
+                     (plot_pd_sensitivity, {'pd_sensitivity': self.pd_sensitivity,
+                                            'save_path': plot_path,
+                                            'sensitivity_interval': self.sensitivity_interval}),
+                     (plot_acc_and_sens, {'accuracy': self.recist_accuracy,
+                                          'sensitivity': self.pd_sensitivity,
+                                          'save_path': plot_path,
+                                          'accuracy_interval': self.accuracy_interval,
+                                          'sensitivity_interval': self.sensitivity_interval})]
+            # The lesion data is not kept in memory when streaming
+            if self.synth_lesions is not None:
+                # Large cohorts are binned here so only the bin counts are sent to the plotting workers
+                plots.append((draw_vol_vs_diameter, {**vol_vs_diameter_data(self.synth_lesions, density=PLOT_MODES[plot_mode]),
+                                                     'save_path': plot_path}))
+            # The figures are independent, so they are rendered concurrently and dropped once saved
+            render_plots(plots, n_jobs=n_jobs)
+
+
+class Simulation:
+    """Base radiomic data of one dataset, prepared once, with a persistent worker pool for running many simulations from it.
+
+    The radiomic features file is read, or loaded from the ingest cache, when the Simulation is made. If n_jobs is not 1, the base
+    columns are published once as a SharedTable and a joblib process pool is kept open across runs, so each run only sends the
+    chunk bounds and random streams to workers that already have the data mapped. Runs with the same options and seed give the
+    same results as the pipe command. Call close, or use the Simulation as a context manager, to stop the pool and remove the
+    shared base columns.
+
+    Parameters
+    ----------
+    radiomic_features_filepath: Path
+        Real radiomic feature data with diameter and volume data to generate simulations from.
+    location_label: str = "LABEL"
+        Location column label in the radiomic feature data.
+    n_jobs: int = 1
+        Number of worker processes chunked runs are spread across. -1 uses all available cores.
+    cache_dir: Path | None = None
+        Ingest cache directory, see load_radiomic_data.
+    profile: RunProfile | None = None
+        If given, the ingest stage is recorded in it.
+    pool: object | None = None
+        An entered joblib Parallel with return_as='generator' to run chunks on, shared with other Simulations, such as those of a
+        batch. It is left open by close, as its owner stops it. If None, the Simulation starts its own pool on first use.
+    """
+
+    def __init__(self,
+                 radiomic_features_filepath: Path,
+                 location_label: str = "LABEL",
+                 n_jobs: int = 1,
+                 cache_dir: Path | None = None,
+                 profile: RunProfile | None = None,
+                 pool: object | None = None
+                 ) -> None:
+        self.radiomic_features_filepath = Path(radiomic_features_filepath)
+        self.dataset_name = self.radiomic_features_filepath.parent.stem
+        self.location_label = location_label
+        self.n_jobs = n_jobs
+
+        with (profile or RunProfile()).stage('ingest') as stage:
+            # Load the radiomics data columns needed for simulation, with slice thickness and contoured volume calculated
+            self.radiomic_data = load_radiomic_data(self.radiomic_features_filepath,
+                                                    location_label=location_label,
+                                                    cache_dir=cache_dir)
+            stage['rows'] = len(self.radiomic_data)
+
+        base_columns = select_base_columns(self.radiomic_data, location_label=location_label)
+        self.base_columns = SharedTable(base_columns) if n_jobs != 1 else base_columns
+        self._dataset_hash = None
+        self._pool = pool
+        self._owns_pool = pool is None
+
+    @property
+    def dataset_hash(self) -> str:
+        """Content hash of the radiomic features file, hashed on first use as it is only needed to checkpoint a run."""
+        if self._dataset_hash is None:
+            self._dataset_hash = file_hash(self.radiomic_features_filepath)
+        return self._dataset_hash
+
+    @property
+    def pool(self) -> object | None:
+        """The persistent joblib pool chunked runs use, started on first use, or None if n_jobs is 1."""
+        if self.n_jobs == 1:
+            return None
+        if self._pool is None:
+            # joblib is only imported for parallel runs, keeping serial runs quick to start
+            from joblib import Parallel
+
+            self._pool = Parallel(n_jobs=self.n_jobs, return_as='generator')
+            self._pool.__enter__()
+        return self._pool
+
+    def close(self) -> None:
+        """Stop the worker pool, unless it was given, and remove the shared base columns."""
+        if self._pool is not None and self._owns_pool:
+            self._pool.__exit__(None, None, None)
+            self._pool = None
+        if isinstance(self.base_columns, SharedTable):
+            self.base_columns.remove()
+
+    def __enter__(self) -> 'Simulation':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    def run(self,
+            num_patients: int = 100,
+            expected_num_lesions: int = 10,
+            seed: int | None = None,
+            replicates: int = 1,
+            mode: str = 'batch',
+            criteria: tuple[str, ...] = ('RECIST',),
+            site_mix: dict[str, float] | None = None,
+            chunk_size: int = DEFAULT_CHUNK_SIZE,
+            estimator: str = 'sampled',
+            tolerance: float | None = None,
+            lesion_writer: TableWriter | None = None,
+            response_writer: TableWriter | None = None,
+            checkpoint_dir: Path | None = None,
+            resume: bool = False,
+            profile: RunProfile | None = None
+            ) -> SimulationResult:
+        """Simulate and assess num_patients synthetic patients, or replicates cohorts of them, and calculate their metrics.
+
+        See the pipe command for the meaning of each option.
+
+        Parameters
+        ----------
+        num_patients: int = 100
+            Number of patients per cohort, or the patient budget if tolerance is given.
+        expected_num_lesions: int = 10
+            Expected number of lesions per patient.
+        seed: int | None = None
+            Random seed to initialize the random number generators with.
+        replicates: int = 1
+            Number of independent cohorts of num_patients to simulate.
+        mode: str = 'batch'
+            One of SIMULATION_MODES. 'legacy' always runs in this process, the chunked modes use the worker pool.
+        criteria: tuple[str, ...] = ('RECIST',)
+            Response criteria to assess, RECIST is always assessed.
+        site_mix: dict[str, float] | None = None
+            Share of the synthetic lesions to draw from each location, see parse_site_mix.
+        chunk_size: int = 10000
+            Number of patients per chunk of work for the chunked modes.
+        estimator: str = 'sampled'
+            Whether the RECIST metrics use each patient's one sampled target subset or average over every target subset.
+        tolerance: float | None = None
+            If given, stream chunks until every accuracy and PD sensitivity confidence interval is within this many percentage
+            points. Implies mode 'stream'.
+        lesion_writer: TableWriter | None = None
+            If given with mode 'stream', each chunk's lesion data is appended with it. The caller closes it.
+        response_writer: TableWriter | None = None
+            If given with mode 'stream', each chunk's response data is appended with it. The caller closes it.
+        checkpoint_dir: Path | None = None
+            If given, each finished chunk is saved to a RunCheckpoint in this directory, and a legacy run is chunked like a batch run.
+        resume: bool = False
+            Whether to resume the checkpoint in checkpoint_dir.
+        profile: RunProfile | None = None
+            Profile to record the run's stages in. A new one is made if not given.
+
+        Returns
+        -------
+        SimulationResult
+            The run's synthetic data, metrics and profile.
+        """
+        validate_run_options(mode=mode, replicates=replicates, estimator=estimator, tolerance=tolerance)
+        # RECIST is always assessed, as the plotted metrics are based on it
+        criteria = list(dict.fromkeys(['RECIST', *criteria]))
+        if tolerance is not None:
+            # Adaptive runs stop partway through the budget, so patients are streamed rather than generated up front
+            mode = 'stream'
+        if checkpoint_dir is not None and mode == 'legacy':
+            mode = 'batch'
+        profile = profile if profile is not None else RunProfile()
+        lesion_selection_rng = np.random.default_rng(seed)
+
+        run_checkpoint = None
+        if checkpoint_dir is not None:
+            run_checkpoint, lesion_selection_rng = self._open_checkpoint(checkpoint_dir,
+                                                                         run_options={'num_sim_patients': num_patients,
+                                                                                      'replicates': replicates,
+                                                                                      'expected_num_lesions': expected_num_lesions,
+                                                                                      'location_label': self.location_label,
+                                                                                      'site_mix': site_mix,
+                                                                                      'random_seed': seed,
+                                                                                      'chunk_size': chunk_size,
+                                                                                      'criteria': criteria},
+                                                                         lesion_selection_rng=lesion_selection_rng,
+                                                                         resume=resume)
+
+        # Patients are numbered consecutively, so each block of num_patients is one replicate cohort
+        chunk_options = {'expected_num_lesions': expected_num_lesions,
+                         'location_label': self.location_label,
+                         'max_targets': 10,
+                         'patients_per_replicate': num_patients if replicates > 1 else None,
+                         'n_jobs': self.n_jobs,
+                         'pool': self.pool,
+                         'chunk_size': chunk_size,
+                         'criteria': criteria,
+                         'site_mix': site_mix,
+                         'checkpoint': run_checkpoint}
+
+        accumulators = convergence = synth_lesions = synth_response = None
+        if mode == 'stream':
+            accumulators, convergence = self._stream(num_patients, replicates, lesion_selection_rng, tolerance, lesion_writer, response_writer,
+                                                     profile, chunk_options)
+        elif mode == 'batch':
+            synth_lesions, synth_response = self._simulate_batch(num_patients * replicates, lesion_selection_rng, profile, chunk_options)
+        else:
+            synth_lesions, synth_response = self._simulate_legacy(num_patients * replicates, lesion_selection_rng, profile, chunk_options)
+        logger.info('Finished response assessments.')
+
+        return self._result(synth_lesions, synth_response, accumulators, lesion_selection_rng, num_patients, replicates, estimator, profile,
+                            chunk_options, convergence=convergence, checkpoint=run_checkpoint)
+
+    def _open_checkpoint(self,
+                         checkpoint_dir: Path,
+                         run_options: dict,
+                         lesion_selection_rng: np.random.Generator,
+                         resume: bool = False
+                         ) -> tuple[RunCheckpoint, np.random.Generator]:
+        """Start or resume the RunCheckpoint of a run with run_options, returning it and the random number generator the run continues from."""
+        # Chunks depend on everything that changes the simulated data, but not on how the chunks are run or saved
+        run_config = {'dataset_hash': self.dataset_hash,
+                      'code_version': code_version(),
+                      **run_options}
+        run_checkpoint = RunCheckpoint(checkpoint_dir,
+                                       run_config=run_config,
+                                       seed_entropy=lesion_selection_rng.bit_generator.seed_seq.entropy,
+                                       resume=resume)
+        # Without a random seed, a resumed run continues from the entropy the interrupted run drew
+        return run_checkpoint, np.random.default_rng(run_checkpoint.seed_entropy)
+
+    def _stream(self,
+                num_patients: int,
+                replicates: int,
+                lesion_selection_rng: np.random.Generator,
+                tolerance: float | None,
+                lesion_writer: TableWriter | None,
+                response_writer: TableWriter | None,
+                profile: RunProfile,
+                chunk_options: dict
+                ) -> tuple[list[MetricAccumulator], pd.DataFrame | None]:
+        """Stream the run's chunks into one MetricAccumulator per criterion, returning them and the convergence table if tolerance is given."""
+        logger.info('Streaming synthetic lesion generation and RECIST assessment.')
+        # Generate and assess one chunk of patients at a time, keeping only the running metric counts in memory
+        convergence = ConvergenceTracker(tolerance) if tolerance is not None else None
+        with profile.stage('simulation', rows=num_patients * replicates) as stage:
+            accumulators = stream_simulation(num_sim_patients=num_patients * replicates,
+                                            base_radiomic_data=self.base_columns,
+                                            lesion_selection_rng=lesion_selection_rng,
+                                            accumulator=[MetricAccumulator(max_targets=11, num_replicates=replicates, criterion=criterion)
+                                                         for criterion in chunk_options['criteria']],
+                                            lesion_writer=lesion_writer,
+                                            response_writer=response_writer,
+                                            profile=profile,
+                                            convergence=convergence,
+                                            **chunk_options)
+            stage['rows'] = int(accumulators[0].num_patients.sum())
+        if convergence is None:
+            return accumulators, None
+
+        convergence_table = convergence.table()
+        logger.info(f'Adaptive run simulated {convergence.num_patients} of a budget of {num_patients} patients for a tolerance of ±{tolerance} percentage points.')
+        for point in convergence_table.itertuples():
+            logger.info(f'{point.num_targets} targets: accuracy ±{point.accuracy_half_width:.3f} after {point.accuracy_patients_needed} patients, '
+                        f'PD sensitivity ±{point.pd_sensitivity_half_width:.3f} after {point.pd_sensitivity_patients_needed} patients.')
+        return accumulators, convergence_table
+
+    def _simulate_batch(self,
+                        num_sim_patients: int,
+                        lesion_selection_rng: np.random.Generator,
+                        profile: RunProfile,
+                        chunk_options: dict
+                        ) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Generate and assess the run's patients in chunks kept in memory, returning their lesion and response data."""
+        logger.info('Starting chunked synthetic lesion generation and RECIST assessment.')
+        # Generate and assess chunks of patients in one vectorized pass each
+        with profile.stage('simulation', rows=num_sim_patients):
+            lesion_store, synth_response = simulate_patients(num_sim_patients=num_sim_patients,
+                                                              base_radiomic_data=self.base_columns,
+                                                              lesion_selection_rng=lesion_selection_rng,
+                                                              profile=profile,
+                                                              **chunk_options)
+        with profile.stage('lesion_table', rows=len(lesion_store)):
+            synth_lesions = lesion_store.to_frame()
+        return synth_lesions, synth_response
+
+    def _simulate_legacy(self,
+                         num_sim_patients: int,
+                         lesion_selection_rng: np.random.Generator,
+                         profile: RunProfile,
+                         chunk_options: dict
+                         ) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Generate the run's patients one at a time in this process and assess them in one pass, returning their lesion and response data."""
+        logger.info('Starting synthetic lesion generation.')
+        with profile.stage('generation', rows=num_sim_patients):
+            # Generate lesion measurements for N synthetic patients with 1 to M synthetic lesions based on real lesion data
+            synth_lesions = generate_synthetic_patients(num_sim_patients=num_sim_patients,
+                                                        base_radiomic_data=self.radiomic_data,
+                                                        expected_num_lesions=chunk_options['expected_num_lesions'],
+                                                        location_label=self.location_label,
+                                                        lesion_selection_rng=lesion_selection_rng,
+                                                        site_mix=chunk_options['site_mix'])
+        logger.info('Synthetic lesion generation finished.')
+        logger.info('Performing RECIST assessment of synthetic lesions.')
+        with profile.stage('response_assessment', rows=len(synth_lesions)):
+            # Assess the response category of each synthetic patient under each criterion using all lesions and 1-10 target lesions
+            # per patient (max 2 per location), sweeping over nested target subsets in one pass
+            synth_response = assess_criteria(lesion_data=synth_lesions,
+                                             lesion_selection_rng=lesion_selection_rng,
+                                             criteria=chunk_options['criteria'],
+                                             max_targets=10)
+
+        patients_per_replicate = chunk_options['patients_per_replicate']
+        if patients_per_replicate:
+            synth_lesions['replicate'] = synth_lesions['patient_id'] // patients_per_replicate
+            synth_response['replicate'] = synth_response['patient_id'] // patients_per_replicate
+        return synth_lesions, synth_response
+
+    def _result(self,
+                synth_lesions: pd.DataFrame | None,
+                synth_response: pd.DataFrame | None,
+                accumulators: list[MetricAccumulator] | None,
+                lesion_selection_rng: np.random.Generator,
+                num_patients: int,
+                replicates: int,
+                estimator: str,
+                profile: RunProfile,
+                chunk_options: dict,
+                convergence: pd.DataFrame | None = None,
+                checkpoint: RunCheckpoint | None = None
+                ) -> SimulationResult:
+        """Calculate the metrics of a run from its response data, or from the accumulators of a streamed run, and return its SimulationResult."""
+        logger.info('Calculating accuracy and PD sensitivity.')
+        criteria = chunk_options['criteria']
+        target_probability = criteria_metrics = accuracy_interval = sensitivity_interval = None
+        with profile.stage('metrics', rows=num_patients * replicates):
+            if estimator == 'expected':
+                # Average over target selection for each patient in place of the one sampled target subset
+                target_probability = target_misclassification_probability(lesion_data=synth_lesions,
+                                                                          lesion_selection_rng=lesion_selection_rng,
+                                                                          max_targets=10)
+                recist_accuracy, pd_sensitivity, replicate_metrics = self._expected_metrics(target_probability, replicates,
+                                                                                            chunk_options['patients_per_replicate'])
+            else:
+                recist_accuracy, pd_sensitivity, replicate_metrics = self._sampled_metrics(synth_response, accumulators, replicates)
+            if replicate_metrics is not None:
+                recist_accuracy = replicate_metrics['accuracy_mean'].tolist()
+                pd_sensitivity = replicate_metrics['pd_sensitivity_mean'].tolist()
+                accuracy_interval = (replicate_metrics['accuracy_ci_low'], replicate_metrics['accuracy_ci_high'])
+                sensitivity_interval = (replicate_metrics['pd_sensitivity_ci_low'], replicate_metrics['pd_sensitivity_ci_high'])
+
+            if accumulators is None:
+                accumulators = [MetricAccumulator(max_targets=11, num_replicates=replicates, criterion=criterion) for criterion in criteria]
+                for criterion_accumulator in accumulators:
+                    criterion_accumulator.update(synth_response)
+            # Per category metrics and lesion count stratified confusion matrices of every criterion, pooled over replicates
+            confusion_metrics = pd.concat([criterion_accumulator.confusion_metrics() for criterion_accumulator in accumulators], ignore_index=True)
+            confusion_counts = pd.concat([criterion_accumulator.confusion_counts() for criterion_accumulator in accumulators], ignore_index=True)
+
+            # Pooled accuracy and PD sensitivity of every criterion, compared to its own assessment using all lesions
+            if len(criteria) > 1:
+                criteria_metrics = criteria_metrics_table({criterion_accumulator.criterion: criterion_accumulator.metrics()
+                                                           for criterion_accumulator in accumulators})
+
+        return SimulationResult(dataset_name=self.dataset_name,
+                                synth_lesions=synth_lesions,
+                                synth_response=synth_response,
+                                accumulators=accumulators,
+                                recist_accuracy=recist_accuracy,
+                                pd_sensitivity=pd_sensitivity,
+                                confusion_metrics=confusion_metrics,
+                                confusion_counts=confusion_counts,
+                                profile=profile,
+                                accuracy_interval=accuracy_interval,
+                                sensitivity_interval=sensitivity_interval,
+                                replicate_metrics=replicate_metrics,
+                                criteria_metrics=criteria_metrics,
+                                target_probability=target_probability,
+                                convergence=convergence,
+                                checkpoint=checkpoint)
+
+    @staticmethod
+    def _sampled_metrics(synth_response: pd.DataFrame | None,
+                         accumulators: list[MetricAccumulator] | None,
+                         replicates: int
+                         ) -> tuple[list | None, list | None, pd.DataFrame | None]:
+        """Return the pooled RECIST accuracy and PD sensitivity by number of target lesions, or the replicate metrics if replicates is more than 1.
+
+        The metrics come from synth_response, or from the first accumulator of a streamed run, which keeps no response data.
+        """
+        # Calculate the classification accuracy for RECIST as a function of the number of target lesions
+        if replicates > 1:
+            if synth_response is None:
+                return None, None, replicate_metrics_table(*accumulators[0].replicate_metrics())
+            return None, None, recist_metrics_replicates(patient_response=synth_response, num_replicates=replicates, max_targets=11)
+        if synth_response is None:
+            return *accumulators[0].metrics(), None
+        return *recist_metrics_by_target_count(patient_response=synth_response, max_targets=11), None
+
+    @staticmethod
+    def _expected_metrics(target_probability: pd.DataFrame,
+                          replicates: int,
+                          patients_per_replicate: int | None
+                          ) -> tuple[list | None, list | None, pd.DataFrame | None]:
+        """Return the expected estimator's pooled RECIST accuracy and PD sensitivity, or its replicate metrics if replicates is more than 1."""
+        if replicates > 1:
+            return None, None, replicate_metrics_table(*expected_replicate_metrics(target_probability,
+                                                                                   patients_per_replicate=patients_per_replicate))
+        recist_accuracy, pd_sensitivity = recist_metrics_from_counts(*expected_metric_counts(target_probability))
+        return recist_accuracy.tolist(), pd_sensitivity.tolist(), None
@@ -0,0 +1,408 @@
+from collections.abc import Iterator
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+from checkpoint import RunCheckpoint
+from chunking import DEFAULT_CHUNK_SIZE, chunk_bounds, iter_chunks, spawn_chunk_rngs
+from criteria import assess_criteria
+from lesion_store import LesionStore
+from output import TableWriter
+from profiling import RunProfile, time_stage
+from recist import (
+    MAX_LESION_STRATUM,
+    RECIST_CATEGORIES,
+    confusion_matrices,
+    confusion_matrix_table,
+    confusion_metric_counts,
+    confusion_metrics_table,
+    recist_metrics_from_counts,
+    recist_response_codes,
+)
+from samplers import ChangeSampler, LocationRowSampler
+from shared_table import SharedTable, share_with_workers
+from synthetic_gen import generate_synthetic_lesion_batch, select_base_columns
+
+
+class MetricAccumulator:
+    """Running confusion matrices behind the metrics of a response criterion for each number of target lesions in the range 1 to max_targets.
+
+    Updated one chunk of patient response data at a time, so the metrics for a full cohort can be calculated without holding
+    all of its patients in memory. If num_replicates is more than 1, separate counts are kept for each replicate cohort
+    using the replicate column of the response data. criterion is the name of the response columns to count, see assess_criteria.
+    The counts are the confusion_matrices of each replicate, target count and number of lesions, from which accuracy and PD
+    sensitivity, and the full confusion_metrics_table, are derived.
+    """
+
+    def __init__(self,
+                 max_targets: int = 11,
+                 num_replicates: int = 1,
+                 criterion: str = 'RECIST'
+                 ) -> None:
+        self.criterion = criterion
+        self.target_columns = [f"{criterion} ({num_targets} targets)" for num_targets in range(1, max_targets)]
+        self.num_replicates = num_replicates
+        self.num_patients = np.zeros(num_replicates, dtype=np.int64)
+        # Shape (replicates, targets, lesion count strata, all lesion category, target category), see confusion_matrices
+        self.confusion = np.zeros((num_replicates, max_targets - 1, MAX_LESION_STRATUM + 1, len(RECIST_CATEGORIES), len(RECIST_CATEGORIES)),
+                                  dtype=np.int64)
+
+    def update(self, patient_response: pd.DataFrame) -> None:
+        """Add the counts for a chunk of patient response data with the criterion's all lesion and target lesion columns."""
+        replicates = patient_response['replicate'].to_numpy() if self.num_replicates > 1 else None
+        self.num_patients += np.bincount(np.zeros(len(patient_response), dtype=int) if replicates is None else replicates,
+                                         minlength=self.num_replicates)
+        self.confusion += confusion_matrices(num_lesions=patient_response['num_lesions'].to_numpy(),
+                                             all_response=recist_response_codes(patient_response, [f"{self.criterion} (all)"])[:, 0],
+                                             target_response=recist_response_codes(patient_response, self.target_columns),
+                                             groups=replicates,
+                                             num_groups=self.num_replicates)
+
+    def replicate_metrics(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return accuracy and PD sensitivity arrays of shape (replicates, max_targets - 1) from the counts so far."""
+        return recist_metrics_from_counts(*confusion_metric_counts(self.confusion))
+
+    def metrics(self) -> tuple[list, list]:
+        """Return accuracy and PD sensitivity lists for all patients so far, like recist_metrics_by_target_count."""
+        accuracy, pd_sensitivity = recist_metrics_from_counts(*confusion_metric_counts(self.confusion.sum(axis=0)))
+        return accuracy.tolist(), pd_sensitivity.tolist()
+
+    def confusion_metrics(self) -> pd.DataFrame:
+        """Return the confusion_metrics_table of all patients so far, with the criterion in the first column."""
+        confusion_metrics = confusion_metrics_table(self.confusion.sum(axis=0))
+        confusion_metrics.insert(0, 'criterion', self.criterion)
+        return confusion_metrics
+
+    def confusion_counts(self) -> pd.DataFrame:
+        """Return the confusion_matrix_table of all patients so far, with the criterion in the first column."""
+        confusion_counts = confusion_matrix_table(self.confusion.sum(axis=0))
+        confusion_counts.insert(0, 'criterion', self.criterion)
+        return confusion_counts
+
+    def merge(self, other: 'MetricAccumulator') -> None:
+        """Add the counts of another accumulator with the same max_targets and num_replicates."""
+        self.num_patients += other.num_patients
+        self.confusion += other.confusion
+
+
+def wilson_half_width(successes: np.ndarray,
+                      trials: np.ndarray,
+                      confidence_level: float = 0.95
+                      ) -> np.ndarray:
+    """Half-width in percentage points of the Wilson score confidence interval of each proportion successes / trials, inf where there are no trials.
+
+    Unlike the normal approximation, the Wilson interval does not shrink to nothing when every trial agrees, so a small sample
+    with 100% PD sensitivity is not mistaken for a precise one.
+    """
+    z = NormalDist().inv_cdf((1 + confidence_level) / 2)
+    trials = np.asarray(trials, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        proportion = np.asarray(successes, dtype=float) / trials
+        half_width = z * np.sqrt(proportion * (1 - proportion) / trials + z ** 2 / (4 * trials ** 2)) / (1 + z ** 2 / trials)
+    return np.where(trials > 0, half_width * 100, np.inf)
+
+
+class ConvergenceTracker:
+    """Stopping rule for adaptive runs, checking after each chunk whether every accuracy and PD sensitivity point is precise enough.
+
+    A point has converged once the half-width of its Wilson confidence interval, see wilson_half_width, is at most tolerance
+    percentage points. The number of patients simulated when each point last came within the tolerance is kept, so the run log
+    can show which target counts needed the most patients.
+    """
+
+    def __init__(self,
+                 tolerance: float,
+                 confidence_level: float = 0.95
+                 ) -> None:
+        if tolerance <= 0:
+            message = f"tolerance must be positive, got {tolerance}."
+            raise ValueError(message)
+
+        self.tolerance = tolerance
+        self.confidence_level = confidence_level
+        self.num_patients = 0
+        self.half_widths = None
+        self.patients_needed = None
+
+    def update(self, accumulator: MetricAccumulator) -> bool:
+        """Check the pooled metrics of accumulator after a chunk, returning whether every point has converged."""
+        num_eligible, num_agree, num_progressive, num_detected = confusion_metric_counts(accumulator.confusion.sum(axis=0))
+        self.num_patients = int(accumulator.num_patients.sum())
+        self.half_widths = np.stack([wilson_half_width(num_agree, num_eligible, self.confidence_level),
+                                     wilson_half_width(num_detected, num_progressive, self.confidence_level)])
+
+        converged = self.half_widths <= self.tolerance
+        if self.patients_needed is None:
+            self.patients_needed = np.full(self.half_widths.shape, -1, dtype=np.int64)
+        newly_converged = converged & (self.patients_needed < 0)
+        self.patients_needed[newly_converged] = self.num_patients
+        # A point whose interval widens again is only counted from when it is next within the tolerance
+        self.patients_needed[~converged] = -1
+        return bool(converged.all())
+
+    def table(self) -> pd.DataFrame:
+        """Return the latest half-width of each point and the patients it needed to converge, with NA for points that did not."""
+        return pd.DataFrame({'num_targets': np.arange(1, self.half_widths.shape[1] + 1),
+                             'accuracy_half_width': self.half_widths[0],
+                             'accuracy_patients_needed': pd.array(np.where(self.patients_needed[0] < 0, None, self.patients_needed[0]), dtype='Int64'),
+                             'pd_sensitivity_half_width': self.half_widths[1],
+                             'pd_sensitivity_patients_needed': pd.array(np.where(self.patients_needed[1] < 0, None, self.patients_needed[1]), dtype='Int64')})
+
+
+def simulate_chunk(num_sim_patients: int,
+                   base_radiomic_data: pd.DataFrame | SharedTable,
+                   lesion_selection_rng: np.random.Generator,
+                   expected_num_lesions: int = 10,
+                   max_num_lesions: int = 30,
+                   location_label: str = "LABEL",
+                   first_patient_id: int = 0,
+                   max_targets: int = 10,
+                   patients_per_replicate: int | None = None,
+                   location_labels: np.ndarray | None = None,
+                   criteria: list[str] | None = None,
+                   change_sampler: ChangeSampler | None = None,
+                   row_sampler: LocationRowSampler | None = None
+                   ) -> tuple[LesionStore, pd.DataFrame]:
+    """Generate a chunk of synthetic patients and assess their response using all lesions and 1 to max_targets target lesions.
+
+    Response is assessed with RECIST, or each of the given RESPONSE_CRITERIA, in one pass with assess_criteria.
+    Lesion generation, with diameter changes from change_sampler and base rows from row_sampler, and target lesion selection both draw from lesion_selection_rng. If patients_per_replicate is given,
+    a replicate column is added identifying the cohort of each patient. The lesions are returned as a compact LesionStore using
+    location_labels as its location lookup table, so chunks are cheap to send between processes and to concatenate.
+
+    Returns
+    -------
+    synth_lesions: LesionStore
+        Synthetic lesion data for the chunk, see generate_synthetic_lesion_batch.
+    synth_response: pd.DataFrame
+        Response data for each synthetic patient in the chunk, see assess_criteria.
+    """
+    # Stage timings travel back from worker processes with the response data, see RunProfile.add_chunk_stages
+    stage_records = []
+    with time_stage(stage_records, 'generation', rows=num_sim_patients):
+        synth_lesions = generate_synthetic_lesion_batch(num_sim_patients=num_sim_patients,
+                                                        base_radiomic_data=base_radiomic_data,
+                                                        lesion_selection_rng=lesion_selection_rng,
+                                                        expected_num_lesions=expected_num_lesions,
+                                                        max_num_lesions=max_num_lesions,
+                                                        location_label=location_label,
+                                                        first_patient_id=first_patient_id,
+                                                        change_sampler=change_sampler,
+                                                        row_sampler=row_sampler)
+        if patients_per_replicate:
+            synth_lesions['replicate'] = synth_lesions['patient_id'] // patients_per_replicate
+        synth_lesions = LesionStore.from_frame(synth_lesions, location_labels=location_labels)
+
+    with time_stage(stage_records, 'response_assessment', rows=len(synth_lesions)):
+        synth_response = assess_criteria(lesion_data=synth_lesions,
+                                         lesion_selection_rng=lesion_selection_rng,
+                                         criteria=criteria or ['RECIST'],
+                                         max_targets=max_targets)
+
+    if patients_per_replicate:
+        synth_response['replicate'] = synth_response['patient_id'] // patients_per_replicate
+    synth_response.attrs['stage_records'] = stage_records
+
+    return synth_lesions, synth_response
+
+
+def simulation_chunk_kwargs(num_sim_patients: int,
+                            base_radiomic_data: pd.DataFrame | SharedTable,
+                            lesion_selection_rng: np.random.Generator,
+                            expected_num_lesions: int = 10,
+                            max_num_lesions: int = 30,
+                            location_label: str = "LABEL",
+                            max_targets: int = 10,
+                            patients_per_replicate: int | None = None,
+                            criteria: list[str] | None = None,
+                            change_sampler: ChangeSampler | None = None,
+                            site_mix: dict[str, float] | None = None,
+                            chunk_size: int = DEFAULT_CHUNK_SIZE,
+                            n_jobs: int = 1
+                            ) -> list[dict]:
+    """Split num_sim_patients into chunks of chunk_size, returning the simulate_chunk keyword arguments for each chunk in patient order.
+
+    Each chunk draws from its own random stream spawned from lesion_selection_rng, so the results for a given seed and chunk_size
+    are the same however the chunks are scheduled. If site_mix is given, one LocationRowSampler is built for every chunk to draw
+    base rows to match it. If the chunks are going to a pool of n_jobs worker processes, the base columns are published once as a
+    SharedTable, so each chunk only carries its bounds and random stream. A SharedTable given as base_radiomic_data is used as is.
+    """
+    bounds = chunk_bounds(num_sim_patients, chunk_size)
+    chunk_rngs = spawn_chunk_rngs(lesion_selection_rng, len(bounds))
+    if isinstance(base_radiomic_data, SharedTable):
+        base_columns = base_radiomic_data
+        base_frame = select_base_columns(base_columns.frame(), location_label=location_label)
+    else:
+        base_frame = select_base_columns(base_radiomic_data, location_label=location_label)
+        base_columns = share_with_workers(base_frame, n_jobs=n_jobs, num_chunks=len(bounds))
+    # Share one location lookup table across all chunks
+    location_labels = np.asarray(pd.factorize(base_frame[location_label], sort=True)[1], dtype=object)
+    row_sampler = LocationRowSampler(base_frame[location_label].to_numpy(), site_mix=site_mix) if site_mix else None
+
+    return [{'num_sim_patients': stop - start,
+             'base_radiomic_data': base_columns,
+             'lesion_selection_rng': chunk_rng,
+             'expected_num_lesions': expected_num_lesions,
+             'max_num_lesions': max_num_lesions,
+             'location_label': location_label,
+             'first_patient_id': start,
+             'max_targets': max_targets,
+             'patients_per_replicate': patients_per_replicate,
+             'location_labels': location_labels,
+             'criteria': criteria,
+             'change_sampler': change_sampler,
+             'row_sampler': row_sampler}
+            for (start, stop), chunk_rng in zip(bounds, chunk_rngs, strict=True)]
+
+
+def iter_simulation_chunks(num_sim_patients: int,
+                           base_radiomic_data: pd.DataFrame,
+                           lesion_selection_rng: np.random.Generator,
+                           n_jobs: int = 1,
+                           checkpoint: RunCheckpoint | None = None,
+                           pool: object | None = None,
+                           **chunk_options: object
+                           ) -> Iterator[tuple[LesionStore, pd.DataFrame]]:
+    """Lazily simulate num_sim_patients in chunks with simulate_chunk, yielding the (synth_lesions, synth_response) of each chunk in patient order.
+
+    The chunks are those of simulation_chunk_kwargs, so the results are the same whether chunks run serially or across n_jobs
+    worker processes, and whether they are kept or streamed. If checkpoint is given, chunks it already holds are loaded from it
+    rather than simulated, and every newly simulated chunk is saved to it before being yielded. If pool is given, a persistent
+    joblib pool such as that of a Simulation, the chunks run on its workers, see iter_chunks.
+    """
+    chunk_kwargs = simulation_chunk_kwargs(num_sim_patients=num_sim_patients,
+                                           base_radiomic_data=base_radiomic_data,
+                                           lesion_selection_rng=lesion_selection_rng,
+                                           n_jobs=n_jobs,
+                                           **chunk_options)
+    # Progress is reported per chunk so it costs nothing per patient, and is hidden when not writing to a terminal. tqdm is imported
+    # here so worker processes that only count chunks, like those of a sweep, never import it.
+    from tqdm import tqdm
+
+    if checkpoint is None:
+        chunks = iter_chunks(simulate_chunk, chunk_kwargs, n_jobs=n_jobs if len(chunk_kwargs) > 1 else 1, pool=pool)
+    else:
+        chunks = checkpointed_chunks(checkpoint, chunk_kwargs, n_jobs=n_jobs, pool=pool)
+
+    return tqdm(chunks,
+                desc="Simulating synthetic patients...",
+                total=len(chunk_kwargs),
+                unit='chunk',
+                disable=None)
+
+
+def checkpointed_chunks(checkpoint: RunCheckpoint,
+                        chunk_kwargs: list[dict],
+                        n_jobs: int = 1,
+                        pool: object | None = None
+                        ) -> Iterator[tuple[LesionStore, pd.DataFrame]]:
+    """Yield the (synth_lesions, synth_response) of each chunk in order, loading finished chunks from checkpoint and simulating the rest."""
+    finished = [checkpoint.is_finished(index, kwargs['lesion_selection_rng']) for index, kwargs in enumerate(chunk_kwargs)]
+    pending = [kwargs for kwargs, is_finished in zip(chunk_kwargs, finished, strict=True) if not is_finished]
+    # The pending chunks are simulated in order, so each result lines up with the next unfinished chunk
+    simulated = iter_chunks(simulate_chunk, pending, n_jobs=n_jobs if len(pending) > 1 else 1, pool=pool)
+
+    for index, kwargs in enumerate(chunk_kwargs):
+        if finished[index]:
+            yield checkpoint.load(index, location_labels=kwargs['location_labels'])
+        else:
+            synth_lesions, synth_response = next(simulated)
+            checkpoint.save(index, kwargs['lesion_selection_rng'], synth_lesions, synth_response)
+            yield synth_lesions, synth_response
+
+
+def count_chunk(num_replicates: int = 1,
+                **chunk_kwargs: object
+                ) -> MetricAccumulator:
+    """Simulate one chunk with simulate_chunk and return only its metric counts for 1 to max_targets target lesions, dropping the lesion and response data."""
+    accumulator = MetricAccumulator(max_targets=chunk_kwargs.get('max_targets', 10) + 1, num_replicates=num_replicates)
+    accumulator.update(simulate_chunk(**chunk_kwargs)[1])
+    return accumulator
+
+
+def simulate_patients(num_sim_patients: int,
+                      base_radiomic_data: pd.DataFrame,
+                      lesion_selection_rng: np.random.Generator,
+                      profile: RunProfile | None = None,
+                      **chunk_options: object
+                      ) -> tuple[LesionStore, pd.DataFrame]:
+    """Simulate and assess num_sim_patients in memory, concatenating the chunks from iter_simulation_chunks.
+
+    If profile is given, the stage timings of each chunk are added to it.
+    Returns the synthetic lesion data for every patient as a LesionStore (see LesionStore.to_frame) and their patient response data.
+    """
+    chunks = list(iter_simulation_chunks(num_sim_patients=num_sim_patients,
+                                         base_radiomic_data=base_radiomic_data,
+                                         lesion_selection_rng=lesion_selection_rng,
+                                         **chunk_options))
+    for _, response in chunks:
+        stage_records = response.attrs.pop('stage_records', [])
+        if profile is not None:
+            profile.add_chunk_stages(stage_records)
+    synth_lesions = LesionStore.concat([lesions for lesions, _ in chunks])
+    synth_response = pd.concat([response for _, response in chunks], ignore_index=True)
+    return synth_lesions, synth_response
+
+
+def stream_simulation(num_sim_patients: int,
+                      base_radiomic_data: pd.DataFrame,
+                      lesion_selection_rng: np.random.Generator,
+                      accumulator: MetricAccumulator | list[MetricAccumulator],
+                      lesion_writer: TableWriter | None = None,
+                      response_writer: TableWriter | None = None,
+                      profile: RunProfile | None = None,
+                      convergence: ConvergenceTracker | None = None,
+                      **chunk_options: object
+                      ) -> MetricAccumulator | list[MetricAccumulator]:
+    """Simulate and assess num_sim_patients one chunk at a time, updating accumulator with each chunk before dropping it.
+
+    Peak memory is bounded by the chunk size rather than the number of patients. The final metrics match those of simulate_patients
+    with the same seed and chunk size. If convergence is given, the run stops early after the first chunk at which the metrics
+    of the first accumulator have all converged, so num_sim_patients is a budget, and the patients simulated match the first
+    patients of a full run.
+
+    Parameters
+    ----------
+    num_sim_patients: int
+        Number of patients to simulate.
+    base_radiomic_data: pd.DataFrame
+        Ground truth radiomic data to base simulations on.
+    lesion_selection_rng: np.random.Generator
+        Random number generator to spawn the chunk random streams from.
+    accumulator: MetricAccumulator | list[MetricAccumulator]
+        Running metric counts to update with each chunk, or a list of them, for example one per response criterion.
+    lesion_writer: TableWriter | None = None
+        If given, each chunk's synthetic lesion data is appended with this writer.
+    response_writer: TableWriter | None = None
+        If given, each chunk's patient response data is appended with this writer.
+    profile: RunProfile | None = None
+        If given, the stage timings of each chunk are added to it.
+    convergence: ConvergenceTracker | None = None
+        If given, updated with the first accumulator after each chunk to decide whether to stop.
+    **chunk_options
+        Other keyword arguments passed to iter_simulation_chunks.
+
+    Returns
+    -------
+    MetricAccumulator | list[MetricAccumulator]
+        The updated accumulator or accumulators.
+    """
+    for synth_lesions, synth_response in iter_simulation_chunks(num_sim_patients=num_sim_patients,
+                                                                base_radiomic_data=base_radiomic_data,
+                                                                lesion_selection_rng=lesion_selection_rng,
+                                                                **chunk_options):
+        stage_records = synth_response.attrs.pop('stage_records', [])
+        for chunk_accumulator in accumulator if isinstance(accumulator, list) else [accumulator]:
+            chunk_accumulator.update(synth_response)
+
+        with time_stage(stage_records, 'save', rows=len(synth_lesions)):
+            if lesion_writer is not None:
+                lesion_writer.write(synth_lesions.to_frame())
+            if response_writer is not None:
+                response_writer.write(synth_response)
+        if profile is not None:
+            profile.add_chunk_stages(stage_records)
+        if convergence is not None and convergence.update(accumulator[0] if isinstance(accumulator, list) else accumulator):
+            break
+
+    return accumulator
@@ -0,0 +1,247 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+from chunking import DEFAULT_CHUNK_SIZE, chunk_bounds
+from damply import dirs
+from ingest import file_hash, load_radiomic_data
+from recist import replicate_metrics_table
+from shared_table import share_with_workers
+from streaming import MetricAccumulator, count_chunk, simulation_chunk_kwargs
+from synthetic_gen import select_base_columns
+from version import code_version
+
+logger = logging.getLogger(__name__)
+
+# Grid spec keys that can take a list of values to sweep over, with the value used when a key is left out
+GRID_DEFAULTS = {'num_sim_patients': 100,
+                 'expected_num_lesions': 10,
+                 'random_seed': 0,
+                 'replicates': 1}
+
+
+def grid_cells(grid_spec: dict) -> list[dict]:
+    """Expand a grid spec into the list of cells to simulate, one per combination of dataset and GRID_DEFAULTS values.
+
+    grid_spec must have a datasets list of radiomic feature file paths. Each GRID_DEFAULTS key can be a single value or a list,
+    and location_label and chunk_size are shared by every cell.
+    """
+    if not grid_spec.get('datasets'):
+        message = "The grid spec must list at least one radiomic features file under datasets."
+        raise ValueError(message)
+
+    values = {key: grid_spec.get(key, default) for key, default in GRID_DEFAULTS.items()}
+    values = {key: value if isinstance(value, list) else [value] for key, value in values.items()}
+
+    cells = []
+    for dataset, *combination in itertools.product(grid_spec['datasets'], *values.values()):
+        cells.append({'dataset': str(dataset),
+                      **dict(zip(values, combination, strict=True)),
+                      'location_label': grid_spec.get('location_label', "LABEL"),
+                      'chunk_size': grid_spec.get('chunk_size', DEFAULT_CHUNK_SIZE)})
+    return cells
+
+
+def cell_key(cell: dict,
+             dataset_hash: str,
+             version: str
+             ) -> str:
+    """Return the cache key of a cell from the content hash of its dataset, its parameters, seed and the code version."""
+    params = {key: value for key, value in cell.items() if key != 'dataset'}
+    key_data = json.dumps({'dataset_hash': dataset_hash, 'params': params, 'code_version': version}, sort_keys=True)
+    return hashlib.sha256(key_data.encode()).hexdigest()[:16]
+
+
+def load_cell(cache_file: Path) -> MetricAccumulator | None:
+    """Load the confusion matrix counts of a cached cell, or None if the cell has not been computed."""
+    if not cache_file.exists():
+        return None
+
+    cached = json.loads(cache_file.read_text())
+    confusion = np.asarray(cached['confusion'], dtype=np.int64)
+    accumulator = MetricAccumulator(max_targets=confusion.shape[1] + 1, num_replicates=confusion.shape[0])
+    accumulator.num_patients[:] = cached['num_patients']
+    accumulator.confusion[:] = confusion
+    return accumulator
+
+
+def save_cell(cache_file: Path,
+              cell: dict,
+              accumulator: MetricAccumulator
+              ) -> None:
+    """Save the confusion matrix counts of a finished cell, written to a temporary file first so an interrupted sweep never leaves a partial cell."""
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    partial_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+    partial_file.write_text(json.dumps({'cell': cell,
+                                        'num_patients': accumulator.num_patients.tolist(),
+                                        'confusion': accumulator.confusion.tolist()}))
+    partial_file.replace(cache_file)
+
+
+def cell_results(cell: dict,
+                 accumulator: MetricAccumulator
+                 ) -> pd.DataFrame:
+    """Tabulate the metrics of a cell, one row per number of target lesions.
+
+    accuracy and pd_sensitivity are pooled over all of the cell's patients, the replicate statistics are those of replicate_metrics_table.
+    """
+    results = replicate_metrics_table(*accumulator.replicate_metrics())
+    accuracy, pd_sensitivity = accumulator.metrics()
+    results.insert(1, 'accuracy', accuracy)
+    results.insert(2, 'pd_sensitivity', pd_sensitivity)
+
+    cell_columns = {'dataset': Path(cell['dataset']).parent.stem, **{key: cell[key] for key in GRID_DEFAULTS}}
+    return pd.concat([pd.DataFrame(cell_columns, index=results.index), results], axis=1)
+
+
+def count_cell_chunk(index: int,
+                     num_replicates: int,
+                     chunk_kwargs: dict
+                     ) -> tuple[int, MetricAccumulator]:
+    """Return the metric counts of one chunk of a sweep cell with the cell's index, see streaming.count_chunk."""
+    return index, count_chunk(num_replicates=num_replicates, **chunk_kwargs)
+
+
+def run_sweep(grid_spec: dict,
+              cache_dir: Path,
+              n_jobs: int = -1,
+              cache_ingest: bool = True
+              ) -> pd.DataFrame:
+    """Simulate every cell of a grid spec that is not already cached and return the consolidated results of all cells.
+
+    The chunks of all missing cells are scheduled on one shared process pool, and each cell's metric counts are saved to
+    cache_dir as soon as its last chunk finishes. Cells with a random_seed of None are not reproducible, so they are always
+    simulated and never cached. Each dataset is loaded once and, if there is more than one chunk and n_jobs is not 1, its base
+    columns are published to the workers once as a SharedTable. The chunks match those of pipe with the same random seed and
+    chunk size, so a cell's metrics match a streamed pipe run.
+
+    Parameters
+    ----------
+    grid_spec: dict
+        Datasets and parameter values to sweep over, see grid_cells.
+    cache_dir: Path
+        Directory holding the cached cells, keyed by cell_key.
+    n_jobs: int = -1
+        Number of worker processes in the shared pool. -1 uses all available cores.
+    cache_ingest: bool = True
+        Whether to cache the prepared radiomic data, see ingest.load_radiomic_data.
+
+    Returns
+    -------
+    pd.DataFrame
+        Results of every cell, see cell_results.
+    """
+    cells = grid_cells(grid_spec)
+    version = code_version()
+    dataset_hashes = {dataset: file_hash(dataset) for dataset in dict.fromkeys(cell['dataset'] for cell in cells)}
+    # Unseeded cells draw fresh random streams on every run, so they are never read from or written to the cache
+    cache_files = [Path(cache_dir) / f"{cell_key(cell, dataset_hashes[cell['dataset']], version)}.json" if cell['random_seed'] is not None else None
+                   for cell in cells]
+
+    accumulators = [load_cell(cache_file) if cache_file is not None else None for cache_file in cache_files]
+    missing = [index for index, accumulator in enumerate(accumulators) if accumulator is None]
+    logger.info(f'{len(cells) - len(missing)} of {len(cells)} sweep cells found in the cache.')
+
+    # A process pool is only started if there is more than one chunk to spread across workers
+    num_chunks = sum(len(chunk_bounds(cells[index]['num_sim_patients'] * cells[index]['replicates'], cells[index]['chunk_size'])) for index in missing)
+    n_jobs = n_jobs if num_chunks > 1 else 1
+
+    rad_data = {}
+    tasks = []
+    remaining_chunks = {}
+    for index in missing:
+        cell = cells[index]
+        if cell['dataset'] not in rad_data:
+            # With a process pool, each dataset's base columns are published once for every worker and cell, rather than pickled into every chunk
+            rad_data[cell['dataset']] = share_with_workers(select_base_columns(load_radiomic_data(cell['dataset'],
+                                                                                                 location_label=cell['location_label'],
+                                                                                                 cache_dir=dirs.PROCDATA / "radiomic_cache" if cache_ingest else None),
+                                                                               location_label=cell['location_label']),
+                                                           n_jobs=n_jobs,
+                                                           num_chunks=num_chunks)
+        # Patients are numbered consecutively, so each block of num_sim_patients is one replicate cohort
+        chunk_kwargs = simulation_chunk_kwargs(num_sim_patients=cell['num_sim_patients'] * cell['replicates'],
+                                               base_radiomic_data=rad_data[cell['dataset']],
+                                               lesion_selection_rng=np.random.default_rng(cell['random_seed']),
+                                               expected_num_lesions=cell['expected_num_lesions'],
+                                               location_label=cell['location_label'],
+                                               max_targets=10,
+                                               patients_per_replicate=cell['num_sim_patients'] if cell['replicates'] > 1 else None,
+                                               chunk_size=cell['chunk_size'])
+        tasks.extend((index, kwargs) for kwargs in chunk_kwargs)
+        remaining_chunks[index] = len(chunk_kwargs)
+        accumulators[index] = MetricAccumulator(max_targets=11, num_replicates=cell['replicates'])
+
+    from joblib import Parallel, delayed
+
+    # Chunks of every cell share the pool and come back in whatever order they finish
+    results = Parallel(n_jobs=n_jobs, return_as='generator_unordered')(delayed(count_cell_chunk)(index, cells[index]['replicates'], kwargs)
+                                                                          for index, kwargs in tasks)
+    for index, chunk_accumulator in results:
+        accumulators[index].merge(chunk_accumulator)
+        remaining_chunks[index] -= 1
+        if remaining_chunks[index] == 0 and cache_files[index] is not None:
+            save_cell(cache_files[index], cells[index], accumulators[index])
+            logger.info(f'Finished sweep cell {cells[index]}.')
+
+    return pd.concat([cell_results(cell, accumulator) for cell, accumulator in zip(cells, accumulators, strict=True)], ignore_index=True)
+
+
+@click.command()
+@click.argument('grid_spec_filepath', type=click.Path(exists=True))
+@click.option('--n_jobs', type=click.INT, default=-1, help="Number of worker processes in the shared pool. -1 uses all available cores.")
+@click.option('--cache_ingest', type=click.BOOL, default=True, help="Whether to cache the prepared radiomic data in data/procdata for faster repeat runs.")
+def sweep(grid_spec_filepath: str,
+          n_jobs: int = -1,
+          cache_ingest: bool = True
+          ) -> pd.DataFrame:
+    """Retiring the Ruler parameter sweep
+
+       Run the simulation pipeline over a grid of datasets, expected lesion counts, patient counts, replicates and random seeds.
+
+    Parameters
+    ----------
+    grid_spec_filepath: str
+        JSON file with the grid to sweep over, for example
+        {"datasets": ["data/rawdata/A/features.csv"], "num_sim_patients": [1000, 10000], "expected_num_lesions": [5, 10], "random_seed": [1, 2, 3]}.
+        num_sim_patients, expected_num_lesions, random_seed and replicates can each be a single value or a list, and
+        location_label and chunk_size apply to every cell.
+    n_jobs: int = -1
+        Number of worker processes in the shared pool. -1 uses all available cores.
+    cache_ingest: bool = True
+        Whether to cache the prepared radiomic data in data/procdata/radiomic_cache.
+
+    Returns
+    -------
+    pd.DataFrame
+        Consolidated accuracy and PD sensitivity of every cell for 1 to 10 target lesions, saved to data/results/sweeps.
+        Cell metric counts are cached in data/procdata/sweep_cache, so a rerun only simulates cells that are new or whose
+        dataset or simulation code has changed.
+    """
+    grid_name = Path(grid_spec_filepath).stem
+
+    logging.basicConfig(filename=dirs.LOGS / f'sweep_{grid_name}.log', level=logging.INFO, format='%(asctime)s %(message)s')
+    logger.info(f'Retiring the Ruler parameter sweep started for {grid_name}')
+
+    grid_spec = json.loads(Path(grid_spec_filepath).read_text())
+    results = run_sweep(grid_spec,
+                        cache_dir=dirs.PROCDATA / "sweep_cache",
+                        n_jobs=n_jobs,
+                        cache_ingest=cache_ingest)
+
+    results_path = dirs.RESULTS / "sweeps"
+    results_path.mkdir(parents=True, exist_ok=True)
+    results.to_csv(results_path / f"{grid_name}_results.csv", index=False)
+    logger.info('Parameter sweep finished.')
+
+    return results
+
+
+if __name__ == '__main__':
+    sweep()
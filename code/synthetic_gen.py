@@ -1,15 +1,34 @@
+from typing import TYPE_CHECKING
+
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
-from scipy.stats import rv_continuous, truncnorm
-from tqdm import tqdm
+from chunking import DEFAULT_CHUNK_SIZE, chunk_bounds, map_chunks, spawn_chunk_rngs
+from samplers import DEFAULT_CHANGE_SAMPLER, ChangeSampler, LocationRowSampler
+from shared_table import SharedTable, share_with_workers, table_frame
+
+if TYPE_CHECKING:
+    from scipy.stats import rv_continuous
+
+# Radiomic feature columns each synthetic lesion's measurements are taken from
+BASE_FEATURE_COLUMNS = ['original_shape_Maximum2DDiameterSlice',
+                        'volume_cc_contoured',
+                        'original_shape_Maximum3DDiameter',
+                        'original_shape_MajorAxisLength',
+                        'original_shape_MinorAxisLength']
+
+# Sphere-derived volume columns of the synthetic lesion data and the diameter column each is calculated from
+DERIVED_VOLUME_COLUMNS = {'volume_cc_pre': 'diameter_pre',
+                          'volume_cc_post': 'diameter_post',
+                          'volume_cc_3Dmax': 'diameter_3D_max',
+                          'volume_cc_majorAx': 'diameter_major_ax',
+                          'volume_cc_minorAx': 'diameter_minor_ax'}
 
 
 def truncate_normal_distribution(low_end: int = -1,
                                  high_end: int = 3,
                                  mean: float = 0,
                                  std_dev: float = 0.3
-                                 ) -> rv_continuous:
+                                 ) -> "rv_continuous":
     """Generate a truncated normal distribution.
 
     Parameters
@@ -28,6 +47,9 @@ def truncate_normal_distribution(low_end: int = -1,
     rv_continuous instance
         A truncated normal continuous random variable.
     """
+    # scipy.stats takes longer to import than the rest of the pipeline, so it is only imported once a distribution is needed
+    from scipy.stats import truncnorm
+
     return truncnorm((low_end - mean) / std_dev, (high_end - mean) / std_dev, loc=mean, scale=std_dev)
 
 
@@ -36,13 +58,137 @@ def volume_calc(diameter:float) -> float:
     return (4/3 * np.pi * (diameter/2)**3) / 1000
 
 
+def select_base_columns(base_radiomic_data: pd.DataFrame,
+                        location_label: str = "LABEL"
+                        ) -> pd.DataFrame:
+    """Select only the radiomic feature columns used to generate synthetic lesions, so less data is copied to worker processes."""
+    if location_label not in base_radiomic_data.columns:
+        message = f"{location_label} is not a column name in the provided radiomic data."
+        raise ValueError(message)
+
+    return base_radiomic_data[[*BASE_FEATURE_COLUMNS, location_label]]
+
+
+def add_lesion_volumes(lesion_data: pd.DataFrame) -> pd.DataFrame:
+    """Add the sphere-derived volume columns to synthetic lesion data, calculated from each diameter measurement."""
+    for volume_column, diameter_column in DERIVED_VOLUME_COLUMNS.items():
+        lesion_data[volume_column] = volume_calc(lesion_data[diameter_column])
+    return lesion_data
+
+
+def draw_lesion_counts(num_sim_patients: int,
+                       lesion_selection_rng: np.random.Generator,
+                       expected_num_lesions: int = 10,
+                       max_num_lesions: int = 30
+                       ) -> np.ndarray:
+    """Draw the number of lesions for each patient from a Poisson distribution, redrawing any counts outside of 1 to max_num_lesions."""
+    lesion_counts = lesion_selection_rng.poisson(expected_num_lesions, size=num_sim_patients)
+
+    # Same rejection rule as generate_synthetic_lesions, applied to every patient at once
+    redraw = (lesion_counts < 1) | (lesion_counts > max_num_lesions)
+    while redraw.any():
+        lesion_counts[redraw] = lesion_selection_rng.poisson(expected_num_lesions, size=np.sum(redraw))
+        redraw = (lesion_counts < 1) | (lesion_counts > max_num_lesions)
+
+    return lesion_counts
+
+
+def generate_synthetic_lesion_batch(num_sim_patients: int,
+                                    base_radiomic_data: pd.DataFrame | SharedTable,
+                                    lesion_selection_rng: np.random.Generator,
+                                    expected_num_lesions: int = 10,
+                                    max_num_lesions: int = 30,
+                                    location_label: str = "LABEL",
+                                    first_patient_id: int = 0,
+                                    change_sampler: ChangeSampler | None = None,
+                                    row_sampler: LocationRowSampler | None = None
+                                    ) -> pd.DataFrame:
+    """
+    Generate synthetic lesion measurement data for a batch of patients in one vectorized pass.
+
+    Draws every patient's lesion count, every base radiomic row and every diameter change at once, then
+    gathers the lesion measurements with NumPy indexing. Produces the same lesion table as
+    generate_synthetic_patients, with all values drawn from lesion_selection_rng.
+
+    Parameters
+    ----------
+    num_sim_patients: int
+        Number of patients to generate lesions for.
+    base_radiomic_data: pd.DataFrame | SharedTable
+        Ground truth radiomic data to base simulations on. Must contain the same columns as required by generate_synthetic_lesions.
+        Worker processes are sent a SharedTable, which they map rather than unpickle.
+    lesion_selection_rng: np.random.Generator
+        Random number generator to use for synthetic lesion creation.
+    expected_num_lesions: int = 10
+        Expected number of lesions to use for poisson distribution
+    max_num_lesions: int = 30
+        Maximum number of lesions a patient can have.
+    location_label: str = "LABEL"
+        Name of tumour location label in the radiomic feature data.
+    first_patient_id: int = 0
+        Patient ID to assign to the first patient in the batch, subsequent patients are numbered consecutively.
+    change_sampler: ChangeSampler | None = None
+        Distribution of the diameter changes. If None, DEFAULT_CHANGE_SAMPLER, a normal distribution with mean 0 and standard
+        deviation 0.3 truncated to -1 to 3.
+    row_sampler: LocationRowSampler | None = None
+        Precomputed sampler of base radiomic rows for the lesions, built from base_radiomic_data, to draw them with a site mix.
+        If None, rows are drawn uniformly.
+
+    Returns
+    -------
+    pd.DataFrame
+        DataFrame of synthetic lesion measurement data, sorted by patient ID.
+    """
+    base_radiomic_data = table_frame(base_radiomic_data)
+    if location_label not in base_radiomic_data.columns:
+        message = f"{location_label} is not a column name in the provided radiomic data."
+        raise ValueError(message)
+
+    lesion_counts = draw_lesion_counts(num_sim_patients=num_sim_patients,
+                                       lesion_selection_rng=lesion_selection_rng,
+                                       expected_num_lesions=expected_num_lesions,
+                                       max_num_lesions=max_num_lesions)
+    num_lesions = int(np.sum(lesion_counts))
+
+    # Label each lesion with its patient and its position within that patient
+    patient_id = np.repeat(np.arange(first_patient_id, first_patient_id + num_sim_patients), lesion_counts)
+    patient_starts = np.cumsum(lesion_counts) - lesion_counts
+    lesion_idx = np.arange(num_lesions) - np.repeat(patient_starts, lesion_counts)
+
+    # Select a random base row for every lesion
+    if row_sampler is None:
+        base_rows = lesion_selection_rng.integers(0, len(base_radiomic_data), size=num_lesions)
+    else:
+        base_rows = row_sampler.sample(lesion_selection_rng, num_lesions)
+
+    # Generate diameter change for every lesion
+    diameter_change = (change_sampler or DEFAULT_CHANGE_SAMPLER).sample(lesion_selection_rng, num_lesions)
+
+    diameter_pre = base_radiomic_data['original_shape_Maximum2DDiameterSlice'].to_numpy()[base_rows]
+
+    synthetic_lesions = pd.DataFrame({'patient_id': patient_id,
+                                      'lesion_idx': lesion_idx,
+                                      'diameter_pre': diameter_pre,
+                                      'diameter_change': diameter_change,
+                                      'diameter_post': diameter_pre + diameter_pre * diameter_change,
+                                      'location': base_radiomic_data[location_label].to_numpy()[base_rows],
+                                      'volume_cc_contoured': base_radiomic_data['volume_cc_contoured'].to_numpy()[base_rows],
+                                      'diameter_3D_max': base_radiomic_data['original_shape_Maximum3DDiameter'].to_numpy()[base_rows],
+                                      'diameter_major_ax': base_radiomic_data['original_shape_MajorAxisLength'].to_numpy()[base_rows],
+                                      'diameter_minor_ax': base_radiomic_data['original_shape_MinorAxisLength'].to_numpy()[base_rows]})
+
+    return add_lesion_volumes(synthetic_lesions)
+
+
 def generate_synthetic_lesions(base_radiomic_data: pd.DataFrame,
                                lesion_selection_rng: np.random.Generator,
                                expected_num_lesions: int = 10,
                                max_num_lesions: int = 30,
                                patient_id: int | str = 0,
                                location_label: str = "LABEL",
-                               random_seed: int | None = None,
+                               change_sampler: ChangeSampler | None = None,
+                               draw_changes: bool = True,
+                               row_sampler: LocationRowSampler | None = None
                                ) -> pd.DataFrame:
     """
     Generate synthetic lesion measurement data. 
@@ -65,8 +211,13 @@ def generate_synthetic_lesions(base_radiomic_data: pd.DataFrame,
         Patient ID to label all these lesions with
     location_label: str
         Name of tumour location label in the radiomic feature data.
-    random_seed: int | None = None
-        Seed to use for diameter change value selection for reproducibility.
+    change_sampler: ChangeSampler | None = None
+        Distribution of the diameter changes, drawn from lesion_selection_rng. If None, DEFAULT_CHANGE_SAMPLER.
+    draw_changes: bool = True
+        Whether to draw the diameter changes. If False, diameter_change and diameter_post are left as NaN so the changes of
+        many patients can be drawn in one batch, see apply_diameter_changes.
+    row_sampler: LocationRowSampler | None = None
+        Precomputed sampler of base radiomic rows, to draw the lesions with a site mix. If None, rows are drawn uniformly.
     
     Returns
     -------
@@ -82,18 +233,24 @@ def generate_synthetic_lesions(base_radiomic_data: pd.DataFrame,
     while n_lesions < 1 or n_lesions > max_num_lesions:
         n_lesions = lesion_selection_rng.poisson(expected_num_lesions)
 
-    # Generated truncated normal distribution setup - used for diameter change
-    diameter_change_dist = truncate_normal_distribution(low_end=-1,
-                                                        high_end=3,
-                                                        mean=0,
-                                                        std_dev=0.3)
-    diameter_change_list = diameter_change_dist.rvs(size=n_lesions, random_state=random_seed)
+    # Diameter change of each lesion
+    if draw_changes:
+        diameter_change_list = (change_sampler or DEFAULT_CHANGE_SAMPLER).sample(lesion_selection_rng, n_lesions)
+    else:
+        diameter_change_list = np.full(n_lesions, np.nan)
+
+    # Select a random base row for every lesion at once, the same draws as one choice over the index per lesion
+    if row_sampler is None:
+        base_rows = lesion_selection_rng.integers(0, len(base_radiomic_data), size=n_lesions)
+    else:
+        base_rows = row_sampler.sample(lesion_selection_rng, n_lesions)
+    base_index = base_radiomic_data.index[base_rows]
+
     # Initialize dictionary to hold lesion data
     lesion_data = {}
     
     for lesion_idx in range(n_lesions):
-        # Select a random index
-        ind = lesion_selection_rng.choice(base_radiomic_data.index)
+        ind = base_index[lesion_idx]
 
         # Generate diameter (pre-treatment)
         diameter_pre = base_radiomic_data['original_shape_Maximum2DDiameterSlice'][ind]
@@ -134,55 +291,86 @@ def generate_synthetic_lesions(base_radiomic_data: pd.DataFrame,
 
 
 
+def apply_diameter_changes(lesion_data: pd.DataFrame, diameter_change: np.ndarray) -> pd.DataFrame:
+    """Set the diameter_change of each lesion and the diameter_post it gives."""
+    lesion_data['diameter_change'] = diameter_change
+    lesion_data['diameter_post'] = lesion_data['diameter_pre'] + lesion_data['diameter_pre'] * diameter_change
+    return lesion_data
+
+
 def generate_synthetic_patients(num_sim_patients: int, 
                                 base_radiomic_data: pd.DataFrame,
                                 lesion_selection_rng: np.random.Generator,
                                 expected_num_lesions: int = 10,
                                 max_num_lesions: int = 30,
                                 location_label: str = "LABEL",
-                                random_seed: int | None = None,
-                                parallel: bool = False
+                                change_sampler: ChangeSampler | None = None,
+                                site_mix: dict[str, float] | None = None,
+                                parallel: bool = False,
+                                batch: bool = False,
+                                n_jobs: int = -1,
+                                chunk_size: int = DEFAULT_CHUNK_SIZE
                                 ) -> pd.DataFrame:
-    """Generate synthetic patient lesion data from an existing dataset"""
-    if parallel:
-        synth_lesion_list = Parallel()(
-            delayed(generate_synthetic_lesions)(
-                base_radiomic_data=base_radiomic_data,
-                expected_num_lesions=expected_num_lesions,
-                max_num_lesions=max_num_lesions,
-                patient_id=pat_idx,
-                location_label=location_label,
-                lesion_selection_rng=lesion_selection_rng,
-                random_seed=pat_idx if random_seed else None
-            )
-            for pat_idx in tqdm(range(num_sim_patients),
-                                desc="Generating synthetic lesion data...",
-                                total=num_sim_patients)
+    """Generate synthetic patient lesion data from an existing dataset.
+    
+       If batch or parallel is True, patients are split into chunks of chunk_size that are each generated in one vectorized pass
+       with generate_synthetic_lesion_batch. Each chunk draws from its own random stream spawned from lesion_selection_rng, so
+       the output for a given seed and chunk_size is identical whether the chunks run serially or across n_jobs worker processes.
+       Otherwise patients are generated one at a time, and the diameter changes of every lesion are drawn afterwards in one batch
+       from lesion_selection_rng with change_sampler, DEFAULT_CHANGE_SAMPLER if None. If site_mix maps locations to shares of the
+       lesions, base rows are drawn to match it with a LocationRowSampler, see samplers.site_mix_shares.
+       """
+    # Built once, so every chunk or patient shares the same precomputed sampling index
+    row_sampler = LocationRowSampler(base_radiomic_data[location_label].to_numpy(), site_mix=site_mix) if site_mix else None
+
+    if batch or parallel:
+        bounds = chunk_bounds(num_sim_patients, chunk_size)
+        chunk_rngs = spawn_chunk_rngs(lesion_selection_rng, len(bounds))
+        # Only the columns used for generation are published to the workers, once, rather than pickled into every chunk
+        base_columns = share_with_workers(select_base_columns(base_radiomic_data, location_label=location_label),
+                                          n_jobs=n_jobs if parallel else 1,
+                                          num_chunks=len(bounds))
+
+        synth_lesion_list = map_chunks(generate_synthetic_lesion_batch,
+                                       [{'num_sim_patients': stop - start,
+                                         'base_radiomic_data': base_columns,
+                                         'lesion_selection_rng': chunk_rng,
+                                         'expected_num_lesions': expected_num_lesions,
+                                         'max_num_lesions': max_num_lesions,
+                                         'location_label': location_label,
+                                         'first_patient_id': start,
+                                         'change_sampler': change_sampler,
+                                         'row_sampler': row_sampler}
+                                        for (start, stop), chunk_rng in zip(bounds, chunk_rngs, strict=True)],
+                                       n_jobs=n_jobs if parallel else 1)
+
+        return pd.concat(synth_lesion_list, ignore_index=True)
+
+    from tqdm import tqdm
+
+    synth_lesion_list = [
+        generate_synthetic_lesions(
+            base_radiomic_data=base_radiomic_data,
+            expected_num_lesions=expected_num_lesions,
+            max_num_lesions=max_num_lesions,
+            patient_id=pat_idx,
+            location_label=location_label,
+            lesion_selection_rng=lesion_selection_rng,
+            draw_changes=False,
+            row_sampler=row_sampler
         )
-    else:
-        synth_lesion_list = [
-            generate_synthetic_lesions(
-                base_radiomic_data=base_radiomic_data,
-                expected_num_lesions=expected_num_lesions,
-                max_num_lesions=max_num_lesions,
-                patient_id=pat_idx,
-                location_label=location_label,
-                lesion_selection_rng=lesion_selection_rng,
-                random_seed=pat_idx if random_seed else None
-            )
-            for pat_idx in tqdm(range(num_sim_patients),
-                                desc="Generating synthetic lesion data...",
-                                total=num_sim_patients)
-        ]
+        # Only check whether to redraw the progress bar every 1% of patients, and hide it when not writing to a terminal
+        for pat_idx in tqdm(range(num_sim_patients),
+                            desc="Generating synthetic lesion data...",
+                            total=num_sim_patients,
+                            miniters=max(1, num_sim_patients // 100),
+                            disable=None)
+    ]
 
     synth_lesion_pd = pd.concat(synth_lesion_list, ignore_index=True)
     synth_lesion_pd = synth_lesion_pd.sort_values(by='patient_id', ignore_index=True)
+    # Draw every lesion's diameter change in one call from the run's own random stream
+    diameter_change = (change_sampler or DEFAULT_CHANGE_SAMPLER).sample(lesion_selection_rng, len(synth_lesion_pd))
+    synth_lesion_pd = apply_diameter_changes(synth_lesion_pd, diameter_change)
 
-    # Add volumes
-    synth_lesion_pd['volume_cc_pre'] = volume_calc(synth_lesion_pd['diameter_pre'])
-    synth_lesion_pd['volume_cc_post'] = volume_calc(synth_lesion_pd['diameter_post'])
-    synth_lesion_pd['volume_cc_3Dmax'] = volume_calc(synth_lesion_pd['diameter_3D_max'])
-    synth_lesion_pd['volume_cc_majorAx'] = volume_calc(synth_lesion_pd['diameter_major_ax'])
-    synth_lesion_pd['volume_cc_minorAx'] = volume_calc(synth_lesion_pd['diameter_minor_ax'])
-
-    return synth_lesion_pd
\ No newline at end of file
+    return add_lesion_volumes(synth_lesion_pd)
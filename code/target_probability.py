@@ -0,0 +1,257 @@
+from math import comb
+
+import numpy as np
+import pandas as pd
+from criteria import RESPONSE_CRITERIA, criteria_codes, lesion_measures, percent_change
+from lesion_store import LesionStore
+from recist import (
+    MAX_TARGETS_PER_LOCATION,
+    RECIST_CATEGORIES,
+    lesion_location_codes,
+    rank_target_lesions,
+    recist_labels,
+    recist_metrics_from_counts,
+)
+
+# Patients with at most this many lesions have every target subset enumerated, 2^10 subsets each
+EXACT_MAX_LESIONS = 10
+# Number of random target rankings averaged over for each patient with more lesions than EXACT_MAX_LESIONS
+NUM_TARGET_DRAWS = 256
+# Rough number of array elements to work on at once, bounding the memory of both estimators
+BLOCK_ELEMENTS = 2_000_000
+
+
+def location_inclusion_weights(max_lesions: int) -> np.ndarray:
+    """Return the probability that a given set of s lesions at a location with n lesions are all among its eligible target lesions.
+
+    Indexed [n, s]. Up to MAX_TARGETS_PER_LOCATION lesions per location are eligible, chosen uniformly at random, so for n above
+    the limit the probability is comb(n - s, limit - s) / comb(n, limit), and 0 for more than limit lesions.
+    """
+    weights = np.zeros((max_lesions + 1, max_lesions + 1))
+    for num_lesions in range(max_lesions + 1):
+        for num_chosen in range(min(num_lesions, MAX_TARGETS_PER_LOCATION) + 1):
+            if num_lesions <= MAX_TARGETS_PER_LOCATION:
+                weights[num_lesions, num_chosen] = 1
+            else:
+                weights[num_lesions, num_chosen] = (comb(num_lesions - num_chosen, MAX_TARGETS_PER_LOCATION - num_chosen)
+                                                    / comb(num_lesions, MAX_TARGETS_PER_LOCATION))
+    return weights
+
+
+def exact_target_probabilities(measures: np.ndarray,
+                               location_codes: np.ndarray,
+                               all_codes: np.ndarray,
+                               pd_threshold: float,
+                               sd_threshold: float,
+                               max_targets: int
+                               ) -> tuple[np.ndarray, np.ndarray]:
+    """Probability of misclassification and of a PD response using 1 to max_targets target lesions, over every possible target subset.
+
+    For patients that all have the same number of lesions n, with measures of shape (patients, n, 2) holding the pre- and
+    post-treatment measure, location_codes of shape (patients, n) and all_codes their response code using all lesions.
+
+    The targets for k lesions are a uniformly random k of the patient's m eligible lesions, or all of them if k is m or more, so
+    a subset S of size min(k, m) is the target set with probability P(S eligible) / comb(m, |S|). P(S eligible) is the product of
+    location_inclusion_weights over the patient's locations, and summing it over the subsets of each size gives comb(m, |S|).
+    Returns two arrays of shape (patients, max_targets).
+    """
+    num_patients, num_lesions = location_codes.shape
+    subsets = ((np.arange(1 << num_lesions)[:, np.newaxis] >> np.arange(num_lesions)) & 1).astype(float)
+    subset_sizes = subsets.sum(axis=1).astype(np.int64)
+
+    # Lesion count at each of the patient's locations, and within each subset
+    location_onehot = (location_codes[..., np.newaxis] == np.unique(location_codes)).astype(float)
+    location_counts = location_onehot.sum(axis=1).astype(np.int64)
+    subset_location_counts = np.einsum('sn,pnl->psl', subsets, location_onehot).astype(np.int64)
+    inclusion = location_inclusion_weights(num_lesions)
+    subset_weights = np.prod(inclusion[location_counts[:, np.newaxis, :], subset_location_counts], axis=-1)
+
+    subset_sums = np.einsum('sn,pnm->psm', subsets, measures)
+    subset_codes = criteria_codes(percent_change(subset_sums[..., 0], subset_sums[..., 1]), pd_threshold, sd_threshold)
+    misclassified = subset_codes != all_codes[:, np.newaxis]
+    progressive = subset_codes == RECIST_CATEGORIES.index('PD')
+
+    # Weighted totals over the subsets of each size, shape (patients, n + 1)
+    size_onehot = (subset_sizes[:, np.newaxis] == np.arange(num_lesions + 1)).astype(float)
+    size_weights = subset_weights @ size_onehot
+    size_misclassified = (subset_weights * misclassified) @ size_onehot
+    size_progressive = (subset_weights * progressive) @ size_onehot
+
+    num_eligible = np.minimum(location_counts, MAX_TARGETS_PER_LOCATION).sum(axis=1)
+    target_sizes = np.minimum(np.arange(1, max_targets + 1), num_eligible[:, np.newaxis])
+    rows = np.arange(num_patients)[:, np.newaxis]
+    size_total = size_weights[rows, target_sizes]
+    return size_misclassified[rows, target_sizes] / size_total, size_progressive[rows, target_sizes] / size_total
+
+
+def sampled_target_probabilities(measures: np.ndarray,
+                                 patient_codes: np.ndarray,
+                                 location_codes: np.ndarray,
+                                 all_codes: np.ndarray,
+                                 pd_threshold: float,
+                                 sd_threshold: float,
+                                 max_targets: int,
+                                 num_draws: int,
+                                 rng: np.random.Generator
+                                 ) -> tuple[np.ndarray, np.ndarray]:
+    """Estimate the probabilities of exact_target_probabilities by averaging over num_draws random target rankings per patient.
+
+    measures of shape (lesions, 2), patient_codes numbering the patients from 0 and all_codes holding one response code per patient.
+    Every draw ranks the lesions with rank_target_lesions, as for a single assessment, but all draws are ranked together by giving
+    each (draw, patient) pair its own code, and only the row positions are repeated, never the lesion measures.
+    Returns two arrays of shape (patients, max_targets).
+    """
+    num_lesions = len(patient_codes)
+    num_patients = len(all_codes)
+
+    draw_codes = (np.arange(num_draws)[:, np.newaxis] * num_patients + patient_codes).ravel()
+    eligible, target_rank = rank_target_lesions(draw_codes,
+                                                np.tile(location_codes, num_draws),
+                                                rng)
+    in_sweep = target_rank < max_targets
+    eligible = eligible[in_sweep]
+
+    target_sums = np.zeros((num_draws * num_patients, max_targets, 2))
+    target_sums[draw_codes[eligible], target_rank[in_sweep]] = measures[eligible % num_lesions]
+    target_sums = np.cumsum(target_sums, axis=1).reshape(num_draws, num_patients, max_targets, 2)
+
+    target_codes = criteria_codes(percent_change(target_sums[..., 0], target_sums[..., 1]), pd_threshold, sd_threshold)
+    return (np.mean(target_codes != all_codes[:, np.newaxis], axis=0),
+            np.mean(target_codes == RECIST_CATEGORIES.index('PD'), axis=0))
+
+
+def target_misclassification_probability(lesion_data: pd.DataFrame | LesionStore,
+                                         lesion_selection_rng: np.random.Generator,
+                                         criterion: str = 'RECIST',
+                                         max_targets: int = 10,
+                                         num_draws: int = NUM_TARGET_DRAWS,
+                                         max_exact_lesions: int = EXACT_MAX_LESIONS
+                                         ) -> pd.DataFrame:
+    """Calculate each patient's probability of being misclassified, and of being assessed as PD, using 1 to max_targets target lesions.
+
+    Where target_lesion_sweep draws one random target subset per patient, this averages over target selection, so the mean over
+    patients has the expected value of the sampled accuracy with a far smaller variance. Patients with up to max_exact_lesions
+    lesions have every location-constrained target subset enumerated and weighted by its selection probability, see
+    exact_target_probabilities, and the rest average over num_draws random target rankings, see sampled_target_probabilities.
+
+    Parameters
+    ----------
+    lesion_data: pd.DataFrame | LesionStore
+        Lesion measurement data, like that output by generate_synthetic_patients.
+    lesion_selection_rng: np.random.Generator
+        Random number generator to use for the sampled target rankings.
+    criterion: str = 'RECIST'
+        Name of the RESPONSE_CRITERIA to assess.
+    max_targets: int = 10
+        Maximum number of target lesions to assess with.
+    num_draws: int = NUM_TARGET_DRAWS
+        Number of random target rankings per patient with more than max_exact_lesions lesions.
+    max_exact_lesions: int = EXACT_MAX_LESIONS
+        Largest number of lesions for which every target subset is enumerated. Each such patient takes 2^n subsets.
+
+    Returns
+    -------
+    pd.DataFrame
+        Sorted patient IDs, the number of lesions, whether the probabilities are exact, the "{criterion} (all)" response category
+        and "{criterion} misclassified (k targets)" and "{criterion} PD (k targets)" probability columns for each k from 1 to max_targets.
+    """
+    if criterion not in RESPONSE_CRITERIA:
+        message = f"{criterion} is not a supported response criterion, must be in {list(RESPONSE_CRITERIA)}."
+        raise ValueError(message)
+    spec = RESPONSE_CRITERIA[criterion]
+
+    patient_codes, patients = pd.factorize(np.asarray(lesion_data['patient_id']), sort=True)
+    num_patients = len(patients)
+    measures = lesion_measures(lesion_data, [spec['pre'], spec['post']])
+    location_codes = lesion_location_codes(lesion_data)
+
+    # Lesions grouped by patient, so each patient's lesions are one contiguous run
+    lesion_order = np.argsort(patient_codes, kind='stable')
+    patient_codes = patient_codes[lesion_order]
+    measures = measures[lesion_order]
+    location_codes = location_codes[lesion_order]
+    lesion_counts = np.bincount(patient_codes, minlength=num_patients)
+    patient_starts = np.cumsum(lesion_counts) - lesion_counts
+
+    sums = np.stack([np.bincount(patient_codes, weights=measures[:, index], minlength=num_patients) for index in range(2)], axis=-1)
+    all_codes = criteria_codes(percent_change(sums[:, 0], sums[:, 1]), spec['pd_threshold'], spec['sd_threshold'])
+
+    misclassified = np.empty((num_patients, max_targets))
+    progressive = np.empty((num_patients, max_targets))
+
+    # Patients with the same number of lesions share one subset enumeration, in blocks that bound the enumerated arrays
+    for num_lesions in np.unique(lesion_counts[lesion_counts <= max_exact_lesions]):
+        group = np.flatnonzero(lesion_counts == num_lesions)
+        block_size = max(1, BLOCK_ELEMENTS // ((1 << num_lesions) * num_lesions))
+        for block_start in range(0, len(group), block_size):
+            block = group[block_start:block_start + block_size]
+            rows = patient_starts[block][:, np.newaxis] + np.arange(num_lesions)
+            misclassified[block], progressive[block] = exact_target_probabilities(measures=measures[rows],
+                                                                                  location_codes=location_codes[rows],
+                                                                                  all_codes=all_codes[block],
+                                                                                  pd_threshold=spec['pd_threshold'],
+                                                                                  sd_threshold=spec['sd_threshold'],
+                                                                                  max_targets=max_targets)
+
+    # The rest are sampled in blocks of patients with about BLOCK_ELEMENTS lesion rankings each
+    sampled = np.flatnonzero(lesion_counts > max_exact_lesions)
+    block_start = 0
+    while block_start < len(sampled):
+        block_lesions = np.cumsum(lesion_counts[sampled[block_start:]]) * num_draws
+        block_end = block_start + max(1, int(np.searchsorted(block_lesions, BLOCK_ELEMENTS, side='right')))
+        block = sampled[block_start:block_end]
+        rows = np.concatenate([np.arange(patient_starts[patient], patient_starts[patient] + lesion_counts[patient]) for patient in block])
+        misclassified[block], progressive[block] = sampled_target_probabilities(measures=measures[rows],
+                                                                                patient_codes=np.repeat(np.arange(len(block)), lesion_counts[block]),
+                                                                                location_codes=location_codes[rows],
+                                                                                all_codes=all_codes[block],
+                                                                                pd_threshold=spec['pd_threshold'],
+                                                                                sd_threshold=spec['sd_threshold'],
+                                                                                max_targets=max_targets,
+                                                                                num_draws=num_draws,
+                                                                                rng=lesion_selection_rng)
+        block_start = block_end
+
+    probabilities = {'patient_id': patients,
+                     'num_lesions': lesion_counts,
+                     'exact': lesion_counts <= max_exact_lesions,
+                     f"{criterion} (all)": recist_labels(all_codes)}
+    for num_targets in range(1, max_targets + 1):
+        probabilities[f"{criterion} misclassified ({num_targets} targets)"] = misclassified[:, num_targets - 1]
+    for num_targets in range(1, max_targets + 1):
+        probabilities[f"{criterion} PD ({num_targets} targets)"] = progressive[:, num_targets - 1]
+
+    return pd.DataFrame(probabilities)
+
+
+def expected_metric_counts(probabilities: pd.DataFrame,
+                           criterion: str = 'RECIST',
+                           max_targets: int = 11
+                           ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Expected values of the confusion_metric_counts for target counts 1 to max_targets - 1, from target_misclassification_probability output.
+
+    Each eligible patient adds its probability of agreeing with, and PD patients their probability of being detected as PD by,
+    k target lesions in place of a 0 or 1 count, so recist_metrics_from_counts gives the expected accuracy and PD sensitivity.
+    """
+    num_targets = np.arange(1, max_targets)
+    misclassified = probabilities[[f"{criterion} misclassified ({count} targets)" for count in num_targets]].to_numpy()
+    progressive_probability = probabilities[[f"{criterion} PD ({count} targets)" for count in num_targets]].to_numpy()
+
+    eligible = probabilities['num_lesions'].to_numpy()[:, np.newaxis] > num_targets
+    progressive = eligible & (probabilities[f"{criterion} (all)"].to_numpy() == 'PD')[:, np.newaxis]
+
+    return (np.sum(eligible, axis=0),
+            np.sum(eligible * (1 - misclassified), axis=0),
+            np.sum(progressive, axis=0),
+            np.sum(progressive * progressive_probability, axis=0))
+
+
+def expected_replicate_metrics(probabilities: pd.DataFrame,
+                               patients_per_replicate: int,
+                               criterion: str = 'RECIST',
+                               max_targets: int = 11
+                               ) -> tuple[np.ndarray, np.ndarray]:
+    """Expected accuracy and PD sensitivity of each replicate cohort of patients_per_replicate consecutive patient IDs, each of shape (replicates, K)."""
+    replicate_counts = [expected_metric_counts(replicate_probabilities, criterion=criterion, max_targets=max_targets)
+                        for _, replicate_probabilities in probabilities.groupby(probabilities['patient_id'] // patients_per_replicate)]
+    return recist_metrics_from_counts(*(np.stack(counts) for counts in zip(*replicate_counts, strict=True)))
@@ -0,0 +1,17 @@
+import hashlib
+from pathlib import Path
+
+# Source files whose contents change the simulation results, hashed into the code version of checkpoints and cached sweep cells.
+# Modules on the simulation path that only write outputs or time stages (checkpoint, output, profiling) are left out.
+SIMULATION_SOURCES = ['chunking.py', 'criteria.py', 'ingest.py', 'lesion_store.py', 'recist.py', 'samplers.py', 'shared_table.py',
+                      'streaming.py', 'synthetic_gen.py', 'target_probability.py']
+
+
+def code_version() -> str:
+    """Return the package version and a hash of the simulation source files, so saved results are invalidated when the code changes."""
+    code_dir = Path(__file__).parent
+    source_hash = hashlib.sha256()
+    for source in SIMULATION_SOURCES:
+        source_hash.update((code_dir / source).read_bytes())
+    version = (code_dir.parent / "version.txt").read_text().strip()
+    return f"{version}+{source_hash.hexdigest()[:12]}"